@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 
+import contextlib
 import hashlib
+import io
 from functools import wraps
 import logging
 import os
 import shutil
+import socket
+import struct
 import tempfile
+import threading
 import unittest
 
 import vignette
@@ -75,6 +80,16 @@ class ThumbnailTests(unittest.TestCase):
 		assert os.path.isfile(dest)
 		self.assertEqual(dest, vignette.try_get_thumbnail(dest, 'large'))
 
+		# a path, even when given a key
+		key = vignette.thumbnail_key(dest)
+		for result in (
+			vignette.try_get_thumbnail(key, 'large'),
+			vignette.get_thumbnail(dest, 'large'),
+			vignette.get_thumbnail(key, 'large'),
+		):
+			self.assertIsInstance(result, str)
+			self.assertEqual(result, dest)
+
 	def test_mtime_validity(self):
 		dest = vignette.get_thumbnail(self.filename, 'large')
 		assert dest
@@ -141,6 +156,934 @@ class ThumbnailTests(unittest.TestCase):
 		assert dest
 		self.assertEqual(dest, vignette.get_thumbnail(self.filename, use_fail_appname='foo'))
 
+	def test_read_png_text(self):
+		dest = vignette.get_thumbnail(self.filename, 'large')
+		text = vignette.read_png_text(dest)
+		self.assertEqual(text[vignette.KEY_URI], 'file://%s' % self.filename)
+		self.assertEqual(int(text[vignette.KEY_MTIME]), int(os.path.getmtime(self.filename)))
+		self.assertIsNone(vignette.read_png_text(__file__))
+
+		try:
+			from PIL import Image, PngImagePlugin
+		except ImportError:
+			return
+
+		info = PngImagePlugin.PngInfo()
+		info.add_text('foo', 'bar', zip=True)
+		info.add_itxt('baz', u'\xe9t\xe9', zip=True)
+		info.add_itxt('qux', u'plain')
+		Image.open(self.filename).save(dest, pnginfo=info)
+		self.assertEqual(
+			vignette.read_png_text(dest),
+			{'foo': 'bar', 'baz': u'\xe9t\xe9', 'qux': 'plain'}
+		)
+
+	def test_write_png_text(self):
+		def chunks(path, ctype):
+			with open(path, 'rb') as fd:
+				data = fd.read()
+			return [
+				data[pos + 4:pos + 4 + struct.unpack('>I', data[pos - 4:pos])[0]]
+				for pos in range(8, len(data)) if data[pos:pos + 4] == ctype
+			]
+
+		dest = os.path.join(self.dir, 'out.png')
+		assert vignette.write_png_text(self.filename, dest, {'foo': 'bar', 'baz': u'\u263a'})
+		self.assertEqual(chunks(self.filename, b'IDAT'), chunks(dest, b'IDAT'))
+		text = vignette.read_png_text(dest)
+		self.assertEqual(text['foo'], 'bar')
+		self.assertEqual(text['baz'], u'\u263a')
+
+		assert vignette.write_png_text(dest, dest + '2', {'foo': 'qux'})
+		foos = [c for c in chunks(dest + '2', b'tEXt') if c.startswith(b'foo\0')]
+		self.assertEqual(foos, [b'foo\0qux'])
+
+		assert not vignette.write_png_text(__file__, dest, {'foo': 'bar'})
+
+	def test_backend_registry(self):
+		class CountingBackend(vignette.ThumbnailBackend):
+			probes = 0
+
+			def is_available(self):
+				self.probes += 1
+				return True
+
+		backend = CountingBackend()
+		registry = vignette.BackendRegistry()
+		self.assertEqual(registry.available([backend]), (backend,))
+		self.assertEqual(registry.available([backend, backend]), (backend, backend))
+		self.assertEqual(backend.probes, 1)
+
+		registry.refresh()
+		registry.available([backend])
+		self.assertEqual(backend.probes, 2)
+
+		old_path = os.environ['PATH']
+		os.environ['PATH'] += os.pathsep + self.dir
+		try:
+			registry.available([backend])
+		finally:
+			os.environ['PATH'] = old_path
+		self.assertEqual(backend.probes, 3)
+
+	def test_backend_mime_dispatch(self):
+		pdf = vignette.PopplerCliBackend()
+		pdf.is_available = lambda: True
+		image = vignette.PilBackend()
+		image.is_available = lambda: True
+
+		registry = vignette.BackendRegistry()
+		self.assertEqual(registry.for_mime([pdf, image], 'image/png'), (image,))
+		self.assertEqual(registry.for_mime([pdf, image], 'application/pdf'), (pdf,))
+		self.assertEqual(registry.for_mime([pdf, image], None), ())
+
+		image.accepts_mime = lambda mime: False
+		self.assertEqual(registry.for_mime([pdf, image], 'image/png'), (image,))
+		registry.refresh()
+		self.assertEqual(registry.for_mime([pdf, image], 'image/png'), ())
+
+		# backends overriding is_accepted are asked with the path
+		class ByName(vignette.PilBackend):
+			def is_accepted(self, path):
+				return path.endswith('.thumbme')
+
+		by_name = ByName()
+		self.assertEqual(registry.for_mime([pdf, by_name], None), (by_name,))
+
+		if not by_name.is_available():
+			return
+		src = os.path.join(self.dir, 'file.thumbme')
+		shutil.copyfile(self.filename, src)
+		vignette.THUMBNAILER_BACKENDS = [by_name]
+		assert vignette.create_thumbnail(src, 'large')
+		self.assertIsNone(vignette.create_thumbnail(self.filename, 'large'))
+
+	def test_lazy_backends(self):
+		built = []
+		backends = vignette.LazyBackendList(lambda: built.append(1) or [vignette.PilBackend()])
+		assert not backends.loaded
+		vignette.build_thumbnail_path(self.filename, 'large')
+		self.assertEqual(built, [])
+
+		backends.append(vignette.QtBackend())
+		self.assertEqual(len(backends), 2)
+		self.assertIsInstance(backends[0], vignette.PilBackend)
+		self.assertEqual(built, [1])
+
+		# importing the module doesn't build the default lists
+		import subprocess
+		import sys
+
+		subprocess.check_call([
+			sys.executable, '-c',
+			'import vignette; assert not vignette.THUMBNAILER_BACKENDS.loaded; '
+			'assert not vignette.ALL_THUMBNAILER_BACKENDS.loaded',
+		], cwd=os.path.dirname(os.path.abspath(__file__)))
+
+	def test_cli_backend(self):
+		vignette.THUMBNAILER_BACKENDS = [vignette.GnomeThumbnailer('cp', 'cp %i %o', ['image/png'])]
+
+		dest = vignette.get_thumbnail(self.filename, 'large')
+		assert dest
+		self.assertEqual(dest, vignette.try_get_thumbnail(self.filename, 'large'))
+
+	def test_command_scheduler(self):
+		import time
+
+		scheduler = vignette.CommandScheduler(max_workers=1)
+		self.assertEqual(scheduler.run(['echo', 'foo']), b'foo\n')
+		self.assertIsNone(scheduler.run(['false']))
+
+		start = time.time()
+		self.assertIsNone(scheduler.run(['sleep', '10'], timeout=.2))
+		assert time.time() - start < 5
+		self.assertEqual(scheduler.timeouts, 1)
+
+		# the second command waits for the first one
+		thread = threading.Thread(target=scheduler.run, args=(['sleep', '.5'],))
+		thread.start()
+		time.sleep(.1)
+		waiter = threading.Thread(target=scheduler.run, args=(['true'],))
+		waiter.start()
+		time.sleep(.1)
+		self.assertEqual(scheduler.running, 1)
+		self.assertEqual(scheduler.queue_depth, 1)
+		thread.join()
+		waiter.join()
+		self.assertEqual(scheduler.queue_depth, 0)
+
+		backend = vignette.GnomeThumbnailer('sleep', 'sleep 10', ['image/png'])
+		backend.timeout = .2
+		self.assertIsNone(backend.create_thumbnail(self.filename, os.path.join(self.dir, 'out'), 128))
+
+	def test_single_flight(self):
+		import time
+
+		create_thumbnail = vignette.create_thumbnail
+		calls = []
+
+		def slow_create(*args, **kwargs):
+			calls.append(args)
+			time.sleep(.2)
+			return create_thumbnail(*args, **kwargs)
+
+		vignette.create_thumbnail = slow_create
+		try:
+			results = []
+			threads = [
+				threading.Thread(target=lambda: results.append(vignette.get_thumbnail(self.filename, 'large')))
+				for _ in range(8)
+			]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			self.assertEqual(len(calls), 1)
+			self.assertEqual(results, [vignette.build_thumbnail_path(self.filename, 'large')] * 8)
+
+			# another process is generating the normal thumbnail
+			lock = vignette._ThumbnailLock(vignette._any2uri(self.filename), 'normal')
+			assert lock.acquire()
+			thread = threading.Thread(target=lambda: results.append(vignette.get_thumbnail(self.filename, 'normal')))
+			thread.start()
+			time.sleep(.1)
+			assert thread.is_alive()
+			dest = create_thumbnail(self.filename, 'normal')
+			lock.release()
+			thread.join()
+			self.assertEqual(results[-1], dest)
+			self.assertEqual(len(calls), 1)
+			self.assertEqual(os.listdir(os.path.join(self.dir, 'thumbnails', '.vignette-locks')), [])
+		finally:
+			vignette.create_thumbnail = create_thumbnail
+
+	def test_thumbnail_key(self):
+		key = vignette.thumbnail_key(self.filename)
+		self.assertIs(key, vignette.thumbnail_key(self.filename))
+		self.assertIs(key, vignette.thumbnail_key(key))
+		self.assertEqual(key.uri, 'file://%s' % self.filename)
+		self.assertEqual(key.md5, vignette.hash_name(self.filename))
+		self.assertEqual(key.thumbnail_path('large'), vignette.build_thumbnail_path(self.filename, 'large'))
+
+		self.assertIsNone(vignette.try_get_thumbnail(key, 'large'))
+		dest = vignette.get_thumbnail(key, 'large')
+		self.assertEqual(dest, key.thumbnail_path('large'))
+		self.assertEqual(dest, vignette.try_get_thumbnail(self.filename, 'large'))
+		self.assertEqual(dest, vignette.try_get_thumbnail(key, 'large'))
+
+		empty = os.path.join(self.dir, 'empty')
+		open(empty, 'w').close()
+		empty_key = vignette.ThumbnailKey(empty)
+		self.assertIsNone(vignette.create_thumbnail(empty_key, 'normal', use_fail_appname='foo'))
+		assert vignette.is_thumbnail_failed(empty, 'foo')
+		assert vignette.is_thumbnail_failed(empty_key, 'foo')
+
+		# keys depend on the store location
+		os.environ['XDG_CACHE_HOME'] = os.path.join(self.dir, 'other')
+		self.assertIsNot(key, vignette.thumbnail_key(self.filename))
+		assert vignette.build_thumbnail_path(self.filename, 'large').startswith(os.environ['XDG_CACHE_HOME'])
+
+	def test_lookup_directory(self):
+		other = os.path.join(self.dir, 'other.png')
+		shutil.copyfile(self.filename, other)
+		os.mkdir(os.path.join(self.dir, 'subdir'))
+
+		self.assertEqual(vignette.lookup_directory(self.dir), {self.filename: None, other: None})
+
+		large = vignette.get_thumbnail(self.filename, 'large')
+		normal = vignette.get_thumbnail(other, 'normal')
+		self.assertEqual(vignette.lookup_directory(self.dir), {self.filename: large, other: normal})
+		self.assertEqual(vignette.lookup_directory(self.dir, 'normal'), {self.filename: None, other: normal})
+
+		existing = vignette.list_store()
+		self.assertEqual(existing['large'], {os.path.basename(large)})
+		self.assertEqual(
+			vignette.lookup_directory(self.dir, existing=existing), {self.filename: large, other: normal}
+		)
+		self.assertEqual(
+			vignette.lookup_directory(self.dir, existing={'large': set(), 'normal': set()}),
+			{self.filename: None, other: None}
+		)
+
+		# obsolete
+		os.utime(other, (0, 0))
+		self.assertEqual(vignette.lookup_directory(self.dir), {self.filename: large, other: None})
+
+	def test_warm(self):
+		from vignette import warm
+
+		tree = os.path.join(self.dir, 'tree')
+		for sub in ('a', 'a/b', 'c', '.hidden'):
+			os.makedirs(os.path.join(tree, sub))
+		srcs = [os.path.join(tree, name) for name in ('x.png', 'a/x.png', 'a/b/x.png', 'c/x.png', '.hidden/x.png')]
+		for src in srcs:
+			shutil.copyfile(self.filename, src)
+		empty = os.path.join(tree, 'c', 'empty')
+		open(empty, 'w').close()
+
+		self.assertEqual(
+			list(warm.iter_tree([tree])),
+			[tree] + [os.path.join(tree, sub) for sub in ('a', 'a/b', 'c')]
+		)
+
+		vignette.get_thumbnail(srcs[0], 'large')
+		journal = warm.Journal(os.path.join(self.dir, 'journal'))
+		journal.add(os.path.join(tree, 'a', 'b'))
+
+		summary = warm.warm_tree([tree], journal=journal, workers=1)
+		self.assertEqual(summary, (2, 1, 1))
+		assert vignette.try_get_thumbnail(srcs[1], 'large')
+		assert not vignette.try_get_thumbnail(srcs[2], 'large')
+		assert not vignette.try_get_thumbnail(srcs[4], 'large')
+		assert vignette.is_thumbnail_failed(empty, warm.FAIL_APPNAME)
+		journal.close()
+		self.assertEqual(
+			warm.Journal(journal.path).done,
+			set([tree] + [os.path.join(tree, sub) for sub in ('a', 'a/b', 'c')])
+		)
+
+		# without journal, a/b is not skipped
+		self.assertEqual(warm.warm_tree([tree], workers=1), (1, 4, 0))
+		self.assertEqual(warm.warm_tree([tree], workers=1, retry_failed=True), (0, 4, 1))
+		# positional arguments of earlier versions
+		self.assertEqual(
+			warm.warm_tree([tree], 'large', warm.FAIL_APPNAME, False, 1, None, False, None), (0, 5, 0)
+		)
+		self.assertEqual(warm.warm_tree([tree], workers=2, threads=True), (0, 5, 0))
+
+		# overlapping roots
+		self.assertEqual(
+			list(warm.iter_tree([os.path.join(tree, 'a'), tree, tree + '/'])),
+			[tree] + [os.path.join(tree, sub) for sub in ('a', 'a/b', 'c')]
+		)
+		for sub in ('a', 'a/b'):
+			os.remove(vignette.build_thumbnail_path(os.path.join(tree, sub, 'x.png'), 'large'))
+		self.assertEqual(warm.warm_tree([tree, os.path.join(tree, 'a'), tree + '/'], workers=1), (2, 3, 0))
+
+		journal_path = warm.default_journal_path([tree], 'large')
+		with contextlib.redirect_stdout(io.StringIO()) as out:
+			self.assertIsNone(vignette.main(['warm', '--workers', '1', tree]))
+		self.assertEqual(out.getvalue(), 'Created 0 thumbnails, 5 up to date, 0 failed\n')
+		assert not os.path.exists(journal_path)
+
+	def test_warm_many_dirs(self):
+		from vignette import warm
+
+		tree = os.path.join(self.dir, 'tree')
+		for n in range(50):
+			os.makedirs(os.path.join(tree, '%02d' % n))
+			src = os.path.join(tree, '%02d' % n, 'empty')
+			open(src, 'w').close()
+			vignette.put_fail(src, warm.FAIL_APPNAME)
+
+		store = os.path.join(vignette._thumb_path_prefix(), 'large')
+		listed = []
+		real_listdir = os.listdir
+
+		def listdir(path='.'):
+			if path == store:
+				listed.append(path)
+			return real_listdir(path)
+
+		os.listdir = listdir
+		try:
+			self.assertEqual(warm.warm_tree([tree], workers=1), (0, 50, 0))
+		finally:
+			os.listdir = real_listdir
+		self.assertEqual(len(listed), 1)
+
+	def test_bench(self):
+		from vignette import bench
+
+		results = bench.run_benchmarks(count=10, runs=1, backends=['pil'], size=(64, 48))
+		self.assertEqual(os.environ['XDG_CACHE_HOME'], self.dir)
+		self.assertEqual(results['put_thumbnail']['count'], 10)
+		self.assertEqual(results['is_thumbnail_failed_hit']['count'], 5)
+		if vignette.PilBackend().is_available():
+			self.assertEqual(results['create_thumbnail_pil']['count'], 1)
+			self.assertEqual(results['scan_store']['count'], 16)
+		else:
+			self.assertEqual(results['scan_store']['count'], 15)
+
+		self.assertEqual(bench.percentile([1, 2, 3, 4], 50), 2)
+		self.assertEqual(bench.percentile([1, 2, 3, 4], 99), 4)
+
+	def test_in_memory(self):
+		if not vignette.PilBackend().is_available():
+			return
+
+		data = vignette.create_thumbnail_bytes(self.filename, 'large')
+		assert data.startswith(vignette.PNG_SIGNATURE)
+		self.assertIsNone(vignette.try_get_thumbnail(self.filename, 'large'))
+		path = os.path.join(self.dir, 'out.png')
+		with open(path, 'wb') as fd:
+			fd.write(data)
+		self.assertEqual(vignette.read_png_text(path)[vignette.KEY_URI], 'file://%s' % self.filename)
+
+		with open(self.filename, 'rb') as fd:
+			content = fd.read()
+		uri = 'http://example.com/upload.png'
+		with self.assertRaises(ValueError):
+			vignette.create_thumbnail_bytes(content, 'normal', uri=uri, store=True)
+		self.assertEqual(
+			vignette.create_thumbnail_bytes(io.BytesIO(content), 'normal', uri=uri, mtime=42, store=True),
+			vignette.create_thumbnail_bytes(content, 'normal', uri=uri, mtime=42),
+		)
+		assert vignette.try_get_thumbnail(uri, 'normal', mtime=42)
+		self.assertIsNone(vignette.create_thumbnail_bytes(b'not an image', 'normal'))
+
+		img = vignette.get_thumbnail_image(self.filename, 'large', store=True)
+		assert max(img.size) <= 256
+		dest = vignette.try_get_thumbnail(self.filename, 'large')
+		assert dest
+		self.assertEqual(vignette.get_thumbnail_image(self.filename, 'large').filename, dest)
+		assert max(vignette.get_thumbnail_image(content, 'normal').size) <= 128
+
+	def test_stats(self):
+		from vignette.stats import Stats
+
+		empty = os.path.join(self.dir, 'empty')
+		open(empty, 'w').close()
+		records = []
+		vignette.STATS = stats = Stats()
+		stats.hooks.append(lambda *args: records.append(args))
+		try:
+			dest = vignette.get_thumbnail(self.filename, 'large')
+			self.assertEqual(dest, vignette.try_get_thumbnail(self.filename, 'large'))
+			os.utime(self.filename, (0, 0))
+			self.assertIsNone(vignette.try_get_thumbnail(self.filename, 'large'))
+
+			self.assertIsNone(vignette.get_thumbnail(empty, 'large', use_fail_appname='foo'))
+			self.assertIsNone(vignette.get_thumbnail(empty, 'large', use_fail_appname='foo'))
+		finally:
+			vignette.STATS = None
+
+		self.assertEqual(stats.counters[('miss', None)], 3)
+		self.assertEqual(stats.counters[('hit', None)], 1)
+		self.assertEqual(stats.counters[('stale', None)], 1)
+		self.assertEqual(stats.counters[('failure', None)], 1)
+		self.assertEqual(stats.counters[('fail_file', None)], 1)
+
+		stages = set(stage for stage, _ in stats.timings)
+		assert set(['key', 'get_info', 'create', 'install']) <= stages, stages
+		backends = [backend for stage, backend in stats.timings if stage == 'create']
+		assert all(backends), backends
+
+		snapshot = stats.snapshot()
+		self.assertEqual(
+			sum(row['count'] for row in snapshot['timings']),
+			len([r for r in records if r[0] == 'time'])
+		)
+		self.assertEqual(
+			sum(row['count'] for row in snapshot['counters']),
+			len([r for r in records if r[0] == 'count'])
+		)
+
+		stats.reset()
+		self.assertEqual(stats.snapshot(), {'timings': [], 'counters': []})
+
+	def test_store_index(self):
+		from vignette.index import StoreIndex
+
+		index = vignette.STORE_INDEX = StoreIndex()
+		try:
+			dest = vignette.get_thumbnail(self.filename, 'large')
+			self.assertEqual(len(index), 1)
+			self.assertEqual(dest, vignette.try_get_thumbnail(self.filename, 'large'))
+			self.assertEqual((index.hits, index.misses), (1, 0))
+
+			# obsolete
+			self.assertIsNone(vignette.try_get_thumbnail(self.filename, 'large', mtime=1))
+			self.assertEqual(index.hits, 2)
+
+			# modified by another app: read and repaired
+			shutil.copyfile('test.png', dest)
+			self.assertIsNone(vignette.try_get_thumbnail(self.filename, 'large'))
+			self.assertEqual(index.misses, 1)
+			self.assertIsNone(vignette.try_get_thumbnail(self.filename, 'large'))
+			self.assertEqual(index.hits, 3)
+
+			empty = os.path.join(self.dir, 'empty')
+			open(empty, 'w').close()
+			vignette.put_fail(empty, 'foo')
+			assert vignette.is_thumbnail_failed(empty, 'foo')
+			self.assertEqual(index.hits, 4)
+
+			vignette.create_thumbnail(self.filename, 'normal')
+			index.clear()
+			self.assertEqual(index.rebuild(), 2)
+			assert vignette.try_get_thumbnail(self.filename, 'normal')
+			self.assertEqual((index.hits, index.misses), (1, 0))
+		finally:
+			vignette.STORE_INDEX = None
+
+	def test_store_index_unwritable(self):
+		import sqlite3
+		from vignette.index import StoreIndex
+
+		# the store can't be created under a file, even by root
+		blocker = os.path.join(self.dir, 'file')
+		open(blocker, 'w').close()
+		root = os.path.join(blocker, 'thumbnails')
+		index = StoreIndex(root)
+
+		thumb = os.path.join(root, 'large', 'x.png')
+		self.assertIsNone(index.is_valid(thumb, 'file:///x', 0))
+		self.assertIsInstance(index.error, OSError)
+		index.update(thumb, 'file:///x', 0)
+		index.forget(thumb)
+		with self.assertRaises(sqlite3.Error):
+			len(index)
+
+		# database which can't be opened
+		index = vignette.STORE_INDEX = StoreIndex()
+		index.path = os.path.join(blocker, 'index.sqlite')
+		try:
+			dest = vignette.get_thumbnail(self.filename, 'large')
+			self.assertEqual(dest, vignette.try_get_thumbnail(self.filename, 'large'))
+			self.assertIsInstance(index.error, sqlite3.Error)
+		finally:
+			vignette.STORE_INDEX = None
+
+	def test_daemon(self):
+		from vignette import daemon
+
+		path = os.path.join(self.dir, 'sock')
+		server = daemon.ThumbnailServer(path, workers=1)
+		server.start()
+		thread = threading.Thread(target=server.serve_forever)
+		thread.start()
+
+		# not a socket, left alone
+		notes = os.path.join(self.dir, 'notes.txt')
+		open(notes, 'w').close()
+		with self.assertRaises(daemon.DaemonError):
+			daemon.ThumbnailServer(notes, workers=1).start()
+		assert os.path.exists(notes)
+
+		daemon.SOCKET_PATH = path
+		vignette.USE_DAEMON = True
+		try:
+			self.assertEqual(daemon.call('ping'), os.path.join(self.dir, 'thumbnails'))
+
+			dest = vignette.get_thumbnail(self.filename, 'large')
+			self.assertEqual(dest, vignette.build_thumbnail_path(self.filename, 'large'))
+			self.assertEqual(dest, vignette.try_get_thumbnail(self.filename, 'large'))
+
+			empty = os.path.join(self.dir, 'empty')
+			open(empty, 'w').close()
+			self.assertEqual(
+				daemon.call('get_thumbnails', srcs=[self.filename, empty], size='normal'),
+				[vignette.build_thumbnail_path(self.filename, 'normal'), None]
+			)
+
+			with self.assertRaises(daemon.DaemonError):
+				daemon.call('foo')
+
+			# workers killed: the daemon starts new ones, the client generates locally meanwhile
+			import signal
+
+			executor = server._executor
+			for pid in list(executor._processes):
+				os.kill(pid, signal.SIGKILL)
+			for n in range(2):
+				other = os.path.join(self.dir, 'crash%d.png' % n)
+				shutil.copyfile(self.filename, other)
+				self.assertEqual(vignette.get_thumbnail(other, 'large'), vignette.build_thumbnail_path(other, 'large'))
+			self.assertIsNot(server._executor, executor)
+			other = os.path.join(self.dir, 'restarted.png')
+			shutil.copyfile(self.filename, other)
+			self.assertEqual(
+				daemon.call('get_thumbnail', src=other, size='large'), vignette.build_thumbnail_path(other, 'large')
+			)
+			with self.assertRaises(daemon.DaemonUnavailable):
+				daemon.call('ping', store='/nonexistent')
+		finally:
+			server.shutdown()
+			thread.join()
+			server.close()
+
+		try:
+			assert not os.path.exists(path)
+			with self.assertRaises(daemon.DaemonUnavailable):
+				daemon.call('ping')
+			# generated locally
+			assert vignette.get_thumbnail(self.filename, 'normal')
+
+			# a daemon which doesn't answer
+			hung = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			hung.bind(path)
+			hung.listen(1)
+			daemon.TIMEOUT = .2
+			try:
+				with self.assertRaises(daemon.DaemonUnavailable):
+					daemon.call('ping')
+				other = os.path.join(self.dir, 'other.png')
+				shutil.copyfile(self.filename, other)
+				assert vignette.get_thumbnail(other, 'large')
+			finally:
+				hung.close()
+		finally:
+			daemon.TIMEOUT = 60
+			daemon.SOCKET_PATH = None
+			vignette.USE_DAEMON = False
+
+	def test_scheduler(self):
+		from vignette import scheduler
+
+		get_thumbnail = vignette.get_thumbnail
+		started = threading.Event()
+		blocker = threading.Event()
+		calls = []
+
+		def blocking_get(src, size=None, use_fail_appname=None):
+			calls.append(vignette._source_path(src))
+			started.set()
+			blocker.wait(5)
+			return get_thumbnail(src, size, use_fail_appname)
+
+		srcs = [os.path.join(self.dir, 'f%d.png' % n) for n in range(5)]
+		for src in srcs:
+			shutil.copyfile(self.filename, src)
+
+		vignette.get_thumbnail = blocking_get
+		try:
+			with scheduler.ThumbnailScheduler(workers=1) as sched:
+				first = sched.submit(srcs[0])
+				assert started.wait(5)
+
+				background = sched.submit(srcs[1], priority=scheduler.PRIORITY_BACKGROUND)
+				default = sched.submit(srcs[2])
+				foreground = sched.submit(srcs[3], priority=scheduler.PRIORITY_FOREGROUND)
+				dropped = sched.submit(srcs[4])
+				self.assertIs(sched.submit(srcs[2], 'large'), default)
+				self.assertEqual(len(sched), 4)
+
+				assert sched.set_priority(background, scheduler.PRIORITY_FOREGROUND)
+				assert sched.cancel(dropped)
+				assert not sched.cancel(first)
+				assert not sched.set_priority(first, scheduler.PRIORITY_FOREGROUND)
+				blocker.set()
+
+				self.assertEqual(foreground.result(5), vignette.build_thumbnail_path(srcs[3], 'large'))
+				self.assertEqual(default.result(5), vignette.build_thumbnail_path(srcs[2], 'large'))
+				assert first.result(5)
+				assert dropped.cancelled()
+				self.assertEqual(calls, [srcs[0], srcs[3], srcs[1], srcs[2]])
+		finally:
+			vignette.get_thumbnail = get_thumbnail
+
+		with self.assertRaises(RuntimeError):
+			sched.submit(srcs[4])
+
+		# cancelled with the future itself, then submitted again
+		blocker.clear()
+		started.clear()
+		vignette.get_thumbnail = blocking_get
+		try:
+			with scheduler.ThumbnailScheduler(workers=1) as sched:
+				busy = sched.submit(srcs[0], 'normal')
+				assert started.wait(5)
+				cancelled = sched.submit(srcs[1], 'normal')
+				assert cancelled.cancel()
+				self.assertEqual(len(sched), 0)
+				again = sched.submit(srcs[1], 'normal')
+				self.assertIsNot(again, cancelled)
+				self.assertEqual(len(sched), 1)
+				blocker.set()
+
+				assert busy.result(5)
+				self.assertEqual(again.result(5), vignette.build_thumbnail_path(srcs[1], 'normal'))
+				assert all(thread.is_alive() for thread in sched._threads)
+		finally:
+			vignette.get_thumbnail = get_thumbnail
+
+	def test_aio(self):
+		import asyncio
+		import vignette.aio
+
+		empty = os.path.join(self.dir, 'empty')
+		open(empty, 'w').close()
+		vignette.THUMBNAILER_BACKENDS = list(vignette.THUMBNAILER_BACKENDS) + [
+			vignette.GnomeThumbnailer('cp', 'cp %i %o', ['image/png']),
+			vignette.GnomeThumbnailer('false', 'false %i %o', ['application/x-empty', 'inode/x-empty']),
+		]
+
+		async def run():
+			self.assertIsNone(await vignette.aio.try_get_thumbnail(self.filename, 'large'))
+			dest = await vignette.aio.get_thumbnail(self.filename, 'large')
+			self.assertEqual(dest, await vignette.aio.try_get_thumbnail(self.filename, 'large'))
+			self.assertIsInstance(await vignette.aio.get_thumbnail(dest, 'large'), str)
+
+			self.assertIsNone(await vignette.aio.get_thumbnail(empty, 'large', use_fail_appname='foo'))
+			assert vignette.is_thumbnail_failed(empty, 'foo')
+
+			self.assertIsNone(await vignette.aio._run_command(['sleep', '10'], .2))
+
+			# cancelled by the caller
+			pidfile = os.path.join(self.dir, 'pid')
+			task = asyncio.ensure_future(vignette.aio._run_command(
+				['sh', '-c', 'echo $$ > %s; exec sleep 37' % pidfile], 60
+			))
+			for _ in range(100):
+				if os.path.exists(pidfile) and os.path.getsize(pidfile):
+					break
+				await asyncio.sleep(.05)
+			with open(pidfile) as fd:
+				pid = int(fd.read())
+			task.cancel()
+			with self.assertRaises(asyncio.CancelledError):
+				await task
+			with self.assertRaises(ProcessLookupError):
+				os.kill(pid, 0)
+
+			dests = await asyncio.gather(*[vignette.aio.get_thumbnail(self.filename, 'normal') for _ in range(4)])
+			self.assertEqual(dests, [vignette.build_thumbnail_path(self.filename, 'normal')] * 4)
+
+		asyncio.run(run())
+
+	def test_validity_cache(self):
+		cache = vignette.VALIDITY_CACHE = vignette.ValidityCache(maxsize=1)
+		try:
+			dest = vignette.get_thumbnail(self.filename, 'large')
+			self.assertEqual((cache.hits, cache.misses), (0, 1))
+			self.assertEqual(dest, vignette.try_get_thumbnail(self.filename, 'large'))
+			self.assertEqual(dest, vignette.try_get_thumbnail(self.filename, 'large'))
+			self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+			os.utime(self.filename, (0, 0))
+			self.assertIsNone(vignette.try_get_thumbnail(self.filename, 'large'))
+
+			self.assertEqual(dest, vignette.get_thumbnail(self.filename, 'large'))
+			self.assertEqual(dest, vignette.try_get_thumbnail(self.filename, 'large'))
+			self.assertEqual(dest, vignette.try_get_thumbnail(self.filename, 'large'))
+			self.assertEqual(cache.hits, 2)
+
+			vignette.create_thumbnail(self.filename, 'large')
+			self.assertEqual(len(cache), 0)
+
+			# another store
+			self.assertEqual(dest, vignette.try_get_thumbnail(self.filename, 'large'))
+			os.environ['XDG_CACHE_HOME'] = os.path.join(self.dir, 'other')
+			self.assertIsNone(vignette.try_get_thumbnail(self.filename, 'large'))
+		finally:
+			os.environ['XDG_CACHE_HOME'] = self.dir
+			vignette.VALIDITY_CACHE = None
+
+	def test_scan_store(self):
+		from vignette import store
+
+		large = vignette.get_thumbnail(self.filename, 'large')
+		normal = vignette.get_thumbnail(self.filename, 'normal')
+		fail = vignette.put_fail(self.filename, 'foo')
+		open(os.path.join(self.dir, 'thumbnails', 'large', 'extra'), 'w').close()
+
+		for workers in (None, 2):
+			records = {r.path: r for r in store.scan_store(workers=workers)}
+			self.assertEqual(len(records), 4)
+
+			self.assertEqual(records[large].kind, 'large')
+			self.assertEqual(records[normal].kind, 'normal')
+			self.assertEqual(records[fail].kind, 'fail')
+			self.assertEqual(records[fail].appname, 'foo')
+			for path in (large, normal, fail):
+				self.assertEqual(records[path].hash, vignette.hash_name(self.filename))
+				self.assertEqual(records[path].uri, 'file://%s' % self.filename)
+				self.assertEqual(records[path].mtime, int(os.path.getmtime(self.filename)))
+				self.assertEqual(records[path].size, os.path.getsize(self.filename))
+				self.assertEqual(records[path].file_size, os.path.getsize(path))
+
+			extra = records[os.path.join(self.dir, 'thumbnails', 'large', 'extra')]
+			self.assertIsNone(extra.hash)
+			self.assertIsNone(extra.uri)
+
+	def test_collect_garbage(self):
+		from vignette import store
+
+		large = vignette.get_thumbnail(self.filename, 'large')
+		normal = vignette.get_thumbnail(self.filename, 'normal')
+		fail = vignette.put_fail(self.filename, 'foo')
+		os.utime(normal, (1000, 1000))
+		os.utime(fail, (2000, 2000))
+
+		self.assertEqual(store.collect_garbage(max_entries=3), [])
+		self.assertEqual(store.collect_garbage(max_entries=1, dry_run=True), [normal, fail])
+		assert os.path.exists(normal)
+
+		# accessed since last gc
+		os.utime(normal, (3000, 3000))
+		self.assertEqual(store.collect_garbage(max_entries=2), [fail])
+		assert not os.path.exists(fail)
+
+		budget = os.path.getsize(large)
+		self.assertEqual(store.collect_garbage(max_size=budget), [normal])
+		self.assertEqual(sorted(r.path for r in store.scan_store()), [large])
+
+		self.assertEqual(store.parse_size('2G'), 2 * 1024 ** 3)
+		self.assertEqual(store.parse_size('1.5k'), 1536)
+		self.assertEqual(store.parse_size('42'), 42)
+
+	def test_create_sizes(self):
+		dests = vignette.create_thumbnail_sizes(self.filename)
+		self.assertEqual(dests, {
+			'large': vignette.build_thumbnail_path(self.filename, 'large'),
+			'normal': vignette.build_thumbnail_path(self.filename, 'normal'),
+		})
+		self.assertEqual(dests['large'], vignette.try_get_thumbnail(self.filename, 'large'))
+		self.assertEqual(dests['normal'], vignette.try_get_thumbnail(self.filename, 'normal'))
+
+		try:
+			from PIL import Image
+		except ImportError:
+			return
+		with Image.open(dests['large']) as img:
+			self.assertEqual(max(img.size), 256)
+		with Image.open(dests['normal']) as img:
+			self.assertEqual(max(img.size), 128)
+
+		empty = os.path.join(self.dir, 'empty')
+		open(empty, 'w').close()
+		self.assertEqual(
+			vignette.create_thumbnail_sizes(empty, ['normal'], use_fail_appname='foo'),
+			{'normal': None}
+		)
+		assert vignette.is_thumbnail_failed(empty, 'foo')
+		self.assertEqual(os.listdir(os.path.join(self.dir, 'thumbnails', 'normal')), [os.path.basename(dests['normal'])])
+
+	def test_pil_fast(self):
+		try:
+			from PIL import Image
+		except ImportError:
+			return
+
+		src = os.path.join(self.dir, 'big.jpg')
+		Image.new('RGB', (2000, 1000), (255, 0, 0)).save(src)
+
+		for fast in (True, False):
+			dest = os.path.join(self.dir, 'out.png')
+			vignette.PilBackend(fast=fast).create_thumbnail(src, dest, 256)
+			with Image.open(dest) as img:
+				self.assertEqual(img.size, (256, 128))
+				r, g, b = img.convert('RGB').getpixel((128, 64))
+			assert r > 240 and g < 16 and b < 16
+
+		# JPEG is drafted by Pillow only, once
+		backend = vignette.PilBackend()
+		backend.is_available()
+		with Image.open(src) as img:
+			backend._reduce_decoding(img, 256)
+			self.assertEqual(img.size, (2000, 1000))
+			backend._thumbnail(img, 256)
+			self.assertEqual(img.size, (256, 128))
+
+	def test_exif_preview(self):
+		try:
+			from PIL import Image
+		except ImportError:
+			return
+
+		import io
+
+		preview = io.BytesIO()
+		Image.new('RGB', (400, 300), (0, 255, 0)).save(preview, 'JPEG')
+		preview = preview.getvalue()
+
+		# IFD0 with orientation 6 (rotated 90° clockwise), IFD1 pointing to the preview
+		exif = b'II*\x00' + struct.pack('<I', 8)
+		exif += struct.pack('<HHHIHHI', 1, 0x112, 3, 1, 6, 0, 26)
+		exif += struct.pack('<HHHIIHHIII', 2, 0x201, 4, 1, 56, 0x202, 4, 1, len(preview), 0)
+		exif += preview
+
+		src = os.path.join(self.dir, 'photo.jpg')
+		Image.new('RGB', (1600, 1200), (255, 0, 0)).save(src, exif=b'Exif\x00\x00' + exif)
+
+		with open(src, 'rb') as fd:
+			previews, orientation, size = vignette.find_embedded_previews(fd)
+		self.assertEqual([p[:2] for p in previews], [(400, 300)])
+		self.assertEqual(orientation, 6)
+		self.assertEqual(size, (1600, 1200))
+
+		dest = os.path.join(self.dir, 'out.png')
+		backend = vignette.ExifPreviewBackend()
+		assert backend.create_thumbnail(src, dest, 256)
+		img = Image.open(dest).convert('RGB')
+		self.assertEqual(img.size, (192, 256))
+		r, g, b = img.getpixel((96, 128))
+		assert g > 240 and r < 16
+
+		# too small for this size
+		self.assertIsNone(backend.create_thumbnail(src, dest, 512))
+
+		# PIL backend orients thumbnails too
+		vignette.PilBackend().create_thumbnail(src, dest, 256)
+		with Image.open(dest) as img:
+			self.assertEqual(img.size, (192, 256))
+
+		# not a photo
+		self.assertIsNone(backend.create_thumbnail(self.filename, dest, 128))
+
+	def test_batch(self):
+		empty = os.path.join(self.dir, 'empty')
+		open(empty, 'w').close()
+
+		results = dict(vignette.get_thumbnails([self.filename, empty], 'large', workers=2))
+		self.assertEqual(set(results), {self.filename, empty})
+		self.assertIsNone(results[empty])
+		self.assertEqual(results[self.filename], vignette.try_get_thumbnail(self.filename, 'large'))
+
+		results = list(vignette.create_thumbnails(iter([self.filename]), 'normal', workers=1))
+		self.assertEqual(results, [(self.filename, vignette.build_thumbnail_path(self.filename, 'normal'))])
+
+		# an error for one file doesn't stop the others
+		class Raising(vignette.PilBackend):
+			def create_thumbnail(self, src, dest, size, moreinfo=None):
+				if src == broken:
+					raise ValueError(src)
+				return super(Raising, self).create_thumbnail(src, dest, size, moreinfo)
+
+		broken = os.path.join(self.dir, 'broken.png')
+		shutil.copyfile(self.filename, broken)
+		vignette.THUMBNAILER_BACKENDS = [Raising()]
+		for threads in (False, True):
+			results = dict(vignette.create_thumbnails([broken, self.filename], 'large', workers=1, threads=threads))
+			self.assertEqual(set(results), {broken, self.filename})
+			self.assertIsNone(results[broken])
+			if vignette.PilBackend().is_available():
+				assert results[self.filename]
+
+	def test_batch_threads(self):
+		srcs = [os.path.join(self.dir, 'f%d.png' % n) for n in range(8)]
+		for src in srcs:
+			shutil.copyfile(self.filename, src)
+
+		results = dict(vignette.get_thumbnails(srcs, 'large', workers=4, threads=True))
+		self.assertEqual(results, dict((src, vignette.try_get_thumbnail(src, 'large')) for src in srcs))
+		assert all(results.values())
+		results = dict(vignette.create_thumbnails(srcs, 'normal', workers=4, threads=True))
+		self.assertEqual(results, dict((src, vignette.try_get_thumbnail(src, 'normal')) for src in srcs))
+		# no leftover temporary file
+		self.assertEqual(len(os.listdir(os.path.join(self.dir, 'thumbnails', 'large'))), 8)
+
+		builds = []
+		barrier = threading.Barrier(4)
+
+		def factory():
+			builds.append(1)
+			return [1, 2]
+
+		backends = vignette.LazyBackendList(factory)
+
+		def use():
+			barrier.wait()
+			self.assertEqual(list(backends), [1, 2])
+
+		threads = [threading.Thread(target=use) for _ in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(builds, [1])
+
 
 class MultiBackendsLoader(unittest.TestLoader):
 	def loadTestsFromTestCase(self, testCaseClass):
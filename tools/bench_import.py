@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""Measure the startup cost of vignette for apps that only query the store
+
+Each run is done in a fresh interpreter: it imports vignette, computes a thumbnail path,
+and reports whether thumbnailer backends were discovered along the way (they should not).
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+SNIPPET = '''
+import json, time
+start = time.perf_counter()
+import vignette
+imported = time.perf_counter()
+vignette.build_thumbnail_path('/tmp/foo.jpg', 'large')
+vignette.hash_name('/tmp/foo.jpg')
+done = time.perf_counter()
+print(json.dumps({
+	'import': imported - start,
+	'query': done - imported,
+	'backends_loaded': vignette.ALL_THUMBNAILER_BACKENDS.loaded,
+}))
+'''
+
+
+def median(values):
+	values = sorted(values)
+	return values[len(values) // 2]
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('-n', '--runs', type=int, default=20)
+	args = parser.parse_args()
+
+	env = dict(os.environ)
+	env['PYTHONPATH'] = os.pathsep.join(
+		[os.path.join(os.path.dirname(__file__), '..')] + env.get('PYTHONPATH', '').split(os.pathsep)
+	)
+
+	results = []
+	for _ in range(args.runs):
+		out = subprocess.check_output([sys.executable, '-c', SNIPPET], env=env)
+		results.append(json.loads(out.decode('utf-8')))
+
+	print(json.dumps({
+		'runs': args.runs,
+		'import_median_ms': median([r['import'] for r in results]) * 1000,
+		'import_min_ms': min(r['import'] for r in results) * 1000,
+		'query_median_ms': median([r['query'] for r in results]) * 1000,
+		'backends_loaded': any(r['backends_loaded'] for r in results),
+	}, indent=2))
+
+
+if __name__ == '__main__':
+	main()
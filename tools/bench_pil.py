@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""Compare the "fast" and "quality" modes of the PIL backend to a plain Image.thumbnail call
+
+A big JPEG and a big JPEG 2000 image are generated, then thumbnailed repeatedly in a fresh
+interpreter for each mode, reporting the latency per image and the peak memory (RSS) of the
+process. The "baseline" mode is the call PilBackend used to make: open, Image.thumbnail with
+the default reducing gap, save.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+
+SNIPPET = '''
+import json, resource, sys, time
+import vignette
+
+src, dest, runs, mode = sys.argv[1], sys.argv[2], int(sys.argv[3]), sys.argv[4]
+backend = vignette.PilBackend(fast=mode == 'fast')
+assert backend.is_available()
+
+def baseline(src, dest, size):
+	img = backend.mod.open(src)
+	img.thumbnail((size, size), backend.resample)
+	img.save(dest)
+	img.close()
+
+if mode == 'baseline':
+	func = baseline
+else:
+	func = backend.create_thumbnail
+
+times = []
+for _ in range(runs):
+	start = time.perf_counter()
+	func(src, dest, 256)
+	times.append(time.perf_counter() - start)
+
+times.sort()
+print(json.dumps({
+	'median_ms': times[len(times) // 2] * 1000,
+	'min_ms': times[0] * 1000,
+	# kilobytes on Linux
+	'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+}))
+'''
+
+
+BUILD_SNIPPET = '''
+import sys
+from PIL import Image, ImageDraw
+
+path, width, height = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+img = Image.new('RGB', (width, height))
+draw = ImageDraw.Draw(img)
+for x in range(0, width, 64):
+	draw.line([(x, 0), (width - x, height)], fill=(x % 256, 128, 255 - x % 256), width=8)
+if path.endswith('.jp2'):
+	img.save(path, num_resolutions=6)
+else:
+	img.save(path, quality=90)
+'''
+
+
+MODES = ('baseline', 'fast', 'quality')
+
+
+def build_source(path, width, height):
+	# in another process: on Linux, the peak RSS of a process is inherited by its children
+	subprocess.check_call([sys.executable, '-c', BUILD_SNIPPET, path, str(width), str(height)])
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('-n', '--runs', type=int, default=5)
+	parser.add_argument('--width', type=int, default=6000)
+	parser.add_argument('--height', type=int, default=4000)
+	parser.add_argument(
+		'--format', action='append', choices=('jpg', 'jp2'), dest='formats',
+		help='format of the source image, can be repeated (default: all)'
+	)
+	args = parser.parse_args()
+
+	env = dict(os.environ)
+	env['PYTHONPATH'] = os.pathsep.join(
+		[os.path.join(os.path.dirname(__file__), '..')] + env.get('PYTHONPATH', '').split(os.pathsep)
+	)
+
+	tmpdir = tempfile.mkdtemp()
+	dest = os.path.join(tmpdir, 'thumb.png')
+	results = {}
+	for fmt in args.formats or ('jpg', 'jp2'):
+		src = os.path.join(tmpdir, 'source.%s' % fmt)
+		try:
+			build_source(src, args.width, args.height)
+		except subprocess.CalledProcessError:
+			# Pillow built without this codec
+			results[fmt] = None
+			continue
+
+		results[fmt] = {'source': '%dx%d' % (args.width, args.height)}
+		for mode in MODES:
+			out = subprocess.check_output(
+				[sys.executable, '-c', SNIPPET, src, dest, str(args.runs), mode], env=env
+			)
+			results[fmt][mode] = json.loads(out.decode('utf-8'))
+		os.remove(src)
+
+	if os.path.exists(dest):
+		os.remove(dest)
+	os.rmdir(tmpdir)
+
+	print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+	main()
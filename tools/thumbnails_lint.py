@@ -3,71 +3,66 @@
 """Tool to clean obsolete thumbnails in ~/.cache/thumbnails
 """
 
-import re
 import os
 from urllib.request import url2pathname
 from urllib.parse import urlparse
 
-import vignette
+from vignette import store
 
 
 DELETE_EXTRA = True
+WORKERS = 8
 COUNT = 0
 SIZE = 0
 
-def remove(t):
+def remove(record):
 	global COUNT, SIZE
 
 	COUNT += 1
-	SIZE += os.path.getsize(t)
-	os.unlink(t)
+	SIZE += record.file_size
+	os.unlink(record.path)
 
 
-def do_dir(d):
-	global COUNT
+def check(record):
+	if not record.hash:
+		if DELETE_EXTRA:
+			print('Extra file %r' % record.path)
+			remove(record)
+		return
 
-	fn_template = re.compile('%s/[0-9a-fA-F]{32}.png$' % re.escape(d))
+	if record.uri is None or record.mtime is None:
+		print('Error parsing thumbnail %r' % record.path)
+		remove(record)
+		return
 
-	for f in os.listdir(d):
-		f = os.path.join(d, f)
+	if not record.uri:
+		print('Invalid URI in thumbnail %r' % record.path)
+		remove(record)
+		return
 
-		if not fn_template.match(f):
-			if DELETE_EXTRA:
-				print('Extra file %r' % f)
-				remove(f)
-			continue
+	uri_info = urlparse(record.uri)
+	if uri_info.scheme != 'file':
+		return
 
-		info = vignette.thumbnail_info(f)
-		if not info:
-			print('Error parsing thumbnail %r' % f)
-			remove(f)
-			continue
+	target = url2pathname(uri_info.path)
 
-		if not info.get('uri'):
-			print('Invalid URI in thumbnail %r' % f)
-			remove(f)
-			continue
+	try:
+		mtime = int(os.path.getmtime(target))
+	except OSError:
+		mtime = None
 
-		uri_info = urlparse(info['uri'])
-		if uri_info.scheme != 'file':
-			continue
+	if mtime is None or not os.path.isfile(target):
+		print('Missing file %r' % target)
+		remove(record)
+		return
 
-		target = url2pathname(uri_info.path)
-
-		if not os.path.isfile(target):
-			print('Missing file %r' % target)
-			remove(f)
-			continue
-
-		if int(os.path.getmtime(target)) != info['mtime']:
-			print('Different mtime of %r' % target)
-			remove(f)
-			continue
+	if mtime != record.mtime:
+		print('Different mtime of %r' % target)
+		remove(record)
+		return
 
 
 if __name__ == '__main__':
-	for d in ('large', 'normal'):
-		d = os.path.join(vignette._thumb_path_prefix(), d)
-		if os.path.isdir(d):
-			do_dir(d)
+	for record in store.scan_store(kinds=('large', 'normal'), workers=WORKERS):
+		check(record)
 	print('Removed %d files (%d bytes)' % (COUNT, SIZE))
@@ -66,6 +66,8 @@ They do not generate thumbnails or "fail-files", and can be used with files or U
 refer to non-images:
 
 * :any:`try_get_thumbnail`
+* :any:`lookup_directory`
+* :any:`list_store`
 * :any:`build_thumbnail_path`
 * :any:`is_thumbnail_failed`
 
@@ -85,6 +87,13 @@ because the file is corrupt), they may create a fail-file.
 
 * :any:`get_thumbnail`
 * :any:`create_thumbnail`
+* :any:`create_thumbnail_sizes`
+
+Batch versions of these functions are available, generating thumbnails in parallel, in
+several processes:
+
+* :any:`get_thumbnails`
+* :any:`create_thumbnails`
 
 Storing
 -------
@@ -118,6 +127,14 @@ the thumbnail is considered obsolete and simply ignored.
 Many functions of `vignette` take a ``mtime`` argument that is optional if the ``src`` argument
 refers to a local file, but mandatory if it is an URL.
 
+Source keys
+-----------
+
+The URI of a source, its hash and the paths of its thumbnails are computed by most functions.
+Applications looking up the same sources repeatedly can compute them once with
+:any:`thumbnail_key`, and pass the resulting :any:`ThumbnailKey` as ``src`` argument to any
+function. Recently used keys are memoized anyway, for absolute paths and URLs.
+
 Examples
 ========
 
@@ -159,30 +176,37 @@ Module contents
 
 from __future__ import unicode_literals
 
-from glob import glob
+from collections import OrderedDict
 import hashlib
-import mimetypes
 import os
 import re
-import shlex
-import shutil
-import subprocess
+import struct
 import sys
-import tempfile
+import threading
+import zlib
+
+# some modules are imported lazily, when needed, to keep "import vignette" fast
 
 if sys.version_info.major > 2:
-	from urllib.request import pathname2url
-	from configparser import RawConfigParser
+	from collections.abc import MutableSequence
 else:
-	from urllib import pathname2url
-	from ConfigParser import RawConfigParser
+	from collections import MutableSequence
 
 
 __all__ = (
 	'get_thumbnail',
+	'get_thumbnails',
 	'try_get_thumbnail',
+	'lookup_directory',
+	'list_store',
 	'build_thumbnail_path',
+	'thumbnail_key',
+	'ThumbnailKey',
 	'create_thumbnail',
+	'create_thumbnails',
+	'create_thumbnail_sizes',
+	'create_thumbnail_bytes',
+	'get_thumbnail_image',
 	'put_thumbnail',
 	'put_fail',
 	'is_thumbnail_failed',
@@ -245,6 +269,37 @@ VERSION = '4.5.2'  # $version
 __version__ = VERSION
 
 
+STATS = None
+
+"""If not None, a :any:`vignette.stats.Stats` recording the time spent in each stage of
+lookup and generation, and counting hits, misses and failures."""
+
+
+class _NoTimer(object):
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+def _stage(stage, backend=None):
+	# context manager timing a stage in STATS, if enabled
+	stats = STATS
+	if stats is None:
+		return _NO_TIMER
+	return stats.timer(stage, backend)
+
+
+def _count(event, backend=None):
+	stats = STATS
+	if stats is not None:
+		stats.count(event, backend)
+
+
 def _any2size(size):
 	if size in ('normal', 128, '128'):
 		return (128, 'normal')
@@ -261,19 +316,35 @@ def _any2size(size):
 URI_RE = re.compile(r'[a-z][a-z0-9.+-]*:', re.I)
 
 
+def _pathname2url(path):
+	if sys.version_info.major == 2:
+		from urllib import pathname2url
+	elif os.name == 'nt':
+		from urllib.request import pathname2url
+	else:
+		# what urllib.request.pathname2url does on POSIX, without its import cost
+		from urllib.parse import quote as pathname2url
+
+	return pathname2url(path)
+
+
 def _any2uri(sth):
 	"""Get an URI from the parameter
 
 	If it's already an URI, return it, else return a file:// URL of it
 	"""
 
-	if URI_RE.match(sth):
+	if isinstance(sth, ThumbnailKey):
+		return sth.uri
+	elif URI_RE.match(sth):
 		return sth
 	else:
-		return 'file://' + pathname2url(os.path.abspath(sth))
+		return 'file://' + _pathname2url(os.path.abspath(sth))
 
 
 def _any2mtime(origname, mtime=None):
+	if isinstance(origname, ThumbnailKey):
+		origname = origname.src
 	if mtime is None:
 		return int(os.path.getmtime(origname))
 	else:
@@ -293,6 +364,7 @@ def _info_dict(d, mtime=None, filesize=None, src=None):
 
 	if src is not None:
 		d.setdefault(KEY_URI, _any2uri(src))
+		src = _source_path(src)
 
 		try:
 			if KEY_MTIME not in d:
@@ -305,13 +377,191 @@ def _info_dict(d, mtime=None, filesize=None, src=None):
 	return d
 
 
+def _merge_info(res, moreinfo):
+	# metadata given by the caller takes precedence over what a backend found
+	d = _info_dict(res)
+	d.update(moreinfo or {})
+	return d
+
+
 def _mkstemp(dest):
+	import tempfile
+
 	fd, path = tempfile.mkstemp(suffix='.png', dir=os.path.dirname(dest))
 	os.close(fd)
 	os.chmod(path, 0o600)
 	return path
 
 
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def _parse_png_text(ctype, data):
+	if ctype == b'tEXt':
+		key, text = data.split(b'\0', 1)
+		return key, text.decode('latin-1')
+	elif ctype == b'zTXt':
+		key, text = data.split(b'\0', 1)
+		return key, zlib.decompress(text[1:]).decode('latin-1')
+	else:
+		key, text = data.split(b'\0', 1)
+		compressed = text[0:1] == b'\x01'
+		_, _, text = text[2:].split(b'\0', 2)
+		if compressed:
+			text = zlib.decompress(text)
+		return key, text.decode('utf-8')
+
+
+def read_png_text(path, keys=None):
+	"""Read the text metadata of a PNG file without decoding the image.
+
+	Only the chunk headers are read, and the text chunks (``tEXt``, ``zTXt`` and ``iTXt``).
+	The image data is skipped over. If `keys` is given, reading stops at the image data
+	as soon as all `keys` have been found.
+
+	:param path: path of the PNG file
+	:type path: str
+	:param keys: metadata keys that are needed
+	:returns: a dict of the text metadata, or None if the file is not a readable PNG
+	:rtype: dict
+	"""
+
+	missing = set(keys or ())
+	res = {}
+
+	try:
+		with open(path, 'rb') as fd:
+			if fd.read(8) != PNG_SIGNATURE:
+				return None
+
+			while True:
+				header = fd.read(8)
+				if len(header) < 8:
+					return None
+				length, ctype = struct.unpack('>I4s', header)
+
+				if ctype in (b'tEXt', b'zTXt', b'iTXt'):
+					key, text = _parse_png_text(ctype, fd.read(length))
+					key = key.decode('latin-1')
+					res[key] = text
+					missing.discard(key)
+					fd.seek(4, os.SEEK_CUR)
+				elif ctype == b'IEND':
+					break
+				elif ctype == b'IDAT' and keys and not missing:
+					break
+				else:
+					fd.seek(length + 4, os.SEEK_CUR)
+	except (IOError, OSError, ValueError, UnicodeDecodeError, zlib.error):
+		return None
+
+	return res
+
+
+def _png_chunk(ctype, data):
+	crc = zlib.crc32(ctype + data) & 0xffffffff
+	return struct.pack('>I4s', len(data), ctype) + data + struct.pack('>I', crc)
+
+
+def _png_text_chunk(key, text):
+	key = key.encode('latin-1')
+	try:
+		return _png_chunk(b'tEXt', key + b'\0' + text.encode('latin-1'))
+	except UnicodeEncodeError:
+		# uncompressed, no language tag nor translated keyword
+		return _png_chunk(b'iTXt', key + b'\0' * 5 + text.encode('utf-8'))
+
+
+def write_png_text(path, dest, moreinfo):
+	"""Copy a PNG file, adding text metadata, without decoding the image.
+
+	The chunks of `path` are copied as-is to `dest`, except text chunks for keys of
+	`moreinfo`, which are replaced by new text chunks.
+
+	:param path: path of the input PNG file
+	:type path: str
+	:param dest: path of the output file
+	:type dest: str
+	:param moreinfo: key/values to store in the output file
+	:type moreinfo: dict
+	:returns: True if successful, False if `path` is not a readable PNG file
+	:rtype: bool
+	"""
+
+	keys = set(k.encode('latin-1') for k in moreinfo)
+
+	try:
+		with open(path, 'rb') as fin, open(dest, 'wb') as fout:
+			if fin.read(8) != PNG_SIGNATURE:
+				return False
+			fout.write(PNG_SIGNATURE)
+
+			while True:
+				header = fin.read(8)
+				if len(header) < 8:
+					return False
+				length, ctype = struct.unpack('>I4s', header)
+				data = fin.read(length + 4)
+				if len(data) < length + 4:
+					return False
+
+				if ctype in (b'tEXt', b'zTXt', b'iTXt') and data.split(b'\0', 1)[0] in keys:
+					continue
+
+				fout.write(header)
+				fout.write(data)
+
+				if ctype == b'IHDR':
+					for k in sorted(moreinfo):
+						fout.write(_png_text_chunk(k, str(moreinfo[k])))
+				elif ctype == b'IEND':
+					return True
+	except (IOError, OSError, struct.error):
+		return False
+
+
+def _update_metadata(path, moreinfo):
+	# returns the path of the updated file, which may be different from path
+	with _stage('update_metadata'):
+		return _write_metadata(path, moreinfo)
+
+
+def _write_metadata(path, moreinfo):
+	tmp = _mkstemp(path)
+	if write_png_text(path, tmp, moreinfo):
+		os.remove(path)
+		return tmp
+	os.remove(tmp)
+
+	# not a PNG? let a full-fledged image library convert it
+	backend = get_metadata_backend()
+	if backend is not None:
+		return backend.update_metadata(path, moreinfo)
+
+
+def _get_info(path):
+	with _stage('get_info'):
+		return _read_info(path)
+
+
+def _read_info(path):
+	text = read_png_text(path, (KEY_URI, KEY_MTIME))
+	if text is None:
+		# not a PNG? let a full-fledged image library try
+		backend = get_metadata_backend()
+		if backend is None:
+			return
+		return backend.get_info(path)
+
+	try:
+		return {
+			'mtime': int(float(text[KEY_MTIME])),
+			'uri': text[KEY_URI],
+		}
+	except (KeyError, ValueError):
+		return
+
+
 def create_temp(size):
 	"""Create a temporary file in the thumbnail cache directory.
 
@@ -330,11 +580,21 @@ def create_temp(size):
 	"""
 	size = _any2size(size)[1]
 	dir = os.path.join(_thumb_path_prefix(), size)
-	if not os.path.isdir(dir):
-		os.makedirs(dir, 0o700)
+	_makedir(dir)
 	return _mkstemp(os.path.join(dir, 'ignored'))
 
 
+def _makedir(path):
+	# another process may create it concurrently
+	if os.path.isdir(path):
+		return
+	try:
+		os.makedirs(path, 0o700)
+	except OSError:
+		if not os.path.isdir(path):
+			raise
+
+
 def makedirs():
 	"""Create cache directories."""
 
@@ -342,23 +602,134 @@ def makedirs():
 	for child in ['normal', 'large', 'fail']:
 		path = os.path.join(root, child)
 		if not os.path.isdir(path):
-			os.makedirs(path, 0o700)
+			_makedir(path)
 		else:
 			os.chmod(path, 0o700)
 
 
+_prefix_cache = None
+
+
 def _thumb_path_prefix():
+	global _prefix_cache
+
+	# only recomputed when the environment changes
+	env = (os.environ.get('XDG_CACHE_HOME'), os.environ.get('HOME'))
+	cached = _prefix_cache
+	if cached is not None and cached[0] == env:
+		return cached[1]
+
 	xdgcache = os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
 	xdgcache = os.path.normpath(xdgcache)
-	return os.path.join(xdgcache, 'thumbnails')
+	prefix = os.path.join(xdgcache, 'thumbnails')
+	_prefix_cache = (env, prefix)
+	return prefix
 
 
 def hash_name(src):
-	uri = _any2uri(src)
-	if isinstance(uri, str):
-		uri = uri.encode('utf-8')
+	return thumbnail_key(src).md5
+
+
+class ThumbnailKey(object):
+	"""Identity of a source file in the thumbnail store, computed once.
+
+	Finding the thumbnails of a file requires its URI, the MD5 hash of the URI and the
+	location of the store. A ThumbnailKey computes them once, and can be passed instead of
+	`src` to the functions of this module, so repeated lookups for the same file do not
+	compute them again. See :any:`thumbnail_key` to get memoized keys.
+
+	The location of the store is taken from the environment when the key is created.
+
+	:param src: path or URI of the source file
+	:ivar src: path or URI of the source file, as given
+	:ivar uri: URI of the source file
+	:ivar md5: MD5 hash of the URI, used for naming thumbnails
+	"""
+
+	__slots__ = ('src', 'uri', 'md5', 'prefix', '_paths')
+
+	def __init__(self, src):
+		self.src = src
+		self.uri = _any2uri(src)
+
+		uri = self.uri
+		if isinstance(uri, str):
+			uri = uri.encode('utf-8')
+		self.md5 = hashlib.md5(uri).hexdigest()
+
+		self.prefix = _thumb_path_prefix()
+		self._paths = {}
+
+	def __repr__(self):
+		return '<%s %r>' % (type(self).__name__, self.src)
+
+	def thumbnail_path(self, size):
+		"""Get the path of the potential thumbnail, see :any:`build_thumbnail_path`."""
+		sizename = _any2size(size)[1]
+		try:
+			return self._paths[sizename]
+		except KeyError:
+			pass
+
+		prefix = os.path.join(self.prefix, sizename)
+		if self.src.startswith(prefix + '/'):
+			path = self.src
+		else:
+			path = os.path.join(prefix, '%s.png' % self.md5)
+		self._paths[sizename] = path
+		return path
 
-	return hashlib.md5(uri).hexdigest()
+	def fail_path(self, appname):
+		"""Get the path of the potential fail-file written by `appname`."""
+		return os.path.join(self.prefix, 'fail', appname, '%s.png' % self.md5)
+
+
+KEYS_CACHE_SIZE = 4096
+
+"""Number of keys remembered by :any:`thumbnail_key`."""
+
+_keys = OrderedDict()
+_keys_lock = threading.Lock()
+
+
+def thumbnail_key(src):
+	"""Get a :any:`ThumbnailKey` for `src`, reusing a recently computed one.
+
+	:param src: path or URI of the source file, or a ThumbnailKey, which is returned as is
+	:rtype: ThumbnailKey
+	"""
+
+	if isinstance(src, ThumbnailKey):
+		return src
+	elif not (os.path.isabs(src) or URI_RE.match(src)):
+		# relative to the current directory, which can change
+		return _new_key(src)
+
+	prefix = _thumb_path_prefix()
+	with _keys_lock:
+		key = _keys.pop(src, None)
+		if key is not None and key.prefix == prefix:
+			_keys[src] = key
+			return key
+
+	key = _new_key(src)
+	with _keys_lock:
+		_keys[src] = key
+		while len(_keys) > KEYS_CACHE_SIZE:
+			_keys.popitem(last=False)
+	return key
+
+
+def _new_key(src):
+	with _stage('key'):
+		return ThumbnailKey(src)
+
+
+def _source_path(src):
+	# what backends open
+	if isinstance(src, ThumbnailKey):
+		return src.src
+	return src
 
 
 def is_thumbnail_failed(src, appname, mtime=None):
@@ -382,13 +753,10 @@ def is_thumbnail_failed(src, appname, mtime=None):
 	:rtype: bool
 	"""
 
-	prefix = _thumb_path_prefix()
-	apppath = os.path.join(prefix, 'fail', appname)
-	uri = _any2uri(src)
-	mtime = _any2mtime(src, mtime)
-	md5uri = hash_name(src)
-	thumb = os.path.join(apppath, '%s.png' % md5uri)
-	return os.path.exists(thumb) and is_thumbnail_valid(thumb, uri, mtime)
+	key = thumbnail_key(src)
+	mtime = _any2mtime(key.src, mtime)
+	thumb = key.fail_path(appname)
+	return os.path.exists(thumb) and _check_thumbnail(thumb, key.uri, mtime)
 
 
 def put_thumbnail(src, size, thumb, mtime=None, moreinfo=None):
@@ -415,7 +783,8 @@ def put_thumbnail(src, size, thumb, mtime=None, moreinfo=None):
 	:rtype: str
 	"""
 
-	dest = build_thumbnail_path(src, size)
+	src = thumbnail_key(src)
+	dest = src.thumbnail_path(size)
 
 	if dest == thumb:
 		# thumb in final place, use a temp file anyway
@@ -426,15 +795,30 @@ def put_thumbnail(src, size, thumb, mtime=None, moreinfo=None):
 		tmp = thumb
 	else:
 		# thumb in any other dir
+		import shutil
+
 		tmp = _mkstemp(dest)
 		shutil.move(thumb, tmp)
 
 	moreinfo = _info_dict(moreinfo, mtime=mtime, src=src)
-	if not get_metadata_backend().update_metadata(tmp, moreinfo):
+	tmp = _update_metadata(tmp, moreinfo)
+	if not tmp:
 		return
 
-	os.chmod(tmp, 0o600)
-	os.rename(tmp, dest)
+	return _install_thumbnail(src, size, tmp, dest, moreinfo)
+
+
+def _install_thumbnail(src, size, tmp, dest=None, info=None):
+	if dest is None:
+		dest = thumbnail_key(src).thumbnail_path(size)
+
+	with _stage('install'):
+		os.chmod(tmp, 0o600)
+		os.rename(tmp, dest)
+
+	if VALIDITY_CACHE is not None:
+		VALIDITY_CACHE.invalidate(_any2uri(src), size)
+	_index_thumbnail(dest, info)
 
 	return dest
 
@@ -458,15 +842,14 @@ def put_fail(src, appname, mtime=None, moreinfo=None):
 	:rtype: str
 	"""
 
-	prefix = os.path.join(_thumb_path_prefix(), 'fail', appname)
-	if not os.path.isdir(prefix):
-		os.makedirs(prefix, 0o700)
-
-	md5uri = hash_name(src)
-	dest = os.path.join(prefix, '%s.png' % md5uri)
+	src = thumbnail_key(src)
+	dest = src.fail_path(appname)
+	_makedir(os.path.dirname(dest))
 
 	moreinfo = _info_dict(moreinfo, mtime=mtime, src=src)
-	return get_metadata_backend().create_fail(dest, moreinfo)
+	dest = get_metadata_backend().create_fail(dest, moreinfo)
+	_index_thumbnail(dest, moreinfo)
+	return dest
 
 
 class MetadataBackend(object):
@@ -489,14 +872,25 @@ FILETYPE_DOCUMENT = 'document'
 FILETYPE_MISC = 'misc'
 
 
+def _sniff_mime(path):
+	with _stage('sniff'):
+		return ThumbnailBackend.guess_magic(path) or ThumbnailBackend.guess_mime(path)
+
+
 class ThumbnailBackend(object):
 	accepted_mimes = re.compile(r'$^')  # will never match
 
+	# if True, create_thumbnail() takes a 4th argument: the metadata dict to write in the
+	# thumbnail, so the thumbnail is written once, in its final form
+	embeds_metadata = False
+
 	def is_available(self):
 		return False
 
 	@staticmethod
 	def guess_mime(path):
+		import mimetypes
+
 		return mimetypes.guess_type(path)[0]
 
 	@staticmethod
@@ -520,7 +914,9 @@ class ThumbnailBackend(object):
 				return None
 
 	def is_accepted(self, path):
-		mime = self.guess_magic(path) or self.guess_mime(path)
+		return self.accepts_mime(_sniff_mime(path))
+
+	def accepts_mime(self, mime):
 		if mime is None:
 			return False
 		return bool(self.accepted_mimes.match(mime))
@@ -528,10 +924,36 @@ class ThumbnailBackend(object):
 	def create_thumbnail(self, src, dest, size):
 		raise NotImplementedError()
 
+	def create_thumbnail_sizes(self, src, targets, moreinfo=None):
+		"""Create thumbnails of several sizes for `src`.
+
+		Backends able to decode `src` once for all sizes should override this method. By
+		default, :any:`create_thumbnail` is called for each size.
+
+		:param targets: list of ``(dest, size)`` tuples, largest size first
+		:param moreinfo: metadata to write, if :any:`embeds_metadata` is True
+		:returns: a list with the result of each target, as :any:`create_thumbnail` returns
+		"""
+		return [_thumbnail_with(self, src, dest, size, moreinfo) for dest, size in targets]
+
 
 class PilBackend(MetadataBackend, ThumbnailBackend):
+	"""Backend using the Python Imaging Library.
+
+	:param fast: if True (the default), images are decoded at a reduced resolution when
+	             possible, about twice the thumbnail size: JPEG with DCT scaling (done by
+	             Pillow itself), and JPEG 2000 by decoding a lower resolution level, which is
+	             much faster and uses much less memory for big images. If False, the full
+	             image is decoded and resampled, for best quality, which is many times slower
+	             for big images.
+	"""
+
 	handled_types = frozenset([FILETYPE_IMAGE])
 	accepted_mimes = re.compile('^image/')
+	embeds_metadata = True
+
+	def __init__(self, fast=True):
+		self.fast = fast
 
 	@classmethod
 	def is_available(cls):
@@ -543,8 +965,35 @@ class PilBackend(MetadataBackend, ThumbnailBackend):
 
 		cls.mod = PIL.Image
 		cls.png = PIL.PngImagePlugin
+		# ANTIALIAS was removed in Pillow 10
+		cls.resample = getattr(PIL.Image, 'LANCZOS', None) or PIL.Image.ANTIALIAS
 		return True
 
+	@staticmethod
+	def _reduce_decoding(img, size):
+		# JPEG is drafted by Image.thumbnail, JPEG 2000 isn't
+		if img.format != 'JPEG2000' or not isinstance(getattr(type(img), 'reduce', None), property):
+			return
+
+		# decode a lower resolution level, at least twice the thumbnail size, for quality of
+		# the final resampling
+		factor = 0
+		while min(img.size) >> (factor + 1) >= size * 2:
+			factor += 1
+		if factor:
+			img.reduce = factor
+
+	def _thumbnail(self, img, size):
+		if self.fast:
+			img.thumbnail((size, size), self.resample)
+			return
+
+		try:
+			img.thumbnail((size, size), self.resample, reducing_gap=None)
+		except TypeError:
+			# Pillow < 7.0 always drafts
+			img.thumbnail((size, size), self.resample)
+
 	def _pnginfo(self, moreinfo=None):
 		outinfo = self.png.PngInfo()
 
@@ -554,23 +1003,91 @@ class PilBackend(MetadataBackend, ThumbnailBackend):
 
 		return outinfo
 
-	def create_thumbnail(self, src, dest, size):
+	def create_thumbnail(self, src, dest, size, moreinfo=None):
+		return self.create_thumbnail_sizes(src, [(dest, size)], moreinfo)[0]
+
+	@staticmethod
+	def _get_orientation(img):
+		if not hasattr(img, 'getexif'):
+			# Pillow < 6.0
+			return 1
+
+		try:
+			return img.getexif().get(EXIF_ORIENTATION, 1)
+		except (SyntaxError, ValueError, TypeError, struct.error):
+			return 1
+
+	@staticmethod
+	def _orient(img, orientation):
+		method = _EXIF_TRANSPOSE.get(orientation)
+		if method is None:
+			return img
+		return img.transpose(method)
+
+	def _open(self, src, size):
+		"""Open `src` for a thumbnail of `size`, return the image and its EXIF orientation.
+
+		Returns ``(None, None)`` if `src` cannot be opened.
+		"""
 		try:
 			img = self.mod.open(src)
 		except IOError:
+			return None, None
+
+		if self.fast:
+			self._reduce_decoding(img, size)
+		return img, self._get_orientation(img)
+
+	def render(self, src, size):
+		"""Create a thumbnail of `src` in memory, without writing any file.
+
+		:param src: path of the source file, or a seekable binary file object
+		:param size: maximum width and height of the thumbnail, in pixels
+		:returns: the oriented thumbnail as a PIL image, or None if `src` cannot be opened
+		"""
+		img, orientation = self._open(src, size)
+		if img is None:
 			return None
 
+		self._thumbnail(img, size)
+		out = self._orient(img, orientation)
+		if out is not img:
+			img.close()
+		return out
+
+	def encode(self, img, moreinfo=None):
+		"""Get the PNG data of `img`, with `moreinfo` metadata."""
+		import io
+
+		buf = io.BytesIO()
+		img.save(buf, 'PNG', pnginfo=self._pnginfo(moreinfo))
+		return buf.getvalue()
+
+	def create_thumbnail_sizes(self, src, targets, moreinfo=None):
+		img, orientation = self._open(src, targets[0][1])
+		if img is None:
+			return [None] * len(targets)
+
 		mtime = _any2mtime(src)
+		results = []
+
+		for dest, size in targets:
+			# each smaller size is downscaled from the previous one
+			self._thumbnail(img, size)
+			# thumbnails are small, rotate them rather than the source
+			out = self._orient(img, orientation)
+
+			res = {
+				KEY_MTIME: mtime,
+				KEY_WIDTH: str(out.size[0]),
+				KEY_HEIGHT: str(out.size[1]),
+			}
 
-		img.thumbnail((size, size), self.mod.ANTIALIAS)
+			out.save(dest, 'PNG', pnginfo=self._pnginfo(_merge_info(res, moreinfo)))
+			results.append(res)
 
-		img.save(dest)
 		img.close()
-		return {
-			KEY_MTIME: mtime,
-			KEY_WIDTH: str(img.size[0]),
-			KEY_HEIGHT: str(img.size[1]),
-		}
+		return results
 
 	def create_fail(self, dest, moreinfo=None):
 		outinfo = self._pnginfo(moreinfo)
@@ -608,9 +1125,359 @@ class PilBackend(MetadataBackend, ThumbnailBackend):
 		return dest
 
 
+EXIF_ORIENTATION = 0x0112
+
+"""EXIF tag of the orientation of an image."""
+
+# EXIF orientation -> PIL transpose method (FLIP_LEFT_RIGHT=0, FLIP_TOP_BOTTOM=1, ROTATE_90=2,
+# ROTATE_180=3, ROTATE_270=4, TRANSPOSE=5, TRANSVERSE=6)
+_EXIF_TRANSPOSE = {2: 0, 3: 3, 4: 1, 5: 5, 6: 4, 7: 6, 8: 2}
+
+# TIFF magic numbers: TIFF, Olympus ORF (2 variants), Panasonic RW2
+_TIFF_MAGICS = (42, 0x4f52, 0x5352, 0x55)
+
+# type: (struct format, size) of TIFF field types we need, None format for raw bytes
+_TIFF_TYPES = {1: ('B', 1), 3: ('H', 2), 4: ('I', 4), 7: (None, 1), 13: ('I', 4)}
+
+_TIFF_WIDTH = 0x0100
+_TIFF_HEIGHT = 0x0101
+_TIFF_COMPRESSION = 0x0103
+_TIFF_STRIP_OFFSETS = 0x0111
+_TIFF_STRIP_BYTE_COUNTS = 0x0117
+_TIFF_SUB_IFDS = 0x014a
+_TIFF_JPEG_OFFSET = 0x0201
+_TIFF_JPEG_LENGTH = 0x0202
+_MPF_ENTRIES = 0xb002
+
+_TIFF_TAGS = frozenset([
+	_TIFF_WIDTH, _TIFF_HEIGHT, _TIFF_COMPRESSION, EXIF_ORIENTATION, _TIFF_STRIP_OFFSETS,
+	_TIFF_STRIP_BYTE_COUNTS, _TIFF_SUB_IFDS, _TIFF_JPEG_OFFSET, _TIFF_JPEG_LENGTH, _MPF_ENTRIES,
+])
+
+# JPEG start-of-frame markers decodable by PIL: baseline, extended and progressive
+_JPEG_DECODABLE = (0xc0, 0xc1, 0xc2)
+
+
+def _read_exact(fd, length):
+	data = fd.read(length)
+	if len(data) != length:
+		raise ValueError('truncated file')
+	return data
+
+
+def _read_tiff_header(fd, base):
+	fd.seek(base)
+	head = fd.read(8)
+	if len(head) < 8 or head[:2] not in (b'II', b'MM'):
+		return None, None
+
+	order = '<' if head[:2] == b'II' else '>'
+	magic, offset = struct.unpack(order + 'HI', head[2:])
+	if magic not in _TIFF_MAGICS:
+		return None, None
+	return order, offset
+
+
+def _read_tiff_ifd(fd, base, offset, order):
+	# returns a dict of tag -> values, and the offset of the next IFD
+	fd.seek(base + offset)
+	count, = struct.unpack(order + 'H', _read_exact(fd, 2))
+	data = _read_exact(fd, count * 12 + 4)
+
+	fields = []
+	for pos in range(0, count * 12, 12):
+		tag, ftype, nvalues, raw = struct.unpack(order + 'HHI4s', data[pos:pos + 12])
+		if tag in _TIFF_TAGS and ftype in _TIFF_TYPES:
+			fields.append((tag, ftype, nvalues, raw))
+
+	tags = {}
+	for tag, ftype, nvalues, raw in fields:
+		fmt, itemsize = _TIFF_TYPES[ftype]
+		if nvalues * itemsize > 4:
+			if nvalues * itemsize > 0x10000:
+				# strips of the main image, not a preview
+				continue
+			fd.seek(base + struct.unpack(order + 'I', raw)[0])
+			raw = _read_exact(fd, nvalues * itemsize)
+
+		if fmt is None:
+			tags[tag] = raw[:nvalues]
+		else:
+			tags[tag] = struct.unpack(order + fmt * nvalues, raw[:nvalues * itemsize])
+
+	next_offset, = struct.unpack(order + 'I', data[-4:])
+	return tags, next_offset
+
+
+def _iter_jpeg_segments(fd, start):
+	# yield (marker, offset, length) of JPEG segments until the image data
+	fd.seek(start)
+	if fd.read(2) != b'\xff\xd8':
+		return
+
+	pos = start + 2
+	while True:
+		fd.seek(pos)
+		head = fd.read(4)
+		if len(head) < 4:
+			return
+
+		prefix, marker, length = struct.unpack('>BBH', head)
+		if prefix != 0xff:
+			return
+		elif marker == 0xff:
+			# fill byte
+			pos += 1
+			continue
+		elif marker in (0xd9, 0xda):
+			# end of image, start of scan
+			return
+		elif marker == 0x01 or 0xd0 <= marker <= 0xd7:
+			# no payload
+			pos += 2
+			continue
+
+		yield marker, pos + 4, length - 2
+		pos += 2 + length
+
+
+def _is_jpeg_sof(marker):
+	return 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc)
+
+
+def _read_jpeg_sof(fd, offset):
+	# read (width, height) from a start-of-frame segment
+	fd.seek(offset)
+	_, height, width = struct.unpack('>BHH', _read_exact(fd, 5))
+	return width, height
+
+
+def _jpeg_size(fd, start):
+	# (width, height) of the JPEG at `start`, or None if PIL can't decode it
+	for marker, offset, _ in _iter_jpeg_segments(fd, start):
+		if _is_jpeg_sof(marker):
+			if marker not in _JPEG_DECODABLE:
+				return None
+			return _read_jpeg_sof(fd, offset)
+
+
+def _add_jpeg_preview(previews, fd, offset, length):
+	if length <= 0:
+		return
+	size = _jpeg_size(fd, offset)
+	if size and min(size) > 0:
+		previews.append((size[0], size[1], offset, length))
+
+
+def _tiff_previews(fd, base):
+	order, offset = _read_tiff_header(fd, base)
+	if order is None:
+		return [], 1, None
+
+	previews = []
+	orientation = None
+	size = None
+
+	queue = [offset]
+	seen = set()
+	# IFD chains and SubIFDs, bounded in case of loops
+	while queue and len(seen) < 32:
+		offset = queue.pop(0)
+		if not offset or offset in seen:
+			continue
+		seen.add(offset)
+
+		tags, next_offset = _read_tiff_ifd(fd, base, offset, order)
+		queue.append(next_offset)
+		queue.extend(tags.get(_TIFF_SUB_IFDS, ()))
+
+		if orientation is None:
+			# of IFD0
+			orientation = tags.get(EXIF_ORIENTATION, (1,))[0]
+
+		if _TIFF_WIDTH in tags and _TIFF_HEIGHT in tags:
+			dims = (tags[_TIFF_WIDTH][0], tags[_TIFF_HEIGHT][0])
+			if size is None or dims[0] * dims[1] > size[0] * size[1]:
+				size = dims
+
+		if _TIFF_JPEG_OFFSET in tags and _TIFF_JPEG_LENGTH in tags:
+			_add_jpeg_preview(
+				previews, fd,
+				base + tags[_TIFF_JPEG_OFFSET][0], tags[_TIFF_JPEG_LENGTH][0],
+			)
+		elif (
+			tags.get(_TIFF_COMPRESSION, (None,))[0] in (6, 7)
+			and len(tags.get(_TIFF_STRIP_OFFSETS, ())) == 1
+			and len(tags.get(_TIFF_STRIP_BYTE_COUNTS, ())) == 1
+		):
+			# JPEG compressed image in a single strip
+			_add_jpeg_preview(
+				previews, fd,
+				base + tags[_TIFF_STRIP_OFFSETS][0], tags[_TIFF_STRIP_BYTE_COUNTS][0],
+			)
+
+	return previews, orientation or 1, size
+
+
+def _mpf_previews(fd, base):
+	# Multi-Picture Format: the first entry is the main image, others can be previews
+	order, offset = _read_tiff_header(fd, base)
+	if order is None:
+		return []
+
+	tags, _ = _read_tiff_ifd(fd, base, offset, order)
+	entries = tags.get(_MPF_ENTRIES, b'')
+
+	previews = []
+	for pos in range(16, len(entries) - 15, 16):
+		_, length, offset, _, _ = struct.unpack(order + 'IIIHH', entries[pos:pos + 16])
+		if offset:
+			_add_jpeg_preview(previews, fd, base + offset, length)
+	return previews
+
+
+def _jpeg_previews(fd, start):
+	exif = mpf = size = None
+	for marker, offset, length in _iter_jpeg_segments(fd, start):
+		if marker == 0xe1 and exif is None:
+			fd.seek(offset)
+			if fd.read(6) == b'Exif\x00\x00':
+				exif = offset + 6
+		elif marker == 0xe2 and mpf is None:
+			fd.seek(offset)
+			if fd.read(4) == b'MPF\x00':
+				mpf = offset + 4
+		elif _is_jpeg_sof(marker):
+			size = _read_jpeg_sof(fd, offset)
+			break
+
+	previews = []
+	orientation = 1
+	if exif is not None:
+		previews, orientation, _ = _tiff_previews(fd, exif)
+	if mpf is not None:
+		previews.extend(_mpf_previews(fd, mpf))
+	return previews, orientation, size
+
+
+def find_embedded_previews(fd):
+	"""Find JPEG preview images embedded in a photo, without decoding it.
+
+	JPEG files (EXIF thumbnail and MPF previews), TIFF-based RAW files (like DNG, CR2, NEF,
+	ARW, ORF, RW2 or PEF) and Fuji RAF files are supported.
+
+	:param fd: file object of the photo, opened in binary mode
+	:returns: a tuple ``(previews, orientation, size)``, where `previews` is a list of
+	          ``(width, height, offset, length)`` tuples of JPEG previews found in the file,
+	          `orientation` is the EXIF orientation of the photo (1 if unknown), and `size`
+	          is the ``(width, height)`` of the photo, or None if unknown. Dimensions are
+	          before applying orientation.
+	:raises ValueError: if the file is truncated
+	"""
+
+	fd.seek(0)
+	head = fd.read(16)
+
+	try:
+		if head.startswith(b'\xff\xd8'):
+			return _jpeg_previews(fd, 0)
+
+		elif head == b'FUJIFILMCCD-RAW ':
+			# a full-size JPEG, itself containing an EXIF thumbnail
+			fd.seek(84)
+			offset, length = struct.unpack('>II', _read_exact(fd, 8))
+			previews, orientation, size = _jpeg_previews(fd, offset)
+			if size is not None:
+				previews.append((size[0], size[1], offset, length))
+			return previews, orientation, size
+
+		return _tiff_previews(fd, 0)
+	except struct.error:
+		raise ValueError('truncated file')
+
+
+class ExifPreviewBackend(PilBackend):
+	"""Backend scaling down preview images embedded in photos, with the Python Imaging Library.
+
+	Photos often carry JPEG previews: a 160x120 thumbnail in EXIF metadata, bigger previews
+	in MPF metadata or in RAW files (see :any:`find_embedded_previews`). The smallest preview
+	at least as big as the thumbnail and with the same aspect ratio as the photo is used, and
+	oriented like the photo. If there is none, this backend fails so the next backends decode
+	the full photo.
+
+	:param fast: see :any:`PilBackend`
+	"""
+
+	accepted_mimes = re.compile(
+		r'^image/(jpeg|tiff|x-(adobe-dng|canon-cr2|nikon-nef|nikon-nrw|sony-arw|sony-sr2|sony-srf'
+		r'|pentax-pef|samsung-srw|olympus-orf|panasonic-rw2?|panasonic-raw|fuji-raf))$'
+	)
+
+	# some cameras letterbox previews (e.g. 4:3 previews of 3:2 photos), such previews are
+	# not used if their aspect ratio differs more than this from the photo's
+	max_aspect_error = 0.03
+
+	def _pick_preview(self, previews, size, photo_size):
+		best = None
+		for preview in previews:
+			width, height = preview[:2]
+			if max(width, height) < size:
+				continue
+
+			if photo_size and min(photo_size) > 0:
+				ratio = float(photo_size[0]) / photo_size[1]
+				if abs(float(width) / height - ratio) > ratio * self.max_aspect_error:
+					continue
+
+			if best is None or width * height < best[0] * best[1]:
+				best = preview
+		return best
+
+	def _read_preview(self, fd, size):
+		previews, orientation, photo_size = find_embedded_previews(fd)
+		preview = self._pick_preview(previews, size, photo_size)
+		if preview is None:
+			return None, None
+
+		fd.seek(preview[2])
+		return fd.read(preview[3]), orientation
+
+	def _open(self, src, size):
+		import io
+
+		try:
+			if hasattr(src, 'read'):
+				data, orientation = self._read_preview(src, size)
+			else:
+				with open(src, 'rb') as fd:
+					data, orientation = self._read_preview(fd, size)
+		except (IOError, OSError, ValueError):
+			return None, None
+		if data is None:
+			return None, None
+
+		try:
+			img = self.mod.open(io.BytesIO(data))
+		except IOError:
+			return None, None
+
+		if self.fast:
+			self._reduce_decoding(img, size)
+		return img, orientation
+
+
 class MagickBackend(MetadataBackend, ThumbnailBackend):
+	"""Backend using PythonMagick.
+
+	PythonMagick is not known to be thread-safe, so calls to this backend are serialized
+	when thumbnails are generated by several threads.
+	"""
+
 	handled_types = frozenset([FILETYPE_IMAGE])
 	accepted_mimes = re.compile('^image/')
+	embeds_metadata = True
+
+	_lock = threading.Lock()
 
 	@classmethod
 	def is_available(cls):
@@ -632,59 +1499,202 @@ class MagickBackend(MetadataBackend, ThumbnailBackend):
 			k = str(k).encode('utf-8')
 			img.attribute(k, v)
 
-	def create_thumbnail(self, src, dest, size):
-		try:
-			img = self.mod.Image(self.encode(src))
-		except RuntimeError:
-			return
+	def create_thumbnail(self, src, dest, size, moreinfo=None):
+		with self._lock:
+			try:
+				img = self.mod.Image(self.encode(src))
+			except RuntimeError:
+				return
 
-		mtime = _any2mtime(src)
-		geom = self.mod.Geometry(size, size)
-		img.resize(geom)
-		img.write(self.encode(dest))
+			mtime = _any2mtime(src)
+			geom = self.mod.Geometry(size, size)
+			img.resize(geom)
 
-		return {
-			KEY_MTIME: mtime,
-		}
+			res = {
+				KEY_MTIME: mtime,
+			}
+			self.setattributes(img, _merge_info(res, moreinfo))
+			img.write(self.encode(dest))
+
+			return res
 
 	def update_metadata(self, dest, moreinfo=None):
-		try:
-			img = self.mod.Image(self.encode(dest))
-		except RuntimeError:
-			return
-		self.setattributes(img, moreinfo)
+		with self._lock:
+			try:
+				img = self.mod.Image(self.encode(dest))
+			except RuntimeError:
+				return
+			self.setattributes(img, moreinfo)
 
-		tmp = _mkstemp(dest)
-		img.write(self.encode(tmp))
-		os.rename(tmp, dest)
-		return dest
+			tmp = _mkstemp(dest)
+			img.write(self.encode(tmp))
+			os.rename(tmp, dest)
+			return dest
 
 	def create_fail(self, dest, moreinfo=None):
-		geom = self.mod.Geometry(1, 1)
-		color = self.mod.Color()
+		with self._lock:
+			geom = self.mod.Geometry(1, 1)
+			color = self.mod.Color()
 
-		img = self.mod.Image(geom, color)
-		self.setattributes(img, moreinfo)
+			img = self.mod.Image(geom, color)
+			self.setattributes(img, moreinfo)
 
-		tmp = _mkstemp(dest)
-		img.write(self.encode(tmp))
-		os.rename(tmp, dest)
-		return dest
+			tmp = _mkstemp(dest)
+			img.write(self.encode(tmp))
+			os.rename(tmp, dest)
+			return dest
 
 	def get_info(self, path):
+		with self._lock:
+			try:
+				img = self.mod.Image(self.encode(path))
+				return {
+					'mtime': int(float(img.attribute(KEY_MTIME.encode('ascii')) or 0)),
+					'uri': img.attribute(KEY_URI.encode('ascii')),
+				}
+			except (RuntimeError, KeyError, ValueError):
+				return
+
+
+class CommandScheduler(object):
+	"""Run the commands of :any:`CliMixin` backends, with bounded concurrency and timeouts.
+
+	At most `max_workers` commands run at the same time in the process, whatever the number
+	of threads thumbnailing files: other commands wait for a free slot. A command running
+	longer than its timeout is killed, along with the processes it spawned, and counts as
+	failed. Timeouts are not supported on Python 2, commands run until they exit.
+
+	:param max_workers: maximum number of commands running at the same time, by default the
+	                    number of CPUs
+	:ivar timeouts: number of commands killed because they timed out
+	"""
+
+	def __init__(self, max_workers=None):
+		self.max_workers = max_workers
+		self._slots = None
+		self._lock = threading.Lock()
+		self._waiting = 0
+		self._running = 0
+		self.timeouts = 0
+
+	@property
+	def queue_depth(self):
+		"""Number of commands waiting for a free slot."""
+		return self._waiting
+
+	@property
+	def running(self):
+		"""Number of commands currently running."""
+		return self._running
+
+	def _get_slots(self):
+		with self._lock:
+			if self._slots is None:
+				if self.max_workers is None:
+					from multiprocessing import cpu_count
+
+					self.max_workers = cpu_count()
+				self._slots = threading.BoundedSemaphore(self.max_workers)
+			return self._slots
+
+	def run(self, args, timeout=None):
+		"""Run a command and return its standard output.
+
+		:param args: the command line, as a list
+		:param timeout: in seconds, None to wait indefinitely
+		:returns: the standard output, or None if the command failed or timed out
+		"""
+
+		slots = self._get_slots()
+		with self._lock:
+			self._waiting += 1
+		slots.acquire()
+		with self._lock:
+			self._waiting -= 1
+			self._running += 1
+
 		try:
-			img = self.mod.Image(self.encode(path))
-			return {
-				'mtime': int(float(img.attribute(KEY_MTIME.encode('ascii')) or 0)),
-				'uri': img.attribute(KEY_URI.encode('ascii')),
-			}
-		except (RuntimeError, KeyError, ValueError):
+			return self._run(args, timeout)
+		finally:
+			with self._lock:
+				self._running -= 1
+			slots.release()
+
+	def _run(self, args, timeout):
+		import subprocess
+
+		if sys.version_info.major == 2:
+			# no timeout on Python 2
+			with open(os.devnull, 'rb') as devnull:
+				try:
+					return subprocess.check_output(args, stdin=devnull)
+				except (OSError, subprocess.CalledProcessError):
+					return
+
+		try:
+			# in its own session, so it can be killed with its children
+			proc = subprocess.Popen(
+				args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+				start_new_session=(os.name == 'posix'),
+			)
+		except OSError:
 			return
 
+		try:
+			output, _ = proc.communicate(timeout=timeout)
+		except subprocess.TimeoutExpired:
+			with self._lock:
+				self.timeouts += 1
+			_kill_process(proc)
+			return
+
+		if proc.returncode != 0:
+			return
+		return output
+
+
+def _kill_group(proc):
+	# kill a process started with start_new_session, with the processes it spawned.
+	# `proc` can be a subprocess.Popen or an asyncio Process
+	if os.name == 'posix':
+		import signal
+
+		try:
+			os.killpg(proc.pid, signal.SIGKILL)
+		except OSError:
+			pass
+	else:
+		proc.kill()
+
+
+def _kill_process(proc):
+	# kill a process started with start_new_session, and wait for it
+	_kill_group(proc)
+
+	# children left alive could keep the pipe open, don't wait for EOF
+	if proc.stdout is not None:
+		proc.stdout.close()
+	proc.wait()
+
+
+CLI_SCHEDULER = CommandScheduler()
+
+"""The :any:`CommandScheduler` running commands of the backends."""
+
 
 class CliMixin(object):
+	"""Mixin for backends running external commands.
+
+	Subclasses implement :any:`iter_commands`, and optionally :any:`check_result`. The
+	commands are run by :any:`create_thumbnail` through :any:`CLI_SCHEDULER`, or
+	asynchronously by :any:`vignette.aio`.
+	"""
+
 	cmd = None
 
+	# in seconds, a command running longer is killed and thumbnailing fails
+	timeout = 60
+
 	def is_available(self):
 		for path in os.getenv('PATH').split(os.pathsep):
 			path = os.path.join(path, self.cmd)
@@ -692,19 +1702,58 @@ class CliMixin(object):
 				return True
 		return False
 
+	def iter_commands(self, src, dest, size):
+		"""Generate the command lines to run for thumbnailing `src` into `dest`.
+
+		This is a generator: the standard output of each command is sent back into it.
+		If a command fails, the generator is not resumed and thumbnailing fails.
+		"""
+		raise NotImplementedError()
+
+	def check_result(self, src, dest, size, outputs):
+		"""Get the thumbnail info once all commands succeeded.
+
+		:param outputs: the standard outputs of the commands that were run
+		:returns: a dict of metadata, or None if thumbnailing failed
+		"""
+		if not (os.path.exists(dest) and os.path.getsize(dest)):
+			return
+		return {}
+
+	def run_command(self, args):
+		"""Run a command and return its standard output, or None if it failed or timed out."""
+		return CLI_SCHEDULER.run(args, self.timeout)
+
+	def create_thumbnail(self, src, dest, size):
+		commands = self.iter_commands(src, dest, size)
+		outputs = []
+		output = None
+
+		while True:
+			try:
+				args = commands.send(output)
+			except StopIteration:
+				break
+
+			output = self.run_command(args)
+			if output is None:
+				commands.close()
+				return
+			outputs.append(output)
+
+		return self.check_result(src, dest, size, outputs)
+
 
 class PopplerCliBackend(CliMixin, ThumbnailBackend):
 	handled_types = frozenset([FILETYPE_DOCUMENT])
 	accepted_mimes = re.compile('^application/pdf$')
 	cmd = 'pdftocairo'
 
-	def create_thumbnail(self, src, dest, size):
+	def iter_commands(self, src, dest, size):
 		prefix, _ = os.path.splitext(dest)
-		args = [self.cmd, '-png', '-singlefile', '-scale-to', str(size), src, prefix]
-		try:
-			subprocess.check_call(args)
-		except subprocess.CalledProcessError:
-			return
+		yield [self.cmd, '-png', '-singlefile', '-scale-to', str(size), src, prefix]
+
+	def check_result(self, src, dest, size, outputs):
 		return {}
 
 
@@ -712,16 +1761,11 @@ class OooCliBackend(CliMixin, ThumbnailBackend):
 	handled_types = frozenset([FILETYPE_DOCUMENT])
 	accepted_mimes = re.compile('^application/vnd.oasis.opendocument.')
 	cmd = 'ooo-thumbnailer'
+	# starting an office suite is slow
+	timeout = 120
 
-	def create_thumbnail(self, src, dest, size):
-		args = [self.cmd, src, dest, str(size)]
-		try:
-			subprocess.check_call(args)
-		except subprocess.CalledProcessError:
-			return
-		if not (os.path.exists(dest) and os.path.getsize(dest)):
-			return
-		return {}
+	def iter_commands(self, src, dest, size):
+		yield [self.cmd, src, dest, str(size)]
 
 
 class EvinceCliBackend(CliMixin, ThumbnailBackend):
@@ -734,15 +1778,8 @@ class EvinceCliBackend(CliMixin, ThumbnailBackend):
 	handled_types = frozenset([FILETYPE_DOCUMENT])
 	cmd = 'evince-thumbnailer'
 
-	def create_thumbnail(self, src, dest, size):
-		args = [self.cmd, '-s', str(size), src, dest]
-		try:
-			subprocess.check_call(args)
-		except subprocess.CalledProcessError:
-			return
-		if not (os.path.exists(dest) and os.path.getsize(dest)):
-			return
-		return {}
+	def iter_commands(self, src, dest, size):
+		yield [self.cmd, '-s', str(size), src, dest]
 
 
 class AtrilCliBackend(EvinceCliBackend):
@@ -754,15 +1791,8 @@ class ExeCliBackend(CliMixin, ThumbnailBackend):
 	accepted_mimes = re.compile('^application/x-dosexec|application/x-msi$')
 	cmd = 'exe-thumbnailer'
 
-	def create_thumbnail(self, src, dest, size):
-		args = [self.cmd, src, dest, 'this://is.invalid']
-		try:
-			subprocess.check_call(args)
-		except subprocess.CalledProcessError:
-			return
-		if not (os.path.exists(dest) and os.path.getsize(dest)):
-			return
-		return {}
+	def iter_commands(self, src, dest, size):
+		yield [self.cmd, src, dest, 'this://is.invalid']
 
 
 class OggThumbCliBackend(CliMixin, ThumbnailBackend):
@@ -770,13 +1800,11 @@ class OggThumbCliBackend(CliMixin, ThumbnailBackend):
 	handled_types = frozenset([FILETYPE_VIDEO])
 	cmd = 'oggThumb'
 
-	def create_thumbnail(self, src, dest, size):
-		try:
-			len_ms = int(subprocess.check_output(['oggLength', src]).strip())
-		except subprocess.CalledProcessError:
-			return
+	def iter_commands(self, src, dest, size):
+		output = yield ['oggLength', src]
+		len_ms = int(output.strip())
 
-		args = [
+		yield [
 			self.cmd,
 			'-o', 'png',
 			'-n', dest,
@@ -784,19 +1812,18 @@ class OggThumbCliBackend(CliMixin, ThumbnailBackend):
 			'-s', '%{0}x%{0}'.format(size),
 			src,
 		]
-		try:
-			subprocess.check_call(args)
-		except subprocess.CalledProcessError:
-			return
+
+	def check_result(self, src, dest, size, outputs):
 		if not (os.path.exists(dest) and os.path.getsize(dest)):
 			return
 		return {
-			KEY_MOVIE_LENGTH: str(len_ms) / 1000,
+			KEY_MOVIE_LENGTH: str(int(outputs[0].strip()) / 1000),
 		}
 
 
 class QtBackend(MetadataBackend, ThumbnailBackend):
 	handled_types = frozenset([FILETYPE_IMAGE])
+	embeds_metadata = True
 	_accepted_mimes = None
 
 	@classmethod
@@ -822,24 +1849,33 @@ class QtBackend(MetadataBackend, ThumbnailBackend):
 		for k in moreinfo or {}:
 			img.setText(k, moreinfo[k])
 
-	def create_thumbnail(self, src, dest, size):
+	def create_thumbnail(self, src, dest, size, moreinfo=None):
+		return self.create_thumbnail_sizes(src, [(dest, size)], moreinfo)[0]
+
+	def create_thumbnail_sizes(self, src, targets, moreinfo=None):
 		from PyQt5.QtCore import Qt
 		from PyQt5.QtGui import QImage
 
 		img = QImage(str(src))
 		if img.isNull():
-			return
+			return [None] * len(targets)
 
 		res = {
 			KEY_MTIME: _any2mtime(src),
 			KEY_WIDTH: img.width(),
 			KEY_HEIGHT: img.height(),
 		}
+		results = []
 
-		img = img.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+		for dest, size in targets:
+			# each smaller size is downscaled from the previous one
+			img = img.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+			self.setattributes(img, _merge_info(res, moreinfo))
 
-		img.save(dest)
-		return res
+			img.save(dest, 'PNG')
+			results.append(res)
+
+		return results
 
 	def update_metadata(self, dest, moreinfo=None):
 		from PyQt5.QtGui import QImage
@@ -892,6 +1928,8 @@ class GnomeThumbnailer(CliMixin, ThumbnailBackend):
 	}
 
 	def __init__(self, cmd_test, cmd_exec, mimes):
+		import shlex
+
 		self.cmd = cmd_test
 		self.accepted_mimes = re.compile('^(?:%s)$' % '|'.join(map(re.escape, mimes)))
 		cmd_exec = re.sub('%([iosu])', r'%(\1)s', cmd_exec)
@@ -907,27 +1945,27 @@ class GnomeThumbnailer(CliMixin, ThumbnailBackend):
 	def __repr__(self):
 		return '<%s cmd=%r>' % (type(self).__name__, self.cmd)
 
-	def create_thumbnail(self, src, dest, size):
+	def iter_commands(self, src, dest, size):
 		vars = {
 			'i': src,
 			'o': dest,
 			'u': _any2uri(src),
 			's': str(size),
 		}
-		args = [arg % vars for arg in self.cmd_exec]
-		try:
-			subprocess.check_call(args)
-		except subprocess.CalledProcessError:
-			return
-		if not (os.path.exists(dest) and os.path.getsize(dest)):
-			return
-		return {}
+		yield [arg % vars for arg in self.cmd_exec]
 
 
 GNOME_THUMBNAILERS_PATH = '/usr/share/thumbnailers/*.thumbnailer'
 
 
 def build_gnome_thumbnailers():
+	from glob import glob
+
+	if sys.version_info.major > 2:
+		from configparser import RawConfigParser
+	else:
+		from ConfigParser import RawConfigParser
+
 	section = 'Thumbnailer Entry'
 	for f in glob(GNOME_THUMBNAILERS_PATH):
 		cfg = RawConfigParser()
@@ -941,38 +1979,217 @@ def build_gnome_thumbnailers():
 		yield backend
 
 
-METADATA_BACKENDS = [QtBackend(), PilBackend(), MagickBackend()]
+class LazyBackendList(MutableSequence):
+	"""List of backends, built on first use.
+
+	Building the default lists of backends requires reading the GNOME thumbnailers
+	configuration, which is deferred until backends are actually needed, so importing
+	`vignette` is fast for apps that only query the store.
+
+	Apart from that, it behaves like a regular list. The list is built once, even when
+	first used by several threads at the same time.
+	"""
+
+	def __init__(self, factory):
+		self._factory = factory
+		self._items = None
+		self._lock = threading.Lock()
+
+	@property
+	def loaded(self):
+		return self._items is not None
+
+	def _load(self):
+		items = self._items
+		if items is None:
+			with self._lock:
+				if self._items is None:
+					self._items = list(self._factory())
+				items = self._items
+		return items
+
+	def __getitem__(self, index):
+		return self._load()[index]
+
+	def __setitem__(self, index, value):
+		self._load()[index] = value
+
+	def __delitem__(self, index):
+		del self._load()[index]
+
+	def __len__(self):
+		return len(self._load())
+
+	def __iter__(self):
+		return iter(self._load())
+
+	def insert(self, index, value):
+		self._load().insert(index, value)
+
+	def __repr__(self):
+		if self._items is None:
+			return '<%s (not loaded)>' % type(self).__name__
+		return '<%s %r>' % (type(self).__name__, self._items)
+
+
+def _default_thumbnailer_backends():
+	backends = [
+		OooCliBackend(),
+		PopplerCliBackend(),
+		EvinceCliBackend(),
+		AtrilCliBackend(),
+		ExifPreviewBackend(),
+		QtBackend(),
+		PilBackend(),
+		MagickBackend()
+	]
+	backends.extend(build_gnome_thumbnailers())
+	return backends
+
+
+METADATA_BACKENDS = LazyBackendList(lambda: [QtBackend(), PilBackend(), MagickBackend()])
+
+ALL_THUMBNAILER_BACKENDS = LazyBackendList(_default_thumbnailer_backends)
+
+THUMBNAILER_BACKENDS = LazyBackendList(lambda: list(ALL_THUMBNAILER_BACKENDS))
+
+
+class BackendRegistry(object):
+	"""Cache of the availability of backends.
+
+	Probing a backend can be costly (importing a library, looking for a command in every
+	``PATH`` directory), so it is done once per backend and the result is kept. The lists of
+	available backends are cached too, for each configured list of backends, so changing
+	``THUMBNAILER_BACKENDS`` or ``METADATA_BACKENDS`` is taken into account.
+
+	The cache is dropped when the ``PATH`` environment variable changes, or when calling
+	:any:`refresh`, for example after installing a library or a tool.
+
+	Instances can be used by several threads.
+	"""
+
+	max_lists = 16
+	max_mimes = 256
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.refresh()
+
+	def refresh(self):
+		"""Forget all cached results, backends will be probed again when needed."""
+		self._path = os.getenv('PATH')
+		self._probed = {}
+		self._lists = {}
+		self._mimes = OrderedDict()
+
+	def is_available(self, backend):
+		try:
+			return self._probed[backend]
+		except KeyError:
+			res = self._probed[backend] = bool(backend.is_available())
+			return res
+
+	def available(self, backends):
+		"""Get the available backends among `backends`, keeping their order.
+
+		:param backends: list of backends
+		:rtype: tuple
+		"""
+		if os.getenv('PATH') != self._path:
+			self.refresh()
+
+		key = tuple(backends)
+		try:
+			return self._lists[key]
+		except KeyError:
+			pass
+
+		if len(self._lists) >= self.max_lists:
+			self._lists.clear()
+		res = self._lists[key] = tuple(b for b in key if self.is_available(b))
+		return res
+
+	def for_mime(self, backends, mime):
+		"""Get the available backends among `backends` accepting `mime`, keeping their order.
+
+		The most recently used combinations are cached, so a MIME type is matched
+		against each backend's :any:`ThumbnailBackend.accepts_mime` only once.
+
+		Backends overriding :any:`ThumbnailBackend.is_accepted` are always returned,
+		whatever `mime`: they decide by path, and :any:`is_accepted` should be called on them
+		with the path of the file.
+
+		:param backends: list of backends
+		:param mime: MIME type of a file, or None if unknown
+		:type mime: str
+		:rtype: tuple
+		"""
+		backends = self.available(backends)
+		key = (backends, mime)
+		mimes = self._mimes
+
+		with self._lock:
+			res = mimes.pop(key, None)
+			if res is not None:
+				mimes[key] = res
+				return res
+
+		res = tuple(
+			b for b in backends
+			if _decides_by_path(b) or (mime is not None and b.accepts_mime(mime))
+		)
+
+		with self._lock:
+			mimes.pop(key, None)
+			while len(mimes) >= self.max_mimes:
+				mimes.popitem(last=False)
+			mimes[key] = res
+		return res
 
-ALL_THUMBNAILER_BACKENDS = [
-	OooCliBackend(),
-	PopplerCliBackend(),
-	EvinceCliBackend(),
-	AtrilCliBackend(),
-	QtBackend(),
-	PilBackend(),
-	MagickBackend()
-]
 
-ALL_THUMBNAILER_BACKENDS.extend(build_gnome_thumbnailers())
+def _decides_by_path(backend):
+	# is_accepted overridden, the MIME type is not enough
+	return getattr(type(backend), 'is_accepted', None) is not ThumbnailBackend.is_accepted
 
-THUMBNAILER_BACKENDS = list(ALL_THUMBNAILER_BACKENDS)
+
+BACKEND_REGISTRY = BackendRegistry()
 
 
 def get_metadata_backend():
-	for backend in METADATA_BACKENDS:
-		if backend.is_available():
-			return backend
+	for backend in BACKEND_REGISTRY.available(METADATA_BACKENDS):
+		return backend
 
 
 def iter_thumbnail_backends():
-	for backend in THUMBNAILER_BACKENDS:
-		if backend.is_available():
-			yield backend
+	return iter(BACKEND_REGISTRY.available(THUMBNAILER_BACKENDS))
 
 
 FILTER_MIMETYPES = True
 
 
+def _candidate_backends(src):
+	if not FILTER_MIMETYPES:
+		return BACKEND_REGISTRY.available(THUMBNAILER_BACKENDS)
+	backends = BACKEND_REGISTRY.for_mime(THUMBNAILER_BACKENDS, _sniff_mime(src))
+	return tuple(b for b in backends if not _decides_by_path(b) or b.is_accepted(src))
+
+
+def _thumbnail_with(backend, src, tmp, size, info):
+	if backend.embeds_metadata:
+		return backend.create_thumbnail(src, tmp, size, info)
+	return backend.create_thumbnail(src, tmp, size)
+
+
+def _store_created(src, size, tmp, backend, res, info):
+	if res is None:
+		return
+	elif backend.embeds_metadata:
+		return _install_thumbnail(src, size, tmp, info=info)
+
+	moreinfo = _merge_info(res, info)
+	return put_thumbnail(src, size, tmp, mtime=moreinfo.get(KEY_MTIME), moreinfo=moreinfo)
+
+
 def create_thumbnail(src, size, moreinfo=None, use_fail_appname=None):
 	"""Generate a thumbnail for `src`, even if the thumbnail existed.
 
@@ -993,24 +2210,226 @@ def create_thumbnail(src, size, moreinfo=None, use_fail_appname=None):
 	:rtype: str
 	"""
 
+	key = thumbnail_key(src)
+	src = key.src
 	size = _any2size(size)[0]
 	tmp = create_temp(size)
+	info = _info_dict(moreinfo, src=src)
 
-	for backend in iter_thumbnail_backends():
-		if FILTER_MIMETYPES and not backend.is_accepted(src):
-			continue
+	for backend in _candidate_backends(src):
+		with _stage('create', backend):
+			res = _thumbnail_with(backend, src, tmp, size, info)
+		dest = _store_created(key, size, tmp, backend, res, info)
+		if dest:
+			return dest
+		_count('failure', backend)
+
+	_count('failure')
+	if use_fail_appname is not None:
+		put_fail(key, use_fail_appname)
 
-		moreinfo = backend.create_thumbnail(src, tmp, size)
-		if moreinfo is not None:
-			moreinfo = _info_dict(moreinfo, src=src)
-			mtime = moreinfo[KEY_MTIME]
 
-			dest = put_thumbnail(src, size, tmp, mtime=mtime, moreinfo=moreinfo)
+def create_thumbnail_sizes(src, sizes=('large', 'normal'), moreinfo=None, use_fail_appname=None):
+	"""Generate thumbnails of several sizes for `src`, even if the thumbnails existed.
+
+	This is faster than calling :any:`create_thumbnail` for each size: when backends support
+	it, the source file is decoded only once, and smaller thumbnails are downscaled from
+	the larger ones.
+
+	:param src: path of the source file. Must be an image file. Cannot be a URL.
+	:type src: str
+	:param sizes: desired sizes of thumbnails, see :any:`create_thumbnail`.
+	:param moreinfo: optional additional key/values metadata to store in the thumbnail files.
+	:type moreinfo: dict
+	:param use_fail_appname: app name to use when creating a failure info, if no thumbnail
+	                         could be generated.
+	:type use_fail_appname: str
+	:returns: a dict with size names ('large', 'normal') as keys, and the paths of the
+	          thumbnails as values, or None for thumbnails that couldn't be generated
+	:rtype: dict
+	"""
+
+	key = thumbnail_key(src)
+	src = key.src
+	sizes = sorted(set(_any2size(size) for size in sizes), reverse=True)
+	names = dict(sizes)
+	info = _info_dict(moreinfo, src=src)
+	dests = dict.fromkeys(names.values())
+	missing = [(create_temp(size), size) for size, _ in sizes]
+
+	for backend in _candidate_backends(src):
+		with _stage('create', backend):
+			results = backend.create_thumbnail_sizes(src, missing, info)
+
+		failed = []
+		for (tmp, size), res in zip(missing, results):
+			dest = _store_created(key, size, tmp, backend, res, info)
 			if dest:
-				return dest
+				dests[names[size]] = dest
+			else:
+				failed.append((tmp, size))
+
+		if failed:
+			_count('failure', backend)
+		missing = failed
+		if not missing:
+			break
+
+	for tmp, _ in missing:
+		try:
+			os.remove(tmp)
+		except OSError:
+			pass
+
+	if len(missing) == len(sizes):
+		_count('failure')
+		if use_fail_appname is not None:
+			put_fail(key, use_fail_appname)
+	return dests
+
+
+def _memory_source(src):
+	# path, or a seekable file object at its start
+	import io
+
+	if isinstance(src, bytes):
+		return io.BytesIO(src)
+	elif not hasattr(src, 'read'):
+		return src
+	elif getattr(src, 'seekable', lambda: False)() and src.tell() == 0:
+		return src
+	return io.BytesIO(src.read())
+
+
+def _render(src, size):
+	# the backends able to work without files: PIL-based ones
+	backends = [
+		backend for backend in BACKEND_REGISTRY.available(THUMBNAILER_BACKENDS)
+		if isinstance(backend, PilBackend)
+	]
+
+	for backend in backends:
+		if hasattr(src, 'seek'):
+			src.seek(0)
+		with _stage('create', backend):
+			img = backend.render(src, size)
+		if img is not None:
+			return backend, img
+		_count('failure', backend)
+
+	_count('failure')
+	return None, None
+
+
+def _is_in_memory(src):
+	return isinstance(src, bytes) or hasattr(src, 'read')
+
+
+def _memory_info(path, img, moreinfo, uri, mtime):
+	# path is None for in-memory sources
+	info = _info_dict(moreinfo, mtime=mtime)
+	if uri is not None:
+		info[KEY_URI] = uri
+	if path is not None:
+		info = _info_dict(info, src=path)
+	info.setdefault(KEY_WIDTH, str(img.size[0]))
+	info.setdefault(KEY_HEIGHT, str(img.size[1]))
+	return info
+
+
+def _store_data(path, size, data, info):
+	if KEY_URI not in info or KEY_MTIME not in info:
+		raise ValueError('uri and mtime are required to store a thumbnail of in-memory data')
+
+	if path is None or _any2uri(path) != info[KEY_URI]:
+		key = thumbnail_key(info[KEY_URI])
+	else:
+		key = thumbnail_key(path)
+	dest = key.thumbnail_path(size)
+	_makedir(os.path.dirname(dest))
+	tmp = _mkstemp(dest)
+	with open(tmp, 'wb') as fd:
+		fd.write(data)
+	return _install_thumbnail(key, size, tmp, dest, info)
 
-	if use_fail_appname is not None:
-		put_fail(src, use_fail_appname)
+
+def create_thumbnail_bytes(src, size='large', moreinfo=None, uri=None, mtime=None, store=False):
+	"""Generate a thumbnail in memory, and return its PNG data.
+
+	Unlike :any:`create_thumbnail`, no temporary file is written: the source is decoded
+	and the thumbnail encoded in memory. Only the PIL-based backends can do that, other
+	backends (like external commands) are not used.
+
+	:param src: path of the source file, its content as bytes, or a binary file object
+	            (read from its current position)
+	:param size: desired size of thumbnail. Can be any of 'large', 256 for large
+	             thumbnails or 'normal', 128 for small thumbnails.
+	:param moreinfo: optional additional key/values metadata to store in the thumbnail.
+	:type moreinfo: dict
+	:param uri: URI of the source, written in the thumbnail metadata. By default, the URI
+	            of `src` if it's a path.
+	:param mtime: mtime of the source, written in the thumbnail metadata. By default, the
+	              mtime of `src` if it's a path.
+	:param store: if True, the thumbnail is also put into the store
+	:returns: the PNG data of the thumbnail, or None if it couldn't be generated
+	:rtype: bytes
+	:raises ValueError: if `store` is True but the URI or mtime of an in-memory source is
+	                    not given
+	"""
+
+	size = _any2size(size)
+	path = None if _is_in_memory(src) else src
+	backend, img = _render(_memory_source(_source_path(src)), size[0])
+	if img is None:
+		return None
+
+	info = _memory_info(path, img, moreinfo, uri, mtime)
+	data = backend.encode(img, info)
+	img.close()
+
+	if store:
+		_store_data(path, size[1], data, info)
+	return data
+
+
+def get_thumbnail_image(src, size='large', uri=None, mtime=None, store=False):
+	"""Get a thumbnail as a PIL image, from the store or generated in memory.
+
+	If a valid thumbnail exists in the store, it is loaded. Else, it is generated in memory,
+	see :any:`create_thumbnail_bytes`.
+
+	:param src: path of the source file, its content as bytes, or a binary file object
+	            (read from its current position)
+	:param size: desired size of thumbnail. Can be any of 'large', 256 for large
+	             thumbnails or 'normal', 128 for small thumbnails.
+	:param uri: URI of the source, to look up the store and to write in the thumbnail
+	            metadata. By default, the URI of `src` if it's a path.
+	:param mtime: mtime of the source. By default, the mtime of `src` if it's a path.
+	:param store: if True, a generated thumbnail is also put into the store
+	:returns: a PIL image, or None if the thumbnail couldn't be generated
+	:raises ValueError: if `store` is True but the URI or mtime of an in-memory source is
+	                    not given
+	"""
+
+	size = _any2size(size)
+	path = None if _is_in_memory(src) else src
+	if uri is not None and mtime is not None:
+		thumb = try_get_thumbnail(uri, size[1], mtime)
+	elif path is not None:
+		thumb = try_get_thumbnail(path, size[1], mtime)
+	else:
+		thumb = None
+
+	if thumb is not None and PilBackend.is_available():
+		img = PilBackend.mod.open(thumb)
+		img.load()
+		return img
+
+	backend, img = _render(_memory_source(_source_path(src)), size[0])
+	if img is not None and store:
+		info = _memory_info(path, img, None, uri, mtime)
+		_store_data(path, size[1], backend.encode(img, info), info)
+	return img
 
 
 def build_thumbnail_path(src, size):
@@ -1027,24 +2446,153 @@ def build_thumbnail_path(src, size):
 	:rtype: str
 	"""
 
-	sizename = _any2size(size)[1]
-	prefix = os.path.join(_thumb_path_prefix(), sizename)
-	if src.startswith(prefix + '/'):
-		return src
-
-	md5uri = hash_name(src)
-	return os.path.join(prefix, '%s.png' % md5uri)
+	return thumbnail_key(src).thumbnail_path(size)
 
 
 def is_thumbnail_valid(thumbnail, uri, mtime):
 	mtime = int(float(mtime))
-	info = get_metadata_backend().get_info(thumbnail)
+	info = _get_info(thumbnail)
 	try:
 		return info['uri'] == uri and info['mtime'] == mtime
 	except (TypeError, KeyError):
 		return False
 
 
+STORE_INDEX = None
+
+"""If not None, a :any:`vignette.index.StoreIndex` used to check thumbnails without reading
+them, and updated when thumbnails are written."""
+
+
+def _check_thumbnail(thumbnail, uri, mtime):
+	# is_thumbnail_valid, through STORE_INDEX if enabled
+	index = STORE_INDEX
+	if index is None:
+		return is_thumbnail_valid(thumbnail, uri, mtime)
+
+	valid = index.is_valid(thumbnail, uri, mtime)
+	if valid is not None:
+		return valid
+
+	# not indexed or changed by another app
+	info = _get_info(thumbnail)
+	if info is None:
+		# index it as invalid, so it is not read again
+		index.update(thumbnail, '', -1)
+		return False
+
+	index.update(thumbnail, info['uri'], info['mtime'])
+	return info['uri'] == uri and info['mtime'] == int(float(mtime))
+
+
+def _index_thumbnail(path, info):
+	index = STORE_INDEX
+	if index is None or path is None:
+		return
+
+	try:
+		index.update(path, info[KEY_URI], info[KEY_MTIME])
+	except (KeyError, TypeError, ValueError):
+		index.forget(path)
+
+
+class ValidityCache(object):
+	"""In-memory cache of the thumbnails found valid by :any:`try_get_thumbnail`.
+
+	When a thumbnail is found valid, its path is remembered along with the file status of
+	the thumbnail and the mtime of the source. Later queries for the same source are then
+	answered with a single ``stat()`` of the thumbnail instead of reading it again.
+
+	Only the `maxsize` most recently used entries are kept. The :any:`hits` and
+	:any:`misses` attributes count queries answered (or not) by the cache.
+
+	To enable it, set the module's ``VALIDITY_CACHE`` attribute::
+
+	  vignette.VALIDITY_CACHE = vignette.ValidityCache(maxsize=10000)
+
+	Thumbnails put by :any:`put_thumbnail` (or :any:`create_thumbnail`) invalidate the
+	corresponding entry. Thumbnails changed by other processes are detected by their
+	file status. Entries are kept by thumbnail store, so changing ``XDG_CACHE_HOME`` doesn't
+	return thumbnails of the previous store.
+	"""
+
+	def __init__(self, maxsize=4096):
+		self.maxsize = maxsize
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def _stat_key(st):
+		return (st.st_ino, st.st_size, st.st_mtime)
+
+	@staticmethod
+	def _key(uri, size):
+		return (_thumb_path_prefix(), uri, _any2size(size)[1])
+
+	def __len__(self):
+		return len(self._entries)
+
+	def get(self, uri, size, mtime):
+		"""Get the cached valid thumbnail path for `uri`, or None."""
+		key = self._key(uri, size)
+
+		with self._lock:
+			entry = self._entries.pop(key, None)
+
+		if entry is not None and entry[2] == mtime:
+			try:
+				st = os.stat(entry[0])
+			except OSError:
+				pass
+			else:
+				if self._stat_key(st) == entry[1]:
+					with self._lock:
+						self._entries[key] = entry
+						self.hits += 1
+					return entry[0]
+
+		with self._lock:
+			self.misses += 1
+
+	def put(self, uri, size, thumb, mtime):
+		"""Remember `thumb` is valid for `uri` and source `mtime`."""
+		try:
+			st = os.stat(thumb)
+		except OSError:
+			return
+
+		key = self._key(uri, size)
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = (thumb, self._stat_key(st), mtime)
+			while len(self._entries) > self.maxsize:
+				self._entries.popitem(last=False)
+
+	def invalidate(self, uri, size=None):
+		"""Forget entries of `uri` for `size`, or for all sizes if None."""
+		if size is None:
+			sizes = ('normal', 'large')
+		else:
+			sizes = (_any2size(size)[1],)
+
+		with self._lock:
+			for size in sizes:
+				self._entries.pop(self._key(uri, size), None)
+
+	def clear(self):
+		"""Forget all entries and reset counters."""
+		with self._lock:
+			self._entries.clear()
+			self.hits = self.misses = 0
+
+
+VALIDITY_CACHE = None
+
+"""Optional :any:`ValidityCache` used by :any:`try_get_thumbnail`, disabled if None."""
+
+
 def try_get_thumbnail(src, size=None, mtime=None):
 	"""Get the path of the thumbnail or None if it doesn't exist.
 
@@ -1065,16 +2613,255 @@ def try_get_thumbnail(src, size=None, mtime=None):
 	else:
 		sizes = [size]
 
-	mtime = _any2mtime(src, mtime)
-	uri = _any2uri(src)
+	key = thumbnail_key(src)
+	mtime = _any2mtime(key.src, mtime)
+	uri = key.uri
+	cache = VALIDITY_CACHE
+	stale = False
 
 	for size in sizes:
-		thumb = build_thumbnail_path(src, size)
+		if cache is not None:
+			thumb = cache.get(uri, size, mtime)
+			if thumb is not None:
+				_count('hit')
+				return thumb
+
+		thumb = key.thumbnail_path(size)
 		if os.path.exists(thumb):
-			if src == thumb:
-				return src # bypass checks, the URI won't match
-			elif is_thumbnail_valid(thumb, uri, mtime):
+			if key.src == thumb:
+				return key.src # bypass checks, the URI won't match
+			elif _check_thumbnail(thumb, uri, mtime):
+				if cache is not None:
+					cache.put(uri, size, thumb, mtime)
+				_count('hit')
 				return thumb
+			stale = True
+
+	_count('stale' if stale else 'miss')
+
+
+def list_store(size=None):
+	"""List the names of the thumbnails in the store.
+
+	The result can be passed to :any:`lookup_directory`, to list the store once when looking
+	up many directories. It is not updated when thumbnails are added or removed afterwards.
+
+	:param size: size of thumbnails to list, all if None
+	:returns: a dict with size names ('large', 'normal') as keys, and sets of file names as
+	          values
+	:rtype: dict
+	"""
+
+	if size is None:
+		sizes = ['large', 'normal']
+	else:
+		sizes = [_any2size(size)[1]]
+
+	names = {}
+	for size in sizes:
+		try:
+			names[size] = frozenset(os.listdir(os.path.join(_thumb_path_prefix(), size)))
+		except OSError:
+			names[size] = frozenset()
+	return names
+
+
+def lookup_directory(path, size=None, existing=None):
+	"""Find the valid thumbnails of all files in a directory.
+
+	This is equivalent to calling :any:`try_get_thumbnail` for each file of the directory,
+	but faster: the directory is listed once, file status comes from the directory listing,
+	and only existing thumbnails are read to check their validity.
+
+	Existing thumbnails are found with a ``stat()`` of each thumbnail path. When looking up
+	many directories, list the store once with :any:`list_store` and pass it as `existing`
+	instead.
+
+	Subdirectories are ignored. Thumbnails are not generated.
+
+	:param path: path of the directory
+	:type path: str
+	:param size: desired size of thumbnails. Can be 'large', 256 or 'normal', 128. If None,
+	             large thumbnails are looked up first, then normal thumbnails.
+	:param existing: names of the thumbnails in the store, as returned by :any:`list_store`
+	:returns: a dict with paths of files in `path` as keys, and paths of their thumbnails, or
+	          None, as values
+	:rtype: dict
+	"""
+
+	if size is None:
+		sizes = ['large', 'normal']
+	else:
+		sizes = [_any2size(size)[1]]
+
+	files = []
+	with os.scandir(path) as entries:
+		for entry in entries:
+			try:
+				if entry.is_file():
+					files.append((thumbnail_key(entry.path), int(entry.stat().st_mtime)))
+			except OSError:
+				# removed in the meantime
+				continue
+
+	found = dict.fromkeys(key.src for key, _ in files)
+	cache = VALIDITY_CACHE
+
+	for size in sizes:
+		names = None if existing is None else existing.get(size, ())
+
+		for key, mtime in files:
+			if found[key.src] is not None:
+				continue
+
+			thumb = key.thumbnail_path(size)
+			if names is None:
+				if not os.path.exists(thumb):
+					continue
+			elif '%s.png' % key.md5 not in names:
+				continue
+
+			if cache is not None:
+				cached = cache.get(key.uri, size, mtime)
+				if cached is not None:
+					found[key.src] = cached
+					continue
+
+			if _check_thumbnail(thumb, key.uri, mtime):
+				if cache is not None:
+					cache.put(key.uri, size, thumb, mtime)
+				found[key.src] = thumb
+
+	return found
+
+
+LOCK_GENERATION = True
+
+"""If True, :any:`get_thumbnail` generates a missing thumbnail only once when called
+concurrently for the same file and size, by threads or by processes. Other callers wait for
+the thumbnail and reuse it."""
+
+LOCK_TIMEOUT = 60
+
+"""Time in seconds to wait for another process generating the same thumbnail. After that,
+the other process is considered hung and the thumbnail is generated anyway."""
+
+_LOCKS_DIR = '.vignette-locks'
+
+
+class _ThumbnailLock(object):
+	# lock file shared by processes generating the thumbnail of `uri` at `size`
+
+	def __init__(self, uri, size):
+		name = '%s-%s.lock' % (hash_name(uri), size)
+		self.path = os.path.join(_thumb_path_prefix(), _LOCKS_DIR, name)
+		self.fd = None
+		# True if another process held the lock
+		self.contended = False
+
+	def acquire(self, timeout=None):
+		"""Return True if the lock was acquired, False if it timed out or is not supported."""
+		try:
+			import fcntl
+		except ImportError:
+			return False
+		import time
+
+		try:
+			_makedir(os.path.dirname(self.path))
+		except OSError:
+			return False
+
+		deadline = None if timeout is None else time.time() + timeout
+		delay = .01
+		while True:
+			try:
+				fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+			except OSError:
+				return False
+
+			try:
+				fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except (IOError, OSError):
+				os.close(fd)
+				self.contended = True
+				if deadline is not None and time.time() >= deadline:
+					return False
+				time.sleep(delay)
+				delay = min(delay * 2, .2)
+				continue
+
+			# the previous holder removes the file before releasing the lock: if it did,
+			# this file is not the lock anymore
+			try:
+				current = os.stat(self.path).st_ino == os.fstat(fd).st_ino
+			except OSError:
+				current = False
+			if current:
+				self.fd = fd
+				return True
+			os.close(fd)
+
+	def release(self):
+		if self.fd is None:
+			return
+		try:
+			os.remove(self.path)
+		except OSError:
+			pass
+		os.close(self.fd)
+		self.fd = None
+
+
+class _Flight(object):
+	# a thumbnail being generated in this process
+
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+		self.ok = False
+
+
+_FLIGHTS = {}
+_FLIGHTS_LOCK = threading.Lock()
+
+
+def _create_once(src, size, use_fail_appname=None):
+	# create_thumbnail, unless a thread or process is creating the same thumbnail
+	key = (_any2uri(src), _any2size(size)[1])
+
+	while True:
+		with _FLIGHTS_LOCK:
+			flight = _FLIGHTS.get(key)
+			if flight is None:
+				flight = _FLIGHTS[key] = _Flight()
+				break
+
+		flight.done.wait()
+		if flight.ok:
+			return flight.result
+		# the generating thread raised an exception, try ourselves
+
+	try:
+		lock = _ThumbnailLock(*key)
+		locked = lock.acquire(LOCK_TIMEOUT)
+		try:
+			thumb = None
+			if locked and lock.contended:
+				# another process may have generated it while we were waiting
+				thumb = try_get_thumbnail(src, size)
+			if thumb is None:
+				thumb = create_thumbnail(src, size, use_fail_appname=use_fail_appname)
+		finally:
+			lock.release()
+
+		flight.result = thumb
+		flight.ok = True
+		return thumb
+	finally:
+		with _FLIGHTS_LOCK:
+			del _FLIGHTS[key]
+		flight.done.set()
 
 
 def get_thumbnail(src, size=None, use_fail_appname=None):
@@ -1089,6 +2876,11 @@ def get_thumbnail(src, size=None, use_fail_appname=None):
 	returns None. If `use_fail_appname` is specified, a fail-file is generated in case of
 	error.
 
+	If the same thumbnail is being generated by another call, in another thread or process,
+	the function waits for it instead of generating it again (see :any:`LOCK_GENERATION`).
+
+	Generation can be forwarded to a daemon, see :any:`USE_DAEMON`.
+
 	:param src: path of the source file. Must be an image file. Cannot be a URL.
 	:type src: str
 	:param size: desired size of thumbnail. Can be any of 'large', 256 for large
@@ -1102,6 +2894,7 @@ def get_thumbnail(src, size=None, use_fail_appname=None):
 	:rtype: str
 	"""
 
+	src = thumbnail_key(src)
 	thumb = try_get_thumbnail(src, size)
 	if thumb is not None:
 		return thumb
@@ -1109,15 +2902,139 @@ def get_thumbnail(src, size=None, use_fail_appname=None):
 	if use_fail_appname is not None:
 		mtime = _any2mtime(src)
 		if is_thumbnail_failed(src, use_fail_appname, mtime):
+			_count('fail_file')
 			return None
 
 	if size is None:
 		size = 'large'
+
+	if USE_DAEMON:
+		done, thumb = _create_by_daemon(src, size, use_fail_appname)
+		if done:
+			return thumb
+
+	if LOCK_GENERATION:
+		return _create_once(src, size, use_fail_appname)
 	return create_thumbnail(src, size, use_fail_appname=use_fail_appname)
 
 
+USE_DAEMON = False
+
+"""If True, :any:`get_thumbnail` asks the daemon to generate missing thumbnails, if it is
+running (see :any:`vignette.daemon`). Else, or if the daemon fails, thumbnails are generated
+locally."""
+
+
+def _create_by_daemon(src, size, use_fail_appname):
+	from vignette import daemon
+
+	try:
+		thumb = daemon.call(
+			'get_thumbnail', src=os.path.abspath(_source_path(src)), size=size,
+			use_fail_appname=use_fail_appname,
+		)
+	except daemon.DaemonError:
+		# not running, or failed (for example its worker crashed), generate locally
+		return False, None
+	return True, thumb
+
+
+def _iter_parallel(func, srcs, args, workers, threads=False):
+	from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+	from itertools import islice
+	from multiprocessing import cpu_count
+
+	if workers is None:
+		workers = cpu_count()
+
+	srcs = iter(srcs)
+	pending = {}
+
+	def submit(count):
+		for src in islice(srcs, count):
+			pending[executor.submit(func, src, *args)] = src
+
+	if threads:
+		executor = ThreadPoolExecutor(workers)
+	else:
+		executor = ProcessPoolExecutor(workers)
+	try:
+		# only keep a few jobs queued so srcs can be a lazy iterable
+		submit(workers * 2)
+		while pending:
+			done, _ = wait(pending, return_when=FIRST_COMPLETED)
+			submit(len(done))
+			for future in done:
+				src = pending.pop(future)
+				try:
+					result = future.result()
+				except Exception:
+					# a failing file doesn't stop the batch
+					result = None
+				yield src, result
+	finally:
+		for future in pending:
+			future.cancel()
+		executor.shutdown()
+
+
+def get_thumbnails(srcs, size=None, use_fail_appname=None, workers=None, threads=False):
+	"""Get the paths of the thumbnails of multiple files, creating them if necessary.
+
+	This is the batch version of :any:`get_thumbnail`: work is spread across a pool of
+	`workers` processes. Results are yielded as soon as they are ready, so they may come
+	in a different order than `srcs`.
+
+	Worker processes only see the module configuration (like ``THUMBNAILER_BACKENDS``)
+	that was set before the first result is requested, and only on platforms using
+	"fork" for starting processes.
+
+	With `threads`, a pool of threads is used instead. Libraries are not loaded again in
+	each worker and nothing is copied between processes, which suits long-running
+	applications. The PIL and Qt backends decode and resize images without holding the
+	GIL, and external commands run in parallel anyway, but the PythonMagick backend is
+	serialized.
+
+	:param srcs: paths of the source files. Can be any iterable, it is consumed lazily.
+	:param size: desired size of thumbnails, see :any:`get_thumbnail`.
+	:param use_fail_appname: app name to use when creating a failure info.
+	:type use_fail_appname: str
+	:param workers: number of worker processes. Defaults to the number of CPUs.
+	:type workers: int
+	:param threads: if True, use worker threads instead of processes.
+	:returns: an iterator of ``(src, thumbnail)`` tuples, `thumbnail` being None if it
+	          couldn't be generated, or if an error was raised for it
+	"""
+
+	return _iter_parallel(get_thumbnail, srcs, (size, use_fail_appname), workers, threads)
+
+
+def create_thumbnails(srcs, size, moreinfo=None, use_fail_appname=None, workers=None, threads=False):
+	"""Generate thumbnails for multiple files, even if the thumbnails existed.
+
+	This is the batch version of :any:`create_thumbnail`, see :any:`get_thumbnails` for
+	details about parallelism and order of results.
+
+	:param srcs: paths of the source files. Can be any iterable, it is consumed lazily.
+	:param size: desired size of thumbnails, see :any:`create_thumbnail`.
+	:param moreinfo: optional additional key/values metadata to store in the thumbnail files.
+	:type moreinfo: dict
+	:param use_fail_appname: app name to use when creating a failure info.
+	:type use_fail_appname: str
+	:param workers: number of worker processes. Defaults to the number of CPUs.
+	:type workers: int
+	:param threads: if True, use worker threads instead of processes.
+	:returns: an iterator of ``(src, thumbnail)`` tuples, `thumbnail` being None if it
+	          couldn't be generated, or if an error was raised for it
+	"""
+
+	return _iter_parallel(
+		create_thumbnail, srcs, (size, moreinfo, use_fail_appname), workers, threads
+	)
+
+
 def thumbnail_info(thumbnail):
-	return get_metadata_backend().get_info(thumbnail)
+	return _get_info(thumbnail)
 
 
 def select_thumbnailer_types(types):
@@ -1135,8 +3052,25 @@ def select_thumbnailer_types(types):
 	]
 
 
-def main():
-	output = get_thumbnail(sys.argv[1])
+_COMMANDS = {
+	'gc': ('store', 'gc_main'),
+	'serve': ('daemon', 'serve_main'),
+	'warm': ('warm', 'warm_main'),
+}
+
+
+def main(argv=None):
+	if argv is None:
+		argv = sys.argv[1:]
+
+	if argv and argv[0] in _COMMANDS:
+		import importlib
+
+		modname, funcname = _COMMANDS[argv[0]]
+		module = importlib.import_module('.%s' % modname, __name__)
+		return getattr(module, funcname)(argv[1:])
+
+	output = get_thumbnail(argv[0])
 	if output is None:
 		return 1
 	print(output)
@@ -0,0 +1,227 @@
+"""asyncio versions of the main `vignette` functions.
+
+These functions behave like their synchronous counterparts from :any:`vignette`, but do not
+block the event loop:
+
+* external thumbnailers (for example ``evince-thumbnailer`` or GNOME thumbnailers) are run
+  with :any:`asyncio.create_subprocess_exec`, and killed if they exceed the timeout of
+  their backend
+* work done by libraries (PIL, Qt, etc.) and file operations are run in :any:`EXECUTOR`
+
+At most :any:`MAX_CONCURRENCY` thumbnails are generated at the same time in an event loop,
+other calls wait for their turn.
+
+This module requires Python 3.7 or later.
+
+Example::
+
+  import vignette.aio
+
+  async def handler(request):
+    thumb = await vignette.aio.get_thumbnail(request.path)
+    ...
+"""
+
+import asyncio
+import functools
+import os
+import weakref
+
+import vignette
+
+
+__all__ = (
+	'get_thumbnail',
+	'try_get_thumbnail',
+	'create_thumbnail',
+	'put_thumbnail',
+)
+
+
+MAX_CONCURRENCY = os.cpu_count() or 1
+
+"""Maximum number of thumbnails generated concurrently, per event loop."""
+
+EXECUTOR = None
+
+"""Executor used for blocking work, None for the loop's default executor."""
+
+
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def _limit():
+	loop = asyncio.get_running_loop()
+	try:
+		return _semaphores[loop]
+	except KeyError:
+		semaphore = _semaphores[loop] = asyncio.Semaphore(MAX_CONCURRENCY)
+		return semaphore
+
+
+def _run_sync(func, *args, **kwargs):
+	loop = asyncio.get_running_loop()
+	return loop.run_in_executor(EXECUTOR, functools.partial(func, *args, **kwargs))
+
+
+async def _run_command(args, timeout=None):
+	try:
+		proc = await asyncio.create_subprocess_exec(
+			*args, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+			start_new_session=(os.name == 'posix'),
+		)
+	except OSError:
+		return
+
+	try:
+		output, _ = await asyncio.wait_for(proc.communicate(), timeout)
+	except asyncio.TimeoutError:
+		vignette._kill_group(proc)
+		await proc.wait()
+		return
+	except asyncio.CancelledError:
+		# the command would keep running, without timeout
+		vignette._kill_group(proc)
+		await proc.wait()
+		raise
+
+	if proc.returncode != 0:
+		return
+	return output
+
+
+async def _create_with_commands(backend, src, dest, size):
+	commands = backend.iter_commands(src, dest, size)
+	outputs = []
+	output = None
+
+	while True:
+		try:
+			args = commands.send(output)
+		except StopIteration:
+			break
+
+		output = await _run_command(args, backend.timeout)
+		if output is None:
+			commands.close()
+			return
+		outputs.append(output)
+
+	return backend.check_result(src, dest, size, outputs)
+
+
+async def try_get_thumbnail(src, size=None, mtime=None):
+	"""Get the path of the thumbnail or None if it doesn't exist.
+
+	See :any:`vignette.try_get_thumbnail`.
+	"""
+
+	return await _run_sync(vignette.try_get_thumbnail, src, size, mtime)
+
+
+async def put_thumbnail(src, size, thumb, mtime=None, moreinfo=None):
+	"""Put a thumbnail into the store.
+
+	See :any:`vignette.put_thumbnail`.
+	"""
+
+	return await _run_sync(vignette.put_thumbnail, src, size, thumb, mtime, moreinfo)
+
+
+async def create_thumbnail(src, size, moreinfo=None, use_fail_appname=None):
+	"""Generate a thumbnail for `src`, even if the thumbnail existed.
+
+	See :any:`vignette.create_thumbnail`.
+	"""
+
+	key = vignette.thumbnail_key(src)
+	src = key.src
+	size = vignette._any2size(size)[0]
+
+	async with _limit():
+		tmp = await _run_sync(vignette.create_temp, size)
+		info = await _run_sync(vignette._info_dict, moreinfo, src=src)
+		backends = await _run_sync(vignette._candidate_backends, src)
+
+		for backend in backends:
+			with vignette._stage('create', backend):
+				if isinstance(backend, vignette.CliMixin):
+					res = await _create_with_commands(backend, src, tmp, size)
+				else:
+					res = await _run_sync(vignette._thumbnail_with, backend, src, tmp, size, info)
+
+			dest = await _run_sync(vignette._store_created, key, size, tmp, backend, res, info)
+			if dest:
+				return dest
+			vignette._count('failure', backend)
+
+		vignette._count('failure')
+		if use_fail_appname is not None:
+			await _run_sync(vignette.put_fail, key, use_fail_appname)
+
+
+async def get_thumbnail(src, size=None, use_fail_appname=None):
+	"""Get the path of the thumbnail and create it if necessary.
+
+	See :any:`vignette.get_thumbnail`.
+	"""
+
+	src = vignette.thumbnail_key(src)
+	thumb = await try_get_thumbnail(src, size)
+	if thumb is not None:
+		return thumb
+
+	if use_fail_appname is not None:
+		if await _run_sync(vignette.is_thumbnail_failed, src, use_fail_appname):
+			vignette._count('fail_file')
+			return None
+
+	if size is None:
+		size = 'large'
+	if vignette.LOCK_GENERATION:
+		return await _create_once(src, size, use_fail_appname)
+	return await create_thumbnail(src, size, use_fail_appname=use_fail_appname)
+
+
+_RETRY = object()
+
+_flights = weakref.WeakKeyDictionary()
+
+
+async def _create_once(src, size, use_fail_appname=None):
+	# see vignette._create_once
+	loop = asyncio.get_running_loop()
+	flights = _flights.setdefault(loop, {})
+	key = (vignette._any2uri(src), vignette._any2size(size)[1])
+
+	while key in flights:
+		result = await asyncio.shield(flights[key])
+		if result is not _RETRY:
+			return result
+
+	flight = flights[key] = loop.create_future()
+	try:
+		lock = vignette._ThumbnailLock(*key)
+		acquiring = _run_sync(lock.acquire, vignette.LOCK_TIMEOUT)
+		try:
+			locked = await asyncio.shield(acquiring)
+		except asyncio.CancelledError:
+			# the thread will acquire it anyway
+			acquiring.add_done_callback(lambda _: lock.release())
+			raise
+
+		try:
+			thumb = None
+			if locked and lock.contended:
+				thumb = await try_get_thumbnail(src, size)
+			if thumb is None:
+				thumb = await create_thumbnail(src, size, use_fail_appname=use_fail_appname)
+		finally:
+			await _run_sync(lock.release)
+
+		flight.set_result(thumb)
+		return thumb
+	finally:
+		del flights[key]
+		if not flight.done():
+			flight.set_result(_RETRY)
@@ -0,0 +1,242 @@
+"""Benchmarks of the hot paths of vignette.
+
+A synthetic thumbnail store and source files are built in a temporary ``XDG_CACHE_HOME``,
+then each operation is timed repeatedly::
+
+  python -m vignette.bench --count 2000 --output before.json
+
+Benchmarks are:
+
+* ``put_thumbnail``: filling the store with `count` thumbnails
+* ``put_fail``: creating fail-files for half of the sources
+* ``try_get_thumbnail_hit`` and ``try_get_thumbnail_miss``: looking up existing and missing
+  thumbnails
+* ``is_thumbnail_failed_hit`` and ``is_thumbnail_failed_miss``
+* ``create_thumbnail_<backend>``: generating a thumbnail of a bigger image, with each available
+  image backend
+* ``scan_store``: reading the metadata of the whole store, like ``tools/thumbnails_lint.py``
+
+Results are printed as JSON: for each benchmark the number of operations, throughput,
+latency percentiles in milliseconds, and the peak memory (RSS) of the process so far, in
+kilobytes. Images are generated without any imaging library, so the results only depend on
+vignette and the backends measured.
+
+This module requires Python 3.
+"""
+
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+import vignette
+
+
+__all__ = (
+	'BACKENDS',
+	'percentile',
+	'run_benchmarks',
+	'summarize',
+	'write_png',
+)
+
+
+BACKENDS = {
+	'pil': vignette.PilBackend,
+	'qt': vignette.QtBackend,
+	'magick': vignette.MagickBackend,
+}
+
+"""Image backends benchmarked by default, by name."""
+
+
+def write_png(path, width, height):
+	"""Write an RGB gradient PNG image of `width` x `height` pixels."""
+
+	rows = []
+	for y in range(height):
+		green = y * 255 // height
+		row = bytearray(1 + width * 3)
+		row[1::3] = bytes(x * 255 // width for x in range(width))
+		row[2::3] = bytes([green]) * width
+		row[3::3] = bytes([128]) * width
+		rows.append(bytes(row))
+
+	with open(path, 'wb') as fd:
+		fd.write(b'\x89PNG\r\n\x1a\n')
+		fd.write(vignette._png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+		fd.write(vignette._png_chunk(b'IDAT', zlib.compress(b''.join(rows))))
+		fd.write(vignette._png_chunk(b'IEND', b''))
+
+
+def percentile(values, pct):
+	"""Get the `pct` percentile of sorted `values`, by nearest rank."""
+	index = max(0, min(len(values) - 1, int(round(pct / 100. * len(values))) - 1))
+	return values[index]
+
+
+def _peak_rss():
+	try:
+		import resource
+	except ImportError:
+		return None
+	# kilobytes on Linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def summarize(times):
+	"""Summarize durations in seconds of single operations.
+
+	:returns: a dict of count, throughput and latency percentiles
+	"""
+
+	times = sorted(times)
+	total = sum(times)
+	return {
+		'count': len(times),
+		'ops_per_s': len(times) / total if total else None,
+		'p50_ms': percentile(times, 50) * 1000,
+		'p90_ms': percentile(times, 90) * 1000,
+		'p99_ms': percentile(times, 99) * 1000,
+		'max_ms': times[-1] * 1000,
+		'peak_rss_kb': _peak_rss(),
+	}
+
+
+def _time_each(func, args_list):
+	times = []
+	for args in args_list:
+		start = time.perf_counter()
+		func(*args)
+		times.append(time.perf_counter() - start)
+	return summarize(times)
+
+
+def run_benchmarks(count=1000, runs=5, backends=None, size=(1024, 768)):
+	"""Run all benchmarks in a temporary store.
+
+	The module configuration (``XDG_CACHE_HOME``, ``THUMBNAILER_BACKENDS``) is restored
+	afterwards.
+
+	:param count: number of source files and thumbnails in the store
+	:param runs: number of thumbnails generated with each backend
+	:param backends: names of the backends to benchmark in :any:`BACKENDS`, by default all
+	                 available ones
+	:param size: ``(width, height)`` of the image thumbnailed by backends
+	:returns: a dict of results by benchmark name
+	"""
+
+	from vignette import store
+
+	if backends is None:
+		backends = sorted(BACKENDS)
+
+	tmpdir = tempfile.mkdtemp()
+	old_cache = os.environ.get('XDG_CACHE_HOME')
+	old_backends = vignette.THUMBNAILER_BACKENDS
+	os.environ['XDG_CACHE_HOME'] = os.path.join(tmpdir, 'cache')
+	results = {}
+	try:
+		srcdir = os.path.join(tmpdir, 'sources')
+		os.mkdir(srcdir)
+		template = os.path.join(tmpdir, 'thumbnail.png')
+		write_png(template, 256, 192)
+		write_png(os.path.join(srcdir, 'source.png'), 64, 48)
+		srcs = []
+		for n in range(count):
+			src = os.path.join(srcdir, '%06d.png' % n)
+			shutil.copyfile(os.path.join(srcdir, 'source.png'), src)
+			srcs.append(src)
+
+		vignette.makedirs()
+		tmps = []
+		for src in srcs:
+			tmp = vignette.create_temp('large')
+			shutil.copyfile(template, tmp)
+			tmps.append((src, 'large', tmp))
+		results['put_thumbnail'] = _time_each(vignette.put_thumbnail, tmps)
+
+		failed = srcs[::2]
+		results['put_fail'] = _time_each(vignette.put_fail, [(src, 'bench') for src in failed])
+
+		results['try_get_thumbnail_hit'] = _time_each(
+			vignette.try_get_thumbnail, [(src, 'large') for src in srcs]
+		)
+		results['try_get_thumbnail_miss'] = _time_each(
+			vignette.try_get_thumbnail, [(src, 'normal') for src in srcs]
+		)
+		results['is_thumbnail_failed_hit'] = _time_each(
+			vignette.is_thumbnail_failed, [(src, 'bench') for src in failed]
+		)
+		results['is_thumbnail_failed_miss'] = _time_each(
+			vignette.is_thumbnail_failed, [(src, 'bench') for src in srcs[1::2]]
+		)
+
+		image = os.path.join(srcdir, 'image.png')
+		write_png(image, size[0], size[1])
+		for name in backends:
+			backend = BACKENDS[name]()
+			if not backend.is_available():
+				results['create_thumbnail_%s' % name] = None
+				continue
+			vignette.THUMBNAILER_BACKENDS = [backend]
+			results['create_thumbnail_%s' % name] = _time_each(
+				vignette.create_thumbnail, [(image, 'large')] * runs
+			)
+
+		start = time.perf_counter()
+		records = sum(1 for _ in store.scan_store())
+		elapsed = time.perf_counter() - start
+		results['scan_store'] = {
+			'count': records,
+			'ops_per_s': records / elapsed if elapsed else None,
+			'total_ms': elapsed * 1000,
+			'peak_rss_kb': _peak_rss(),
+		}
+	finally:
+		vignette.THUMBNAILER_BACKENDS = old_backends
+		if old_cache is None:
+			del os.environ['XDG_CACHE_HOME']
+		else:
+			os.environ['XDG_CACHE_HOME'] = old_cache
+		shutil.rmtree(tmpdir)
+
+	return results
+
+
+def main(argv=None):
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		prog='python -m vignette.bench',
+		description='Benchmark lookup, generation and store maintenance',
+	)
+	parser.add_argument('-n', '--count', type=int, default=1000, help='number of thumbnails in the store')
+	parser.add_argument('--runs', type=int, default=5, help='number of thumbnails generated per backend')
+	parser.add_argument(
+		'--backend', action='append', choices=sorted(BACKENDS), dest='backends',
+		help='backend to benchmark, can be repeated (default: all)'
+	)
+	parser.add_argument('-o', '--output', help='write results to this file instead of stdout')
+	args = parser.parse_args(argv)
+
+	results = {
+		'python': sys.version.split()[0],
+		'vignette': vignette.__version__,
+		'count': args.count,
+		'results': run_benchmarks(args.count, args.runs, args.backends),
+	}
+	text = json.dumps(results, indent=2, sort_keys=True)
+	if args.output:
+		with open(args.output, 'w') as fd:
+			fd.write(text + '\n')
+	else:
+		print(text)
+
+
+if __name__ == '__main__':
+	sys.exit(main() or 0)
@@ -0,0 +1,374 @@
+"""Thumbnail generation daemon, and its client.
+
+Short-lived processes pay the cost of importing libraries and probing backends each time they
+generate a thumbnail, and can't share a queue of thumbnails to generate. The daemon, started
+with::
+
+  python -m vignette serve
+
+keeps a pool of worker processes with backends loaded, and generates thumbnails for clients
+connecting to a Unix socket. Concurrent requests for the same thumbnail are generated once.
+
+Applications can then forward generation to the daemon, when it runs::
+
+  import vignette
+
+  vignette.USE_DAEMON = True
+  thumb = vignette.get_thumbnail('/my/file.jpg')  # generated by the daemon
+
+If the daemon is not running, uses another thumbnail store or fails, thumbnails are generated
+locally as usual. If a worker process of the daemon dies (for example a decoder crashes), the
+request fails and the workers are started again.
+
+Protocol
+========
+
+Clients send requests as JSON objects, one per line, and receive one response line per
+request, in order. A request has a ``method`` and ``params``, a response has either a
+``result`` or an ``error`` (a string)::
+
+  {"method": "get_thumbnail", "params": {"src": "/my/file.jpg", "size": "large"}}
+  {"result": "/home/me/.cache/thumbnails/large/0123456789abcdef0123456789abcdef.png"}
+
+Methods are:
+
+* ``ping``: returns the path of the thumbnail store used by the daemon
+* ``get_thumbnail``, ``create_thumbnail``, ``try_get_thumbnail``: like the functions of
+  :any:`vignette`, with the same parameters
+* ``get_thumbnails``: params ``srcs`` (a list), ``size`` and ``use_fail_appname``, returns a
+  list of thumbnails (or None) in the order of ``srcs``
+
+Paths must be absolute. Requests can carry a ``store`` param, the path of the thumbnail
+store of the client: if it's not the one of the daemon, the request fails with error
+``"store"``.
+
+This module requires Python 3.7 or later and Unix sockets.
+"""
+
+import json
+import os
+import socket
+import stat
+import sys
+import threading
+
+import vignette
+
+
+__all__ = (
+	'DaemonError',
+	'DaemonUnavailable',
+	'ThumbnailServer',
+	'call',
+	'default_socket_path',
+)
+
+
+SOCKET_PATH = None
+
+"""Path of the daemon's socket, None for :any:`default_socket_path`."""
+
+TIMEOUT = 60
+
+"""Time in seconds to wait for the daemon to accept a connection, or to answer a request,
+before giving up with :any:`DaemonUnavailable`. None to wait forever."""
+
+
+class DaemonError(Exception):
+	"""The daemon failed to process a request."""
+
+
+class DaemonUnavailable(DaemonError):
+	"""The daemon is not running, or can't serve this client."""
+
+
+def default_socket_path():
+	"""Get the default path of the daemon's socket, in ``$XDG_RUNTIME_DIR`` if set."""
+
+	runtime = os.environ.get('XDG_RUNTIME_DIR')
+	if runtime:
+		return os.path.join(runtime, 'vignette.sock')
+
+	import tempfile
+
+	return os.path.join(tempfile.gettempdir(), 'vignette-%d.sock' % os.getuid())
+
+
+def _socket_path(path=None):
+	return path or SOCKET_PATH or default_socket_path()
+
+
+def _encode(obj):
+	# non-UTF-8 file names are passed as surrogates, escaped by json
+	return json.dumps(obj).encode('ascii') + b'\n'
+
+
+def call(method, path=None, **params):
+	"""Send a request to the daemon and return its result.
+
+	:param method: see the protocol in the module documentation
+	:param path: path of the daemon's socket, by default :any:`SOCKET_PATH`
+	:raises DaemonUnavailable: if the daemon is not running, doesn't answer within
+	                           :any:`TIMEOUT`, or uses another thumbnail store
+	:raises DaemonError: if the request failed
+	"""
+
+	params.setdefault('store', vignette._thumb_path_prefix())
+
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	sock.settimeout(TIMEOUT)
+	try:
+		try:
+			sock.connect(_socket_path(path))
+		except OSError as exc:
+			raise DaemonUnavailable('daemon not running: %s' % exc)
+
+		try:
+			sock.sendall(_encode({'method': method, 'params': params}))
+			with sock.makefile('rb') as fd:
+				line = fd.readline()
+		except socket.timeout:
+			raise DaemonUnavailable('daemon did not answer in time')
+		except OSError as exc:
+			raise DaemonUnavailable('daemon connection failed: %s' % exc)
+	finally:
+		sock.close()
+
+	if not line:
+		raise DaemonUnavailable('daemon closed the connection')
+
+	response = json.loads(line.decode('ascii'))
+	error = response.get('error')
+	if error == 'store':
+		raise DaemonUnavailable('daemon uses another thumbnail store')
+	elif error is not None:
+		raise DaemonError(error)
+	return response.get('result')
+
+
+def _init_worker():
+	# workers generate thumbnails themselves, instead of asking the daemon
+	vignette.USE_DAEMON = False
+
+	# load backends once per worker process
+	vignette.BACKEND_REGISTRY.available(vignette.THUMBNAILER_BACKENDS)
+	vignette.get_metadata_backend()
+
+
+class ThumbnailServer(object):
+	"""Daemon generating thumbnails for clients of a Unix socket.
+
+	:param path: path of the socket, by default :any:`SOCKET_PATH`
+	:param workers: number of worker processes generating thumbnails, by default the
+	                number of CPUs
+	"""
+
+	def __init__(self, path=None, workers=None):
+		self.path = _socket_path(path)
+		self.workers = workers
+		self.store = vignette._thumb_path_prefix()
+		self._executor = None
+		self._server = None
+		self._inflight = {}
+		self._lock = threading.RLock()
+
+	def _check_socket(self):
+		try:
+			st = os.lstat(self.path)
+		except FileNotFoundError:
+			return
+		if not stat.S_ISSOCK(st.st_mode):
+			raise DaemonError('%s exists and is not a socket' % self.path)
+
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.settimeout(TIMEOUT)
+		try:
+			sock.connect(self.path)
+		except socket.timeout:
+			raise DaemonError('a daemon is listening on %s, but not accepting connections' % self.path)
+		except OSError:
+			# left by a daemon which died
+			os.remove(self.path)
+		else:
+			raise DaemonError('a daemon is already listening on %s' % self.path)
+		finally:
+			sock.close()
+
+	def start(self):
+		"""Create the socket and the worker processes."""
+		import socketserver
+
+		server = self
+
+		class Handler(socketserver.StreamRequestHandler):
+			def handle(self):
+				for line in self.rfile:
+					self.wfile.write(_encode(server.handle(line)))
+					self.wfile.flush()
+
+		class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+			daemon_threads = True
+
+		self._check_socket()
+		self._executor = self._new_executor()
+
+		# only the user can connect
+		umask = os.umask(0o177)
+		try:
+			self._server = Server(self.path, Handler)
+		finally:
+			os.umask(umask)
+
+	def serve_forever(self):
+		"""Serve requests until :any:`shutdown` is called."""
+		if self._server is None:
+			self.start()
+		self._server.serve_forever()
+
+	def shutdown(self):
+		"""Stop serving, from another thread than the one running :any:`serve_forever`."""
+		self._server.shutdown()
+
+	def close(self):
+		"""Remove the socket and stop the worker processes."""
+		if self._server is not None:
+			self._server.server_close()
+			try:
+				os.remove(self.path)
+			except OSError:
+				pass
+			self._server = None
+
+		if self._executor is not None:
+			self._executor.shutdown()
+			self._executor = None
+
+	def handle(self, line):
+		"""Process a request line and return the response object."""
+		try:
+			request = json.loads(line.decode('ascii'))
+			method = request['method']
+			params = request.get('params') or {}
+		except (ValueError, KeyError, TypeError) as exc:
+			return {'error': 'invalid request: %s' % exc}
+
+		store = params.pop('store', None)
+		if store is not None and store != self.store:
+			return {'error': 'store'}
+
+		func = getattr(self, 'do_%s' % method, None)
+		if func is None:
+			return {'error': 'unknown method %r' % method}
+
+		try:
+			return {'result': func(**params)}
+		except Exception as exc:
+			return {'error': '%s: %s' % (type(exc).__name__, exc)}
+
+	def _new_executor(self):
+		from concurrent.futures import ProcessPoolExecutor
+
+		return ProcessPoolExecutor(self.workers, initializer=_init_worker)
+
+	def _restart(self, executor):
+		# a worker killed (crashing decoder, out of memory) breaks the whole pool
+		with self._lock:
+			if self._executor is executor:
+				self._executor = self._new_executor()
+			new = self._executor
+		executor.shutdown(wait=False)
+		return new
+
+	def _run(self, func, *args):
+		from concurrent.futures.process import BrokenProcessPool
+
+		def check(future):
+			if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+				self._restart(executor)
+
+		with self._lock:
+			executor = self._executor
+			try:
+				future = executor.submit(func, *args)
+			except BrokenProcessPool:
+				executor = self._restart(executor)
+				future = executor.submit(func, *args)
+		future.add_done_callback(check)
+		return future
+
+	def _submit(self, func, src, size, *args):
+		# a single generation per thumbnail, shared by concurrent requests
+		key = (func.__name__, vignette._any2uri(src), vignette._any2size(size)[1])
+
+		with self._lock:
+			future = self._inflight.get(key)
+			if future is None:
+				future = self._inflight[key] = self._run(func, src, size, *args)
+				future.add_done_callback(lambda _: self._forget(key))
+		return future
+
+	def _forget(self, key):
+		with self._lock:
+			self._inflight.pop(key, None)
+
+	def do_ping(self):
+		return self.store
+
+	def do_try_get_thumbnail(self, src, size=None, mtime=None):
+		return vignette.try_get_thumbnail(src, size, mtime)
+
+	def do_get_thumbnail(self, src, size=None, use_fail_appname=None):
+		thumb = vignette.try_get_thumbnail(src, size)
+		if thumb is not None:
+			return thumb
+
+		if size is None:
+			size = 'large'
+		return self._submit(vignette.get_thumbnail, src, size, use_fail_appname).result()
+
+	def do_create_thumbnail(self, src, size, moreinfo=None, use_fail_appname=None):
+		return self._run(vignette.create_thumbnail, src, size, moreinfo, use_fail_appname).result()
+
+	def do_get_thumbnails(self, srcs, size=None, use_fail_appname=None):
+		results = {}
+		futures = []
+		for src in srcs:
+			results[src] = vignette.try_get_thumbnail(src, size)
+			if results[src] is None:
+				futures.append((src, self._submit(vignette.get_thumbnail, src, size or 'large', use_fail_appname)))
+
+		for src, future in futures:
+			results[src] = future.result()
+		return [results[src] for src in srcs]
+
+
+def serve_main(argv):
+	import argparse
+	import signal
+
+	parser = argparse.ArgumentParser(
+		prog='vignette serve',
+		description='Generate thumbnails for clients connecting to a Unix socket',
+	)
+	parser.add_argument('--socket', help='path of the socket (default: %s)' % _socket_path())
+	parser.add_argument('--workers', type=int, help='number of worker processes')
+	args = parser.parse_args(argv)
+
+	server = ThumbnailServer(args.socket, args.workers)
+	try:
+		server.start()
+	except DaemonError as exc:
+		print(exc, file=sys.stderr)
+		return 1
+
+	def stop(signum, frame):
+		# shutdown() waits for serve_forever() to return, from another thread
+		threading.Thread(target=server.shutdown).start()
+
+	signal.signal(signal.SIGTERM, stop)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.close()
@@ -0,0 +1,215 @@
+"""On-disk index of the thumbnail store, shared by processes.
+
+Checking if a thumbnail is valid requires reading its metadata. :any:`StoreIndex` keeps the
+metadata of thumbnails and fail-files in an SQLite database (in WAL mode, so processes can
+read it while another writes) in the store directory, along with the file status of each
+thumbnail when it was indexed. A validity check is then answered with a ``stat()`` of the
+thumbnail, without opening it.
+
+The index is only a cache: a thumbnail changed or removed by an application not using it has
+a different file status, so it is read again and its entry is repaired.
+
+To enable it, set the ``STORE_INDEX`` attribute of :any:`vignette`::
+
+  import vignette
+  from vignette.index import StoreIndex
+
+  vignette.STORE_INDEX = StoreIndex()
+
+The existing thumbnails can be indexed at once with :any:`StoreIndex.rebuild`, else they are
+indexed when they are first checked.
+
+This module requires Python 3.
+"""
+
+import os
+import sqlite3
+import threading
+
+import vignette
+
+
+__all__ = (
+	'INDEX_FILE',
+	'StoreIndex',
+)
+
+
+INDEX_FILE = '.vignette-index.sqlite'
+
+"""Name of the index file, in the store directory."""
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS thumbnails (
+	name TEXT PRIMARY KEY,
+	uri TEXT NOT NULL,
+	mtime INTEGER NOT NULL,
+	ino INTEGER NOT NULL,
+	file_size INTEGER NOT NULL,
+	file_mtime INTEGER NOT NULL
+) WITHOUT ROWID
+'''
+
+
+class StoreIndex(object):
+	"""Index of the metadata of the thumbnails in the store.
+
+	Entries are keyed by the path of the thumbnail relative to the store, for example
+	``large/<md5>.png`` or ``fail/<appname>/<md5>.png``. Instances can be used by several
+	threads. Errors of the database (for example if it is locked for too long) are not
+	raised, the thumbnails are read instead. If the index can't be opened at all (for
+	example if the store is not writable), it is disabled.
+
+	:param root: thumbnail store directory, by default the user's one
+	:param timeout: how long to wait for another process writing to the index, in seconds
+	:ivar hits: number of checks answered by the index
+	:ivar misses: number of checks of thumbnails not indexed or changed since indexed
+	:ivar error: the error which disabled the index, None if it is enabled
+	"""
+
+	def __init__(self, root=None, timeout=5):
+		if root is None:
+			root = vignette._thumb_path_prefix()
+		self.root = root
+		self.path = os.path.join(root, INDEX_FILE)
+		self.timeout = timeout
+		self.hits = 0
+		self.misses = 0
+		self.error = None
+		self._local = threading.local()
+
+	def _connect(self):
+		# raises sqlite3.Error if the index is disabled
+		local = self._local
+		if getattr(local, 'pid', None) != os.getpid():
+			if self.error is not None:
+				raise sqlite3.OperationalError('index disabled: %s' % self.error)
+
+			# connections can't be used by other threads, nor after a fork
+			try:
+				vignette._makedir(self.root)
+				conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+				conn.execute('PRAGMA journal_mode=WAL')
+				# in WAL mode, commits are still atomic without syncing
+				conn.execute('PRAGMA synchronous=NORMAL')
+				conn.execute(SCHEMA)
+			except (OSError, sqlite3.Error) as exc:
+				self.error = exc
+				raise sqlite3.OperationalError('index disabled: %s' % exc)
+			local.conn = conn
+			local.pid = os.getpid()
+		return local.conn
+
+	def _name(self, path):
+		prefix = self.root + os.sep
+		if path.startswith(prefix):
+			return path[len(prefix):]
+
+	@staticmethod
+	def _stat_key(st):
+		return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+	def is_valid(self, path, uri, mtime):
+		"""Check a thumbnail with the index.
+
+		:param path: path of the thumbnail or fail-file
+		:returns: True or False if the index knows the thumbnail is valid or not, None if it
+		          doesn't know, because the thumbnail is not indexed or changed since
+		"""
+
+		name = self._name(path)
+		if name is None:
+			return None
+
+		try:
+			row = self._connect().execute(
+				'SELECT uri, mtime, ino, file_size, file_mtime FROM thumbnails WHERE name = ?',
+				(name,)
+			).fetchone()
+		except sqlite3.Error:
+			return None
+
+		if row is None:
+			self.misses += 1
+			return None
+
+		try:
+			st = os.stat(path)
+		except OSError:
+			self.forget(path)
+			return False
+
+		if self._stat_key(st) != tuple(row[2:]):
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		return row[0] == uri and row[1] == int(float(mtime))
+
+	def update(self, path, uri, mtime):
+		"""Index the thumbnail at `path`, generated for `uri` at `mtime`."""
+
+		name = self._name(path)
+		if name is None:
+			return
+
+		try:
+			st = os.stat(path)
+		except OSError:
+			self.forget(path)
+			return
+
+		try:
+			self._connect().execute(
+				'INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?, ?, ?)',
+				(name, uri, int(float(mtime))) + self._stat_key(st)
+			)
+		except sqlite3.Error:
+			pass
+
+	def forget(self, path):
+		"""Remove the entry of the thumbnail at `path`."""
+
+		name = self._name(path)
+		if name is None:
+			return
+
+		try:
+			self._connect().execute('DELETE FROM thumbnails WHERE name = ?', (name,))
+		except sqlite3.Error:
+			pass
+
+	def __len__(self):
+		return self._connect().execute('SELECT COUNT(*) FROM thumbnails').fetchone()[0]
+
+	def clear(self):
+		"""Remove all entries and reset counters."""
+		self._connect().execute('DELETE FROM thumbnails')
+		self.hits = self.misses = 0
+
+	def rebuild(self, workers=None):
+		"""Index all thumbnails and fail-files of the store, replacing existing entries.
+
+		:param workers: if not None, number of threads reading thumbnails in parallel
+		:returns: the number of indexed thumbnails
+		"""
+
+		from vignette import store
+
+		rows = []
+		for record in store.scan_store(self.root, workers=workers):
+			if not (record.hash and record.uri and record.mtime is not None):
+				continue
+			try:
+				st = os.stat(record.path)
+			except OSError:
+				continue
+			rows.append((self._name(record.path), record.uri, record.mtime) + self._stat_key(st))
+
+		conn = self._connect()
+		with conn:
+			conn.execute('BEGIN')
+			conn.execute('DELETE FROM thumbnails')
+			conn.executemany('INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?, ?, ?)', rows)
+		return len(rows)
@@ -0,0 +1,279 @@
+"""Generate thumbnails in the background, most urgent first.
+
+:any:`get_thumbnail` blocks until the thumbnail is generated, and a batch like
+:any:`get_thumbnails` handles files in the order it is given. Interactive applications need
+more control: the files the user is looking at should be thumbnailed before files of a
+background scan, and requests for files which scrolled out of view should be dropped.
+
+:any:`ThumbnailScheduler` queues requests with a priority, and generates them in worker
+threads (or processes), lowest priority value first. Each request gets a
+:any:`concurrent.futures.Future`, which is also the handle to change its priority or to
+cancel it while it is queued::
+
+  from vignette.scheduler import ThumbnailScheduler, PRIORITY_BACKGROUND, PRIORITY_FOREGROUND
+
+  scheduler = ThumbnailScheduler()
+  futures = [scheduler.submit(path, priority=PRIORITY_BACKGROUND) for path in all_files]
+  ...
+  scheduler.set_priority(futures[42], PRIORITY_FOREGROUND)  # now visible
+  scheduler.cancel(futures[0])  # not needed anymore
+  futures[42].add_done_callback(lambda future: display(future.result()))
+
+This module requires Python 3.
+"""
+
+from concurrent.futures import Future
+import heapq
+import itertools
+import threading
+
+import vignette
+
+
+__all__ = (
+	'PRIORITY_BACKGROUND',
+	'PRIORITY_DEFAULT',
+	'PRIORITY_FOREGROUND',
+	'ThumbnailScheduler',
+)
+
+
+PRIORITY_FOREGROUND = 0
+
+"""Priority of thumbnails the user is waiting for."""
+
+PRIORITY_DEFAULT = 10
+
+PRIORITY_BACKGROUND = 20
+
+"""Priority of thumbnails generated in advance, for example by a scan."""
+
+
+class _Request(object):
+	def __init__(self, key, src, size, use_fail_appname):
+		self.key = key
+		self.src = src
+		self.size = size
+		self.use_fail_appname = use_fail_appname
+		self.future = Future()
+		# current entry in the heap
+		self.entry = None
+
+
+class ThumbnailScheduler(object):
+	"""Queue of thumbnails to generate, by priority.
+
+	Requests with lower priority values are generated first, requests of the same priority
+	in submission order. Priorities are integers, see :any:`PRIORITY_FOREGROUND`,
+	:any:`PRIORITY_DEFAULT` and :any:`PRIORITY_BACKGROUND`.
+
+	Thumbnails are generated with :any:`vignette.get_thumbnail`, so existing valid
+	thumbnails are returned without being generated again.
+
+	:param workers: number of thumbnails generated at the same time, by default the number
+	                of CPUs
+	:param processes: if True, thumbnails are generated in worker processes instead of
+	                  threads
+	"""
+
+	def __init__(self, workers=None, processes=False):
+		if workers is None:
+			from multiprocessing import cpu_count
+
+			workers = cpu_count()
+
+		self.workers = workers
+		self.processes = processes
+		self._heap = []
+		self._requests = {}
+		self._futures = {}
+		self._counter = itertools.count()
+		self._cond = threading.Condition()
+		self._threads = []
+		self._executor = None
+		self._closed = False
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.shutdown()
+
+	def __len__(self):
+		"""Number of queued requests, not running yet."""
+		with self._cond:
+			return len(self._requests)
+
+	def _start(self):
+		# called with the lock held
+		if self._threads:
+			return
+
+		if self.processes:
+			from concurrent.futures import ProcessPoolExecutor
+
+			self._executor = ProcessPoolExecutor(self.workers)
+
+		for _ in range(self.workers):
+			thread = threading.Thread(target=self._work)
+			thread.daemon = True
+			thread.start()
+			self._threads.append(thread)
+
+	def _push(self, request, priority):
+		# called with the lock held
+		if request.entry is not None:
+			# lazily removed from the heap
+			request.entry[-1] = None
+		request.entry = [priority, next(self._counter), request]
+		heapq.heappush(self._heap, request.entry)
+
+	def submit(self, src, size=None, priority=PRIORITY_DEFAULT, use_fail_appname=None):
+		"""Queue a thumbnail to generate.
+
+		If the same thumbnail is already queued, its future is returned, and its priority
+		raised to `priority` if it was lower.
+
+		:param src: path of the source file, see :any:`vignette.get_thumbnail`
+		:param size: desired size of thumbnail, 'large' if None
+		:param priority: lower values are generated first
+		:param use_fail_appname: app name to use when creating a failure info
+		:returns: a :any:`concurrent.futures.Future` of the path of the thumbnail, or None
+		          if it couldn't be generated
+		"""
+
+		if size is None:
+			size = 'large'
+		thumbnail_key = vignette.thumbnail_key(src)
+		key = (thumbnail_key.uri, vignette._any2size(size)[1])
+
+		with self._cond:
+			if self._closed:
+				raise RuntimeError('cannot submit after shutdown')
+
+			request = self._requests.get(key)
+			if request is not None and not request.future.cancelled():
+				if priority < request.entry[0]:
+					self._push(request, priority)
+				return request.future
+
+			request = self._requests[key] = _Request(key, thumbnail_key, size, use_fail_appname)
+			self._futures[request.future] = request
+			# the future can also be cancelled directly
+			request.future.add_done_callback(self._done)
+			self._push(request, priority)
+			self._start()
+			self._cond.notify()
+		return request.future
+
+	def set_priority(self, future, priority):
+		"""Change the priority of a queued request.
+
+		:param future: as returned by :any:`submit`
+		:returns: False if the request is not queued anymore (running, done or cancelled)
+		"""
+		with self._cond:
+			request = self._futures.get(future)
+			if request is None or future.cancelled():
+				return False
+			self._push(request, priority)
+			return True
+
+	def cancel(self, future):
+		"""Remove a request from the queue.
+
+		:param future: as returned by :any:`submit`
+		:returns: False if the request was not queued anymore (running or done)
+		"""
+		with self._cond:
+			if future not in self._futures:
+				return False
+			# removed from the queue by _done
+			return future.cancel()
+
+	def cancel_all(self, min_priority=None):
+		"""Remove queued requests, of priority value `min_priority` or higher if given.
+
+		:returns: the number of cancelled requests
+		"""
+		with self._cond:
+			requests = [
+				request for request in self._requests.values()
+				if min_priority is None or request.entry[0] >= min_priority
+			]
+			for request in requests:
+				request.future.cancel()
+				self._forget(request)
+			return len(requests)
+
+	def _done(self, future):
+		if not future.cancelled():
+			return
+		with self._cond:
+			request = self._futures.get(future)
+			if request is not None:
+				self._forget(request)
+
+	def _forget(self, request):
+		# called with the lock held, can be called twice for a request
+		if self._requests.get(request.key) is request:
+			del self._requests[request.key]
+		self._futures.pop(request.future, None)
+		if request.entry is not None:
+			request.entry[-1] = None
+
+	def _next(self):
+		with self._cond:
+			while True:
+				while self._heap:
+					request = heapq.heappop(self._heap)[-1]
+					if request is not None:
+						self._forget(request)
+						return request
+				if self._closed:
+					return None
+				self._cond.wait()
+
+	def _work(self):
+		while True:
+			request = self._next()
+			if request is None:
+				return
+
+			future = request.future
+			if not future.set_running_or_notify_cancel():
+				continue
+
+			try:
+				result = self._generate(request)
+			except BaseException as exc:
+				future.set_exception(exc)
+			else:
+				future.set_result(result)
+
+	def _generate(self, request):
+		if self._executor is not None:
+			return self._executor.submit(
+				vignette.get_thumbnail, request.src.src, request.size, request.use_fail_appname
+			).result()
+		return vignette.get_thumbnail(request.src, request.size, request.use_fail_appname)
+
+	def shutdown(self, wait=True, cancel_pending=False):
+		"""Stop the workers once the queue is empty.
+
+		:param wait: if True, wait until the workers stopped
+		:param cancel_pending: if True, cancel queued requests instead of generating them
+		"""
+		with self._cond:
+			self._closed = True
+			if cancel_pending:
+				for request in list(self._requests.values()):
+					request.future.cancel()
+					self._forget(request)
+			self._cond.notify_all()
+
+		if wait:
+			for thread in self._threads:
+				thread.join()
+			if self._executor is not None:
+				self._executor.shutdown()
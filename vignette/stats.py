@@ -0,0 +1,151 @@
+"""Time spent in each stage of thumbnail lookup and generation.
+
+When the ``STATS`` attribute of :any:`vignette` is set to a :any:`Stats` instance, vignette
+records how long each stage takes, and counts the outcomes of lookups and generations::
+
+  import vignette
+  from vignette.stats import Stats
+
+  vignette.STATS = Stats()
+  ...
+  for row in vignette.STATS.snapshot()['timings']:
+    print(row['stage'], row['backend'], row['count'], row['total_s'])
+
+Stages are:
+
+* ``key``: computing the URI and hash of a source file
+* ``get_info``: reading the metadata of a thumbnail to check it
+* ``sniff``: guessing the MIME type of a source file
+* ``create``: generating a thumbnail, by backend
+* ``update_metadata``: writing the metadata into a generated thumbnail
+* ``install``: moving a thumbnail to its final place in the store
+
+Events counted are:
+
+* ``hit``: a valid thumbnail was found by :any:`vignette.try_get_thumbnail`
+* ``miss``: no thumbnail was found
+* ``stale``: a thumbnail was found, but obsolete or invalid
+* ``failure``: generation failed, by backend, and without backend if all backends failed
+* ``fail_file``: :any:`vignette.get_thumbnail` didn't try generating because of a fail-file
+
+Metrics can also be forwarded as they are recorded, by adding callables to
+:any:`Stats.hooks`. Nothing is recorded in worker processes of batch functions like
+:any:`vignette.get_thumbnails`, the instance lives in the process which created it.
+
+This module requires Python 3.
+"""
+
+import threading
+import time
+
+import vignette
+
+
+__all__ = (
+	'Stats',
+	'backend_name',
+)
+
+
+def backend_name(backend):
+	"""Get the name under which stats of `backend` are recorded, like ``'PilBackend'``."""
+	name = type(backend).__name__
+	if isinstance(backend, vignette.GnomeThumbnailer):
+		# one instance per thumbnailer command
+		name = '%s:%s' % (name, backend.cmd)
+	return name
+
+
+class _Timer(object):
+	__slots__ = ('stats', 'stage', 'backend', 'start')
+
+	def __init__(self, stats, stage, backend):
+		self.stats = stats
+		self.stage = stage
+		self.backend = backend
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		self.stats.add_time(self.stage, time.perf_counter() - self.start, self.backend)
+
+
+class Stats(object):
+	"""Registry of stage timings and event counters.
+
+	Instances can be used by several threads.
+
+	:ivar timings: dict of ``[count, total seconds, max seconds]`` lists, by
+	               ``(stage, backend name)``. The backend name is None for stages not
+	               specific to a backend.
+	:ivar counters: dict of counts, by ``(event, backend name)``
+	:ivar hooks: list of callables, called with ``(kind, name, backend, value)`` for each
+	             record: `kind` is ``'time'`` (`value` in seconds) or ``'count'`` (`value` is
+	             1), `name` is the stage or event, `backend` the backend name or None
+	"""
+
+	def __init__(self):
+		self.timings = {}
+		self.counters = {}
+		self.hooks = []
+		self._lock = threading.Lock()
+
+	def timer(self, stage, backend=None):
+		"""Get a context manager recording the time spent in its block for `stage`."""
+		return _Timer(self, stage, backend)
+
+	def add_time(self, stage, seconds, backend=None):
+		"""Record `seconds` spent in `stage`, by `backend` if not None."""
+		if backend is not None:
+			backend = backend_name(backend)
+
+		key = (stage, backend)
+		with self._lock:
+			timing = self.timings.get(key)
+			if timing is None:
+				self.timings[key] = [1, seconds, seconds]
+			else:
+				timing[0] += 1
+				timing[1] += seconds
+				timing[2] = max(timing[2], seconds)
+
+		for hook in self.hooks:
+			hook('time', stage, backend, seconds)
+
+	def count(self, event, backend=None):
+		"""Count an occurrence of `event`, for `backend` if not None."""
+		if backend is not None:
+			backend = backend_name(backend)
+
+		key = (event, backend)
+		with self._lock:
+			self.counters[key] = self.counters.get(key, 0) + 1
+
+		for hook in self.hooks:
+			hook('count', event, backend, 1)
+
+	def snapshot(self):
+		"""Get the recorded stats, in a form suitable for exporting (for example as JSON).
+
+		:returns: a dict with ``timings``, a list of dicts with keys ``stage``, ``backend``,
+		          ``count``, ``total_s`` and ``max_s``, and ``counters``, a list of dicts
+		          with keys ``event``, ``backend`` and ``count``
+		"""
+		with self._lock:
+			timings = [
+				{'stage': stage, 'backend': backend, 'count': count, 'total_s': total, 'max_s': longest}
+				for (stage, backend), (count, total, longest) in self.timings.items()
+			]
+			counters = [
+				{'event': event, 'backend': backend, 'count': count}
+				for (event, backend), count in self.counters.items()
+			]
+		return {'timings': timings, 'counters': counters}
+
+	def reset(self):
+		"""Forget all recorded stats."""
+		with self._lock:
+			self.timings.clear()
+			self.counters.clear()
@@ -0,0 +1,383 @@
+"""Scan and maintain whole directories of the thumbnail store.
+
+The store is walked with :any:`os.scandir` and thumbnails metadata is read with
+:any:`vignette.read_png_text`, so images are never decoded. Results are streamed as
+:any:`ThumbnailRecord` tuples, in no particular order.
+
+Example, listing thumbnails with the URI they were generated for::
+
+  from vignette import store
+
+  for record in store.scan_store(kinds=('normal', 'large'), workers=8):
+    print(record.path, record.uri)
+
+The store can be kept under a size budget with :any:`collect_garbage`, which is also
+available from the command-line::
+
+  python -m vignette gc --max-size 2G
+
+This module requires Python 3.
+"""
+
+from collections import namedtuple
+import os
+import re
+
+import vignette
+
+
+__all__ = (
+	'StoreUsage',
+	'ThumbnailRecord',
+	'collect_garbage',
+	'iter_store_dirs',
+	'read_record',
+	'scan_dir',
+	'scan_store',
+)
+
+
+ThumbnailRecord = namedtuple('ThumbnailRecord', (
+	'path', 'kind', 'appname', 'hash', 'uri', 'mtime', 'size', 'file_size', 'atime',
+))
+
+ThumbnailRecord.__doc__ = """A file found in the thumbnail store.
+
+:ivar path: path of the thumbnail file
+:ivar kind: 'normal', 'large' or 'fail'
+:ivar appname: for fail-files, name of the app which failed, else None
+:ivar hash: the MD5 hash of the source URI, taken from the file name, or None if the file name
+            is not valid
+:ivar uri: source URI from metadata, or None if missing or unreadable
+:ivar mtime: source mtime from metadata, or None if missing or unreadable
+:ivar size: source file size from metadata, or None if missing
+:ivar file_size: size of the thumbnail file
+:ivar atime: last access time of the thumbnail file
+"""
+
+
+KINDS = ('normal', 'large', 'fail')
+
+NAME_RE = re.compile(r'^([0-9a-fA-F]{32})\.png$')
+
+
+def iter_store_dirs(root=None, kinds=KINDS):
+	"""Get the directories of the store.
+
+	:param root: thumbnail store directory, by default the user's one
+	:param kinds: which kinds of thumbnail directories to return
+	:returns: an iterator of ``(kind, appname, path)`` tuples, of existing directories
+	"""
+
+	if root is None:
+		root = vignette._thumb_path_prefix()
+
+	for kind in kinds:
+		path = os.path.join(root, kind)
+		if kind != 'fail':
+			if os.path.isdir(path):
+				yield kind, None, path
+			continue
+
+		try:
+			entries = list(os.scandir(path))
+		except OSError:
+			continue
+		for entry in entries:
+			if entry.is_dir(follow_symlinks=False):
+				yield kind, entry.name, entry.path
+
+
+def _int_or_none(value):
+	try:
+		return int(float(value))
+	except (TypeError, ValueError):
+		return None
+
+
+def read_record(entry, kind, appname=None, metadata=True):
+	"""Build a :any:`ThumbnailRecord` from a :any:`os.DirEntry`.
+
+	:param metadata: if False, the thumbnail is not read, only its file status
+	"""
+
+	st = entry.stat(follow_symlinks=False)
+	match = NAME_RE.match(entry.name)
+
+	text = None
+	if metadata and match:
+		text = vignette.read_png_text(entry.path, (vignette.KEY_URI, vignette.KEY_MTIME))
+	text = text or {}
+
+	return ThumbnailRecord(
+		path=entry.path,
+		kind=kind,
+		appname=appname,
+		hash=match and match.group(1).lower(),
+		uri=text.get(vignette.KEY_URI),
+		mtime=_int_or_none(text.get(vignette.KEY_MTIME)),
+		size=_int_or_none(text.get(vignette.KEY_SIZE)),
+		file_size=st.st_size,
+		atime=st.st_atime,
+	)
+
+
+def scan_dir(path, kind, appname=None, metadata=True):
+	"""Yield a :any:`ThumbnailRecord` for each file in directory `path`."""
+
+	with os.scandir(path) as entries:
+		for entry in entries:
+			if entry.is_file(follow_symlinks=False):
+				record = _read_entry((kind, appname, entry), metadata)
+				if record is not None:
+					yield record
+
+
+def _iter_entries(root, kinds):
+	for kind, appname, path in iter_store_dirs(root, kinds):
+		try:
+			with os.scandir(path) as entries:
+				for entry in entries:
+					if entry.is_file(follow_symlinks=False):
+						yield kind, appname, entry
+		except OSError:
+			continue
+
+
+def _read_entry(item, metadata):
+	kind, appname, entry = item
+	try:
+		return read_record(entry, kind, appname, metadata)
+	except OSError:
+		# removed in the meantime
+		return None
+
+
+def scan_store(root=None, kinds=KINDS, workers=None, metadata=True):
+	"""Yield a :any:`ThumbnailRecord` for each file in the store.
+
+	:param root: thumbnail store directory, by default the user's one
+	:param kinds: which kinds of thumbnail directories to scan
+	:param workers: if not None, number of threads reading thumbnails in parallel
+	:param metadata: if False, thumbnails are not read, only their file status
+	"""
+
+	items = _iter_entries(root, kinds)
+
+	if workers is None:
+		for item in items:
+			record = _read_entry(item, metadata)
+			if record is not None:
+				yield record
+		return
+
+	for _, record in vignette._iter_parallel(_read_entry, items, (metadata,), workers, threads=True):
+		if record is not None:
+			yield record
+
+
+USAGE_FILE = '.vignette-usage.json'
+
+"""Name of the file where :any:`StoreUsage` is saved, in the store directory."""
+
+
+class StoreUsage(object):
+	"""Index of the size and access time of each file in the store.
+
+	The index is saved in the store directory and updated incrementally: only directories
+	modified since the last update are listed again, and only new files in them are
+	``stat()``-ed. Sizes and access times of known files are thus approximate, they are
+	refreshed by :any:`collect_garbage` before deciding to remove a file.
+	"""
+
+	# a directory modified so recently may be modified again without its mtime changing
+	racy_delay = 2
+
+	def __init__(self, root=None):
+		if root is None:
+			root = vignette._thumb_path_prefix()
+		self.root = root
+		self.path = os.path.join(root, USAGE_FILE)
+		self.dirs = {}
+
+	def load(self):
+		import json
+
+		try:
+			with open(self.path) as fd:
+				self.dirs = json.load(fd)['dirs']
+		except (IOError, OSError, ValueError, KeyError, TypeError):
+			self.dirs = {}
+
+	def save(self):
+		import json
+
+		tmp = vignette._mkstemp(self.path)
+		with open(tmp, 'w') as fd:
+			json.dump({'dirs': self.dirs}, fd, separators=(',', ':'))
+		os.rename(tmp, self.path)
+
+	def update(self):
+		"""Take into account files added or removed since last update."""
+		import time
+
+		seen = set()
+		for kind, appname, path in iter_store_dirs(self.root):
+			seen.add(path)
+			try:
+				dir_mtime = os.stat(path).st_mtime
+			except OSError:
+				continue
+
+			cached = self.dirs.get(path)
+			if cached and cached['mtime'] == dir_mtime:
+				continue
+
+			old = cached['entries'] if cached else {}
+			entries = {}
+			with os.scandir(path) as it:
+				for entry in it:
+					if not entry.is_file(follow_symlinks=False):
+						continue
+					try:
+						entries[entry.name] = old.get(entry.name) or self._stat(entry)
+					except OSError:
+						pass
+
+			if time.time() - dir_mtime < self.racy_delay:
+				dir_mtime = None
+			self.dirs[path] = {'mtime': dir_mtime, 'entries': entries}
+
+		for path in set(self.dirs) - seen:
+			del self.dirs[path]
+
+	@staticmethod
+	def _stat(entry):
+		st = entry.stat(follow_symlinks=False)
+		return [st.st_size, st.st_atime]
+
+	def __iter__(self):
+		"""Iterate on ``(atime, file_size, path)`` of all files."""
+		for path, cached in self.dirs.items():
+			for name, (file_size, atime) in cached['entries'].items():
+				yield atime, file_size, os.path.join(path, name)
+
+	def totals(self):
+		"""Get the total size and number of files."""
+		size = count = 0
+		for cached in self.dirs.values():
+			for file_size, _ in cached['entries'].values():
+				size += file_size
+				count += 1
+		return size, count
+
+	def forget(self, path):
+		dirname, name = os.path.split(path)
+		self.dirs.get(dirname, {}).get('entries', {}).pop(name, None)
+
+	def refresh(self, path):
+		"""Update the size and access time of `path`, return them or None if it is gone."""
+		dirname, name = os.path.split(path)
+		try:
+			st = os.stat(path)
+		except OSError:
+			self.forget(path)
+			return None
+		res = self.dirs[dirname]['entries'][name] = [st.st_size, st.st_atime]
+		return res
+
+
+def collect_garbage(max_size=None, max_entries=None, root=None, dry_run=False):
+	"""Remove least recently accessed files of the store to keep it under a budget.
+
+	Thumbnails of all sizes and fail-files are considered together. The :any:`StoreUsage`
+	index is used and updated, so running this periodically is cheap.
+
+	:param max_size: maximum total size in bytes of the files in the store
+	:type max_size: int
+	:param max_entries: maximum number of files in the store
+	:type max_entries: int
+	:param root: thumbnail store directory, by default the user's one
+	:param dry_run: if True, files are not actually removed
+	:returns: the list of removed files
+	"""
+
+	import heapq
+
+	usage = StoreUsage(root)
+	usage.load()
+	usage.update()
+	size, count = usage.totals()
+
+	def over_budget():
+		return (
+			(max_size is not None and size > max_size)
+			or (max_entries is not None and count > max_entries)
+		)
+
+	removed = []
+	if over_budget():
+		heap = list(usage)
+		heapq.heapify(heap)
+
+		while heap and over_budget():
+			atime, file_size, path = heapq.heappop(heap)
+
+			current = usage.refresh(path)
+			if current is None:
+				size -= file_size
+				count -= 1
+				continue
+
+			size += current[0] - file_size
+			if current[1] > atime:
+				# accessed since it was indexed
+				heapq.heappush(heap, (current[1], current[0], path))
+				continue
+
+			if not dry_run:
+				try:
+					os.remove(path)
+				except OSError:
+					continue
+			usage.forget(path)
+			size -= current[0]
+			count -= 1
+			removed.append(path)
+
+	if not dry_run and os.path.isdir(usage.root):
+		usage.save()
+	return removed
+
+
+def parse_size(text):
+	"""Parse a size like "500M" or "2G" (powers of 1024) into a number of bytes."""
+
+	units = 'KMGT'
+	text = text.strip().upper().rstrip('B')
+	if text and text[-1] in units:
+		return int(float(text[:-1]) * 1024 ** (units.index(text[-1]) + 1))
+	return int(text)
+
+
+def gc_main(argv):
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		prog='vignette gc',
+		description='Remove least recently used thumbnails to keep the store under a budget',
+	)
+	parser.add_argument('--max-size', type=parse_size, help='maximum size (e.g. 500M, 2G)')
+	parser.add_argument('--max-entries', type=int, help='maximum number of files')
+	parser.add_argument('--dry-run', action='store_true', help='do not actually remove files')
+	parser.add_argument('-v', '--verbose', action='store_true', help='print removed files')
+	args = parser.parse_args(argv)
+
+	if args.max_size is None and args.max_entries is None:
+		parser.error('at least one of --max-size and --max-entries is required')
+
+	removed = collect_garbage(args.max_size, args.max_entries, dry_run=args.dry_run)
+	if args.verbose:
+		for path in removed:
+			print(path)
+	print('Removed %d files' % len(removed))
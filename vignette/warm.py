@@ -0,0 +1,282 @@
+"""Generate thumbnails in advance for whole directory trees.
+
+Directories are walked in a stable order, files with a valid thumbnail (or a fail-file) are
+skipped using :any:`vignette.lookup_directory` (the store being listed once per run), and the missing thumbnails are generated in
+parallel with :any:`vignette.get_thumbnails`::
+
+  from vignette import warm
+
+  summary = warm.warm_tree(['/mnt/photos'], size='large')
+  print(summary.created)
+
+It is also available from the command-line::
+
+  python -m vignette warm /mnt/photos /mnt/videos
+
+Progress is written to a journal, listing the directories completed, so an interrupted
+run resumes where it stopped instead of checking every file again. The journal is removed
+when the run completes.
+
+This module requires Python 3.
+"""
+
+from collections import namedtuple
+import hashlib
+import os
+
+import vignette
+
+
+__all__ = (
+	'Journal',
+	'WarmSummary',
+	'default_journal_path',
+	'iter_tree',
+	'warm_tree',
+)
+
+
+FAIL_APPNAME = 'vignette-warm'
+
+"""App name of the fail-files created for files which can't be thumbnailed, so later runs
+skip them."""
+
+
+WarmSummary = namedtuple('WarmSummary', ('created', 'skipped', 'failed'))
+
+WarmSummary.__doc__ = """Counts of files handled by :any:`warm_tree`.
+
+:ivar created: number of thumbnails generated
+:ivar skipped: number of files having a valid thumbnail, or a fail-file, already
+:ivar failed: number of files which couldn't be thumbnailed
+"""
+
+
+class Journal(object):
+	"""Directories completed by a run, appended to a file as they complete.
+
+	Only complete lines are read back, so a run killed while writing a line only loses that
+	directory.
+
+	:param path: path of the journal file
+	:ivar done: set of completed directories
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.done = set()
+		self._fd = None
+
+		try:
+			with open(path, encoding='utf-8', errors='surrogateescape') as fd:
+				for line in fd:
+					if line.endswith('\n'):
+						self.done.add(line[:-1])
+		except FileNotFoundError:
+			pass
+
+	def add(self, dirpath):
+		"""Record `dirpath` as completed."""
+		if self._fd is None:
+			vignette._makedir(os.path.dirname(self.path))
+			self._fd = open(self.path, 'a', encoding='utf-8', errors='surrogateescape')
+		self._fd.write('%s\n' % dirpath)
+		self._fd.flush()
+		self.done.add(dirpath)
+
+	def close(self):
+		if self._fd is not None:
+			self._fd.close()
+			self._fd = None
+
+	def remove(self):
+		"""Close and delete the journal."""
+		self.close()
+		try:
+			os.remove(self.path)
+		except FileNotFoundError:
+			pass
+
+
+def default_journal_path(roots, size):
+	"""Get the path of the journal of a run, in the thumbnail store.
+
+	Runs on the same directories and size share the same journal.
+	"""
+
+	key = '\0'.join(sorted(set(os.path.abspath(root) for root in roots)) + [size])
+	digest = hashlib.md5(key.encode('utf-8', 'surrogateescape')).hexdigest()
+	return os.path.join(vignette._thumb_path_prefix(), '.vignette-warm', '%s.journal' % digest)
+
+
+def _is_hidden(path):
+	return os.path.basename(path).startswith('.')
+
+
+def iter_tree(roots, include_hidden=False):
+	"""Walk directory trees depth-first, in sorted order.
+
+	Symbolic links to directories are not followed, and the thumbnail store is skipped. Each
+	directory is yielded once, even if `roots` overlap.
+
+	:param roots: paths of the directories to walk
+	:param include_hidden: if False, skip directories starting with a dot
+	:returns: an iterator of absolute paths of directories
+	"""
+
+	store = vignette._thumb_path_prefix()
+	stack = sorted(set(os.path.abspath(root) for root in roots), reverse=True)
+	visited = set()
+	while stack:
+		path = stack.pop()
+		if path == store or path in visited:
+			continue
+		visited.add(path)
+		yield path
+
+		subdirs = []
+		try:
+			with os.scandir(path) as entries:
+				for entry in entries:
+					try:
+						if not entry.is_dir(follow_symlinks=False):
+							continue
+					except OSError:
+						continue
+					if include_hidden or not _is_hidden(entry.name):
+						subdirs.append(entry.path)
+		except OSError:
+			# unreadable or removed in the meantime
+			continue
+		stack.extend(sorted(subdirs, reverse=True))
+
+
+def warm_tree(
+	roots, size='large', use_fail_appname=FAIL_APPNAME, retry_failed=False, workers=None,
+	journal=None, include_hidden=False, callback=None, threads=False,
+):
+	"""Generate the missing thumbnails of all files in directory trees.
+
+	:param roots: paths of the directories
+	:param size: size of the thumbnails, 'large' or 'normal'
+	:param use_fail_appname: app name of fail-files to create for files which can't be
+	                         thumbnailed, and to skip in later runs
+	:param retry_failed: if True, don't skip files having a fail-file
+	:param workers: number of worker processes, by default the number of CPUs
+	:param journal: a :any:`Journal`, to skip the directories it lists and record the
+	                directories completed; None to not use a journal
+	:param include_hidden: if False, skip files and directories starting with a dot
+	:param callback: if not None, called with ``(src, thumbnail)`` for each generated
+	                 thumbnail, `thumbnail` being None if it failed
+	:param threads: if True, use worker threads instead of processes, see
+	                :any:`vignette.get_thumbnails`
+	:rtype: WarmSummary
+	"""
+
+	size = vignette._any2size(size)[1]
+	counts = {'created': 0, 'skipped': 0, 'failed': 0}
+	# number of files being generated, by directory
+	remaining = {}
+
+	def finish_dir(dirpath):
+		if journal is not None:
+			journal.add(dirpath)
+
+	def iter_missing():
+		# thumbnails created meanwhile are not listed, get_thumbnail will find them
+		existing = vignette.list_store(size)
+
+		for dirpath in iter_tree(roots, include_hidden):
+			if journal is not None and dirpath in journal.done:
+				continue
+
+			try:
+				found = vignette.lookup_directory(dirpath, size, existing)
+			except OSError:
+				continue
+
+			missing = []
+			for src, thumb in sorted(found.items()):
+				if not include_hidden and _is_hidden(src):
+					continue
+				if thumb is not None or (
+					use_fail_appname and not retry_failed
+					and vignette.is_thumbnail_failed(src, use_fail_appname)
+				):
+					counts['skipped'] += 1
+				else:
+					missing.append(src)
+
+			if not missing:
+				finish_dir(dirpath)
+				continue
+
+			remaining[dirpath] = remaining.get(dirpath, 0) + len(missing)
+			for src in missing:
+				yield src
+
+	if retry_failed:
+		# get_thumbnail would give up on files having a fail-file
+		results = vignette.create_thumbnails(
+			iter_missing(), size, use_fail_appname=use_fail_appname, workers=workers, threads=threads
+		)
+	else:
+		results = vignette.get_thumbnails(iter_missing(), size, use_fail_appname, workers, threads)
+	for src, thumb in results:
+		counts['created' if thumb else 'failed'] += 1
+		if callback is not None:
+			callback(src, thumb)
+
+		dirpath = os.path.dirname(src)
+		remaining[dirpath] -= 1
+		if not remaining[dirpath]:
+			del remaining[dirpath]
+			finish_dir(dirpath)
+
+	return WarmSummary(**counts)
+
+
+def warm_main(argv):
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		prog='vignette warm',
+		description='Generate the missing thumbnails of all files in directory trees',
+	)
+	parser.add_argument('dirs', nargs='+', metavar='DIR')
+	parser.add_argument('--size', choices=('large', 'normal'), default='large', help='size of thumbnails')
+	parser.add_argument('--workers', type=int, help='number of worker processes (or threads)')
+	parser.add_argument('--threads', action='store_true', help='use worker threads instead of processes')
+	parser.add_argument('--hidden', action='store_true', help='include hidden files and directories')
+	parser.add_argument(
+		'--retry-failed', action='store_true', help='retry files which could not be thumbnailed before'
+	)
+	parser.add_argument('--journal', help='path of the progress journal (default: in the thumbnail store)')
+	parser.add_argument('--restart', action='store_true', help='ignore the progress of an interrupted run')
+	parser.add_argument('-v', '--verbose', action='store_true', help='print generated thumbnails')
+	args = parser.parse_args(argv)
+
+	journal_path = args.journal or default_journal_path(args.dirs, args.size)
+	if args.restart:
+		Journal(journal_path).remove()
+	journal = Journal(journal_path)
+
+	def report(src, thumb):
+		if thumb is None:
+			print('failed: %s' % src)
+		else:
+			print(thumb)
+
+	try:
+		summary = warm_tree(
+			args.dirs, args.size, retry_failed=args.retry_failed, workers=args.workers,
+			journal=journal, include_hidden=args.hidden, callback=report if args.verbose else None,
+			threads=args.threads,
+		)
+	except KeyboardInterrupt:
+		journal.close()
+		print('Interrupted, run again to resume')
+		return 1
+
+	journal.remove()
+	print('Created %d thumbnails, %d up to date, %d failed' % summary)